@@ -1,11 +1,28 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, WebSocket, WebSocketDisconnect, Body
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, WebSocket, WebSocketDisconnect, Body, BackgroundTasks, Header, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from dotenv import load_dotenv
+from starlette.datastructures import Headers, MutableHeaders
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateMany, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, ConnectionFailure, DuplicateKeyError, ExecutionTimeout, OperationFailure, PyMongoError, WTimeoutError
 import os
+import sys
+import asyncio
+import csv
+import hashlib
+import io
+import json
 import logging
+import math
+import re
+import threading
+import time
+import zlib
+from bisect import bisect_left
+from contextvars import ContextVar
 from pathlib import Path
 from pydantic import BaseModel, Field, EmailStr
 from typing import List, Optional, Dict, Set, Any
@@ -21,19 +38,443 @@ from email.message import EmailMessage
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# ========================= OBSERVABILITY =========================
+# Request and Mongo metrics. Motor runs pymongo calls on executor threads with a
+# copy of the caller's context, so the command listener can attribute each
+# command to the request in `current_request_queries`.
+
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() == "true"
+# Debug mode: log likely N+1 patterns per request and `explain` slow queries.
+QUERY_DEBUG = os.environ.get("QUERY_DEBUG", "false").lower() == "true"
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", "250"))
+N_PLUS_ONE_THRESHOLD = int(os.environ.get("N_PLUS_ONE_THRESHOLD", "10"))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 250)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class RequestQueryStats:
+    """Mongo work done on behalf of one request, grouped by query shape."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.duration = 0.0
+        self.docs = 0
+        self.shapes: Dict[str, int] = {}
+
+    def record(self, duration: float, docs: int, shape: str):
+        with self.lock:
+            self.count += 1
+            self.duration += duration
+            self.docs += docs
+            self.shapes[shape] = self.shapes.get(shape, 0) + 1
+
+    def repeated_shapes(self, threshold: int) -> Dict[str, int]:
+        return {shape: n for shape, n in self.shapes.items() if n >= threshold}
+
+current_request_queries: ContextVar[Optional[RequestQueryStats]] = ContextVar("current_request_queries", default=None)
+# Finished request stats are also appended to each list here (query-budget tests, debugging).
+query_capture_sinks: List[List[RequestQueryStats]] = []
+
+def command_filter(command_name: str, command: dict) -> dict:
+    if command_name in ("update", "delete"):
+        statements = command.get("updates") or command.get("deletes") or [{}]
+        return statements[0].get("q") or {}
+    if command_name == "aggregate":
+        first = (command.get("pipeline") or [{}])[0]
+        return first.get("$match") or {}
+    return command.get("filter") or command.get("query") or {}
+
+def query_shape(collection: str, command_name: str, query: Optional[dict]) -> str:
+    """`collection.command{filter keys}`, e.g. `users.find{id}`: same shape, same query bar values."""
+    keys = ",".join(sorted((query or {}).keys())) if isinstance(query, dict) else ""
+    return f"{collection}.{command_name}{{{keys}}}"
+
+def _prom_labels(**labels) -> str:
+    def escape(value) -> str:
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels.items()) + "}"
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.request_latency: Dict[tuple, Histogram] = {}  # (method, route)
+        self.request_queries: Dict[tuple, Histogram] = {}  # (method, route)
+        self.request_query_seconds: Dict[tuple, float] = {}  # (method, route)
+        self.responses: Dict[tuple, int] = {}  # (method, route, status)
+        self.command_latency: Dict[tuple, Histogram] = {}  # (collection, command)
+        self.command_docs: Dict[tuple, int] = {}
+        self.command_failures: Dict[tuple, int] = {}
+        self.n_plus_one: Dict[tuple, int] = {}  # (method, route, shape)
+
+    def observe_request(self, method: str, route: str, status_code: int, seconds: float, queries: RequestQueryStats):
+        key = (method, route)
+        with self.lock:
+            self.request_latency.setdefault(key, Histogram(LATENCY_BUCKETS)).observe(seconds)
+            self.request_queries.setdefault(key, Histogram(QUERY_COUNT_BUCKETS)).observe(queries.count)
+            self.request_query_seconds[key] = self.request_query_seconds.get(key, 0.0) + queries.duration
+            self.responses[(method, route, status_code)] = self.responses.get((method, route, status_code), 0) + 1
+
+    def observe_command(self, collection: str, command: str, seconds: float, docs: int, failed: bool = False):
+        key = (collection, command)
+        with self.lock:
+            self.command_latency.setdefault(key, Histogram(LATENCY_BUCKETS)).observe(seconds)
+            self.command_docs[key] = self.command_docs.get(key, 0) + docs
+            if failed:
+                self.command_failures[key] = self.command_failures.get(key, 0) + 1
+
+    @staticmethod
+    def _histogram_lines(name: str, series: Dict[tuple, Histogram], label_names: tuple) -> List[str]:
+        lines = [f"# TYPE {name} histogram"]
+        for key, hist in sorted(series.items()):
+            labels = dict(zip(label_names, key))
+            cumulative = 0
+            for bound, count in zip(hist.buckets, hist.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{_prom_labels(**labels, le=bound)} {cumulative}")
+            lines.append(f"{name}_bucket{_prom_labels(**labels, le='+Inf')} {hist.count}")
+            lines.append(f"{name}_sum{_prom_labels(**labels)} {hist.sum}")
+            lines.append(f"{name}_count{_prom_labels(**labels)} {hist.count}")
+        return lines
+
+    @staticmethod
+    def _counter_lines(name: str, series: Dict[tuple, float], label_names: tuple) -> List[str]:
+        lines = [f"# TYPE {name} counter"]
+        for key, value in sorted(series.items()):
+            lines.append(f"{name}{_prom_labels(**dict(zip(label_names, key)))} {value}")
+        return lines
+
+    def render(self) -> str:
+        """Prometheus text exposition format (0.0.4)."""
+        with self.lock:
+            lines = ["# TYPE petsy_http_requests_in_flight gauge", f"petsy_http_requests_in_flight {self.in_flight}"]
+            lines += self._histogram_lines("petsy_http_request_duration_seconds", self.request_latency, ("method", "route"))
+            lines += self._counter_lines("petsy_http_responses_total", self.responses, ("method", "route", "status"))
+            lines += self._histogram_lines("petsy_http_request_mongo_queries", self.request_queries, ("method", "route"))
+            lines += self._counter_lines("petsy_http_request_mongo_seconds_total", self.request_query_seconds, ("method", "route"))
+            lines += self._histogram_lines("petsy_mongo_command_duration_seconds", self.command_latency, ("collection", "command"))
+            lines += self._counter_lines("petsy_mongo_documents_returned_total", self.command_docs, ("collection", "command"))
+            lines += self._counter_lines("petsy_mongo_command_failures_total", self.command_failures, ("collection", "command"))
+            lines += self._counter_lines("petsy_n_plus_one_total", self.n_plus_one, ("method", "route", "shape"))
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+def record_query(collection: str, command_name: str, seconds: float, docs: int, shape: str, failed: bool = False):
+    metrics.observe_command(collection, command_name, seconds, docs, failed)
+    stats = current_request_queries.get()
+    if stats is not None:
+        stats.record(seconds, docs, shape)
+
+EXPLAINABLE_COMMANDS = {"find", "aggregate", "count", "distinct", "update", "delete", "findAndModify"}
+EXPLAIN_COOLDOWN_SECONDS = 600
+explained_shapes: Dict[str, float] = {}
+query_debug_loop: Optional[asyncio.AbstractEventLoop] = None  # set at startup
+
+async def explain_slow_query(shape: str, command: dict):
+    now = time.monotonic()
+    if now - explained_shapes.get(shape, float("-inf")) < EXPLAIN_COOLDOWN_SECONDS:
+        return
+    explained_shapes[shape] = now
+    clean = {k: v for k, v in command.items() if not k.startswith("$") and k not in ("lsid", "txnNumber", "autocommit", "startTransaction")}
+    try:
+        plan = await db.command("explain", clean, verbosity="queryPlanner")
+    except Exception as e:
+        logger.warning(f"Explain failed for slow query {shape}: {e}")
+        return
+    winning = (plan.get("queryPlanner") or {}).get("winningPlan") or {}
+    stages = []
+    while winning:
+        stages.append(winning.get("stage") or "?")
+        winning = winning.get("inputStage") or (winning.get("inputStages") or [None])[0]
+    logger.warning(f"Slow query plan {shape}: {' <- '.join(stages) or plan}")
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Feeds every Mongo command into `metrics` and the current request's stats.
+
+    Commands slower than SLOW_QUERY_MS are logged; with QUERY_DEBUG their plan is
+    fetched with `explain` (at most once per shape per EXPLAIN_COOLDOWN_SECONDS).
+    """
+
+    IGNORED_COMMANDS = {"hello", "ismaster", "isMaster", "ping", "saslStart", "saslContinue", "endSessions", "buildInfo", "explain"}
+
+    def __init__(self):
+        self._pending: Dict[int, tuple] = {}  # request_id -> (collection, shape, command kept for explain)
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        if event.command_name in self.IGNORED_COMMANDS:
+            return
+        collection = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            collection = event.command.get("collection")
+        collection = collection if isinstance(collection, str) else "-"
+        shape = query_shape(collection, event.command_name, command_filter(event.command_name, event.command))
+        keep = dict(event.command) if QUERY_DEBUG and event.command_name in EXPLAINABLE_COMMANDS else None
+        with self._lock:
+            self._pending[event.request_id] = (collection, shape, keep)
+
+    @staticmethod
+    def _documents(reply) -> int:
+        cursor = reply.get("cursor") or {}
+        if "firstBatch" in cursor or "nextBatch" in cursor:
+            return len(cursor.get("firstBatch") or cursor.get("nextBatch") or [])
+        if "value" in reply:
+            return 1 if reply.get("value") else 0
+        return int(reply.get("n") or 0)
+
+    def _finish(self, event, docs: int, failed: bool):
+        with self._lock:
+            pending = self._pending.pop(event.request_id, None)
+        if pending is None:
+            return
+        collection, shape, command = pending
+        seconds = event.duration_micros / 1_000_000
+        record_query(collection, event.command_name, seconds, docs, shape, failed)
+        if seconds * 1000 >= SLOW_QUERY_MS:
+            logger.warning(f"Slow query {shape}: {seconds * 1000:.0f}ms, {docs} docs")
+            if command is not None and query_debug_loop is not None:
+                asyncio.run_coroutine_threadsafe(explain_slow_query(shape, command), query_debug_loop)
+
+    def succeeded(self, event):
+        self._finish(event, self._documents(event.reply or {}), failed=False)
+
+    def failed(self, event):
+        self._finish(event, 0, failed=True)
+
+mongo_command_metrics = MongoCommandMetrics()
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[mongo_command_metrics] if METRICS_ENABLED else [])
 db = client[os.environ.get('DB_NAME', 'petsy_db')]
 
+# Multi-document transactions need a replica set / sharded cluster; opt in explicitly.
+MONGO_TRANSACTIONS = os.environ.get("MONGO_TRANSACTIONS", "false").lower() == "true"
+
 # JWT Configuration
 SECRET_KEY = os.environ.get('JWT_SECRET', 'petsy-secret-key-2025')
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_DAYS = 30
 ALLOW_INSECURE_AUTH_CODE_RESPONSE = os.environ.get("ALLOW_INSECURE_AUTH_CODE_RESPONSE", "false").lower() == "true"
 
+# ========================= FAST JSON RESPONSES =========================
+
+try:
+    import orjson
+except ImportError:  # optional: fall back to the stdlib encoder
+    orjson = None
+
+FAST_JSON_RESPONSES = os.environ.get("FAST_JSON_RESPONSES", "false").lower() == "true" and orjson is not None
+
+class FastJSONResponse(JSONResponse):
+    """orjson renderer; datetimes come out in the same ISO format Pydantic produces."""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=str, option=orjson.OPT_NON_STR_KEYS)
+
+DefaultJSONResponse = FastJSONResponse if FAST_JSON_RESPONSES else JSONResponse
+
+def mongo_projection(*fields: str) -> dict:
+    return {"_id": 0, **{name: 1 for name in fields}}
+
+def parse_fields(fields: Optional[str], allowed) -> Optional[List[str]]:
+    """Parse a sparse fieldset (`?fields=name,avatar`) against what an endpoint can return."""
+    requested = [f.strip() for f in (fields or "").split(",") if f.strip()]
+    if not requested:
+        return None
+    unknown = sorted(set(requested) - set(allowed))
+    if unknown:
+        raise HTTPException(status_code=400, detail=error_detail("INVALID_FIELDS", f"Unknown fields: {', '.join(unknown)}"))
+    return requested
+
+def pick_fields(row: dict, fields: Optional[List[str]]) -> dict:
+    if fields is None:
+        return row
+    return {k: v for k, v in row.items() if k == "id" or k in fields}
+
+class TrustedProjection:
+    """Serve Mongo documents shaped like `model` without building and re-validating models.
+
+    Only the model's fields are fetched (`projection`), and defaults are filled in
+    the way `response_model` would, so the JSON is the same as the validated path.
+    Use it only for collections the API itself writes through that model.
+    """
+
+    def __init__(self, model, fields=None):
+        self.model = model
+        self.fields = {name for name in model.model_fields if fields is None or name in fields}
+        self.projection = mongo_projection(*self.fields)
+        self.defaults = {
+            name: field.default
+            for name, field in model.model_fields.items()
+            if name in self.fields and not field.is_required() and field.default_factory is None
+        }
+        self.factories = {
+            name: field.default_factory
+            for name, field in model.model_fields.items()
+            if name in self.fields and field.default_factory is not None
+        }
+
+    def only(self, fields: Optional[str]) -> "TrustedProjection":
+        """Narrow to a `fields=a,b` query parameter; `id` is always returned."""
+        requested = parse_fields(fields, self.model.model_fields)
+        if requested is None:
+            return self
+        return TrustedProjection(self.model, {"id", *requested})
+
+    def row(self, doc: dict) -> dict:
+        row = {**self.defaults, **{k: v for k, v in doc.items() if k in self.fields}}
+        for name, factory in self.factories.items():
+            if name not in row:
+                row[name] = factory()
+        return row
+
+    def response(self, docs) -> Response:
+        rows = [self.row(doc) for doc in docs] if isinstance(docs, list) else self.row(docs)
+        if FAST_JSON_RESPONSES:
+            return FastJSONResponse(rows)
+        return JSONResponse(jsonable_encoder(rows))
+
+# ========================= RESPONSE COMPRESSION =========================
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
+
+COMPRESSION_ENABLED = os.environ.get("COMPRESSION_ENABLED", "true").lower() == "true"
+COMPRESSION_MIN_BYTES = int(os.environ.get("COMPRESSION_MIN_BYTES", "1024"))
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.environ.get("BROTLI_QUALITY", "5"))
+COMPRESSION_ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/", "application/javascript", "image/svg+xml")
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """Pick the best supported content-coding from an Accept-Encoding header (br before gzip on ties)."""
+    offered = {}
+    for part in (accept_encoding or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip().replace(" ", "")
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if coding:
+            offered[coding.strip().lower()] = q
+    best, best_q = None, 0.0
+    for coding in COMPRESSION_ENCODINGS:
+        q = offered.get(coding, offered.get("*", 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+class StreamCompressor:
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "br":
+            self._br = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self._gz = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)  # 31 = gzip container
+
+    def compress(self, data: bytes) -> bytes:
+        return self._br.process(data) if self.encoding == "br" else self._gz.compress(data)
+
+    def flush(self) -> bytes:
+        """Emit everything compressed so far, so the client can decode it before the stream ends."""
+        return self._br.flush() if self.encoding == "br" else self._gz.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._br.finish() if self.encoding == "br" else self._gz.flush()
+
+def compress_body(encoding: str, body: bytes) -> bytes:
+    compressor = StreamCompressor(encoding)
+    return compressor.compress(body) + compressor.finish()
+
+def is_compressible(content_type: Optional[str]) -> bool:
+    return bool(content_type) and content_type.startswith(COMPRESSIBLE_TYPES)
+
+class CompressionMiddleware:
+    """Negotiated gzip/brotli for responses over `minimum_size`.
+
+    Single-message bodies are compressed in one go; streamed bodies (more_body)
+    are compressed chunk by chunk and sync-flushed after each one, so a streamed
+    export reaches the client as it is produced. Responses that already carry
+    a Content-Encoding (e.g. the precompressed catalogue cache) pass through.
+    """
+
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_BYTES):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding")) if scope["type"] == "http" else None
+        if not COMPRESSION_ENABLED or encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+        compressor = None
+        passthrough = False
+
+        async def send_wrapper(message):
+            nonlocal start, compressor, passthrough
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if compressor is None:
+                headers = MutableHeaders(raw=start["headers"])
+                eligible = (
+                    "content-encoding" not in headers
+                    and start["status"] not in (204, 304)
+                    and is_compressible(headers.get("content-type"))
+                    and (more_body or len(body) >= self.minimum_size)
+                )
+                if not eligible:
+                    passthrough = True
+                    await send(start)
+                    await send(message)
+                    return
+                compressor = StreamCompressor(encoding)
+                headers["Content-Encoding"] = encoding
+                headers.add_vary_header("Accept-Encoding")
+                if "content-length" in headers:
+                    del headers["content-length"]
+                if not more_body:
+                    body = compressor.compress(body) + compressor.finish()
+                    headers["Content-Length"] = str(len(body))
+                    await send(start)
+                    await send({"type": "http.response.body", "body": body})
+                    return
+                await send(start)
+
+            chunk = compressor.compress(body) + (compressor.flush() if more_body else compressor.finish())
+            await send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+
+        await self.app(scope, receive, send_wrapper)
+
 # Create the main app
-app = FastAPI(title="Petsy API", version="1.0.0")
+app = FastAPI(title="Petsy API", version="1.0.0", default_response_class=DefaultJSONResponse)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -45,6 +486,31 @@ security_optional = HTTPBearer(auto_error=False)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# ========================= BACKGROUND JOBS =========================
+
+PERIODIC_JOBS: List[Dict[str, Any]] = []
+background_tasks: List[asyncio.Task] = []
+
+def periodic_job(name: str, interval_seconds: float):
+    """Register a coroutine to run every `interval_seconds` once the app has started.
+
+    An interval of 0 or less disables the job.
+    """
+    def decorator(func):
+        PERIODIC_JOBS.append({"name": name, "interval": interval_seconds, "func": func})
+        return func
+    return decorator
+
+async def run_periodic_job(name: str, interval_seconds: float, func):
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            await func()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Periodic job {name} failed: {e}")
+
 # ========================= REALTIME CHAT (WEBSOCKET) =========================
 
 class ChatConnectionManager:
@@ -104,6 +570,139 @@ async def user_is_conversation_participant(user_id: str, conversation_id: str) -
     conversation = await db.conversations.find_one({"id": conversation_id, "participants": user_id})
     return conversation is not None
 
+# ========================= UNREAD COUNTERS =========================
+#
+# One `user_counters` document per user keeps badge counts in step with writes:
+#   notifications_unread: int
+#   chat_unread: {conversation_id: int}
+# Documents are created lazily and seeded from the source collections on first
+# read (`reconciled_at` unset); a periodic job corrects any drift afterwards.
+
+UNREAD_COUNTER_RECONCILE_SECONDS = float(os.environ.get("UNREAD_COUNTER_RECONCILE_SECONDS", "900"))
+
+async def bump_notifications_unread(user_id: str, delta: int):
+    if not user_id or not delta:
+        return
+    await db.user_counters.update_one(
+        {"user_id": user_id},
+        {"$inc": {"notifications_unread": delta}, "$set": {"updated_at": datetime.utcnow()}},
+        upsert=True,
+    )
+
+async def reset_notifications_unread(user_id: str):
+    await db.user_counters.update_one(
+        {"user_id": user_id},
+        {"$set": {"notifications_unread": 0, "updated_at": datetime.utcnow()}},
+    )
+
+async def record_chat_unread(conversation_id: str, sender_id: str, participants: List[str]):
+    # One round trip for all recipients; per-user upserts because a recipient may have no counters doc yet.
+    recipients = sorted({uid for uid in participants or [] if uid and uid != sender_id})
+    if not recipients:
+        return
+    now = datetime.utcnow()
+    await db.user_counters.bulk_write([
+        UpdateOne({"user_id": uid}, {"$inc": {f"chat_unread.{conversation_id}": 1}, "$set": {"updated_at": now}}, upsert=True)
+        for uid in recipients
+    ], ordered=False)
+
+async def clear_chat_unread(user_id: str, conversation_id: str):
+    await db.user_counters.update_one(
+        {"user_id": user_id},
+        {"$unset": {f"chat_unread.{conversation_id}": ""}, "$set": {"updated_at": datetime.utcnow()}},
+    )
+
+async def count_unread_chat_by_conversation(conversation_ids: List[str], user_id: Optional[str] = None) -> Dict[str, Dict[str, int]]:
+    """Return {user_id: {conversation_id: unread}} from the unread messages of the given conversations.
+
+    When `user_id` is given only that user's counts are returned.
+    """
+    if not conversation_ids:
+        return {}
+    match: dict = {"conversation_id": {"$in": conversation_ids}, "is_read": False}
+    if user_id:
+        match["sender_id"] = {"$ne": user_id}
+    rows = await db.chat_messages.aggregate([
+        {"$match": match},
+        {"$group": {"_id": {"conversation_id": "$conversation_id", "sender_id": "$sender_id"}, "count": {"$sum": 1}}},
+    ]).to_list(None)
+    conversations = await db.conversations.find(
+        {"id": {"$in": list({r["_id"]["conversation_id"] for r in rows})}},
+        {"_id": 0, "id": 1, "participants": 1},
+    ).to_list(None)
+    participants_map = {c["id"]: c.get("participants", []) for c in conversations}
+
+    result: Dict[str, Dict[str, int]] = {}
+    for r in rows:
+        conversation_id = r["_id"]["conversation_id"]
+        for uid in participants_map.get(conversation_id, []):
+            if uid == r["_id"].get("sender_id") or (user_id and uid != user_id):
+                continue
+            per_user = result.setdefault(uid, {})
+            per_user[conversation_id] = per_user.get(conversation_id, 0) + r["count"]
+    return result
+
+async def reconcile_user_counters(user_id: str) -> dict:
+    notifications_unread = await db.notifications.count_documents({"user_id": user_id, "is_read": False})
+    conversations = await db.conversations.find({"participants": user_id}, {"_id": 0, "id": 1}).to_list(None)
+    conversation_ids = [c["id"] for c in conversations if c.get("id")]
+    chat_unread = (await count_unread_chat_by_conversation(conversation_ids, user_id)).get(user_id, {}) if conversation_ids else {}
+
+    row = {
+        "user_id": user_id,
+        "notifications_unread": notifications_unread,
+        "chat_unread": chat_unread,
+        "reconciled_at": datetime.utcnow(),
+        "updated_at": datetime.utcnow(),
+    }
+    await db.user_counters.update_one({"user_id": user_id}, {"$set": row}, upsert=True)
+    return row
+
+async def get_user_counters(user_id: str) -> dict:
+    row = await db.user_counters.find_one({"user_id": user_id})
+    if not row or not row.get("reconciled_at"):
+        row = await reconcile_user_counters(user_id)
+    chat_unread = {cid: n for cid, n in (row.get("chat_unread") or {}).items() if n > 0}
+    return {
+        "notifications_unread": max(0, int(row.get("notifications_unread") or 0)),
+        "chat_unread": chat_unread,
+        "chat_unread_total": sum(chat_unread.values()),
+    }
+
+@periodic_job("reconcile_unread_counters", UNREAD_COUNTER_RECONCILE_SECONDS)
+async def reconcile_all_user_counters():
+    notification_rows = await db.notifications.aggregate([
+        {"$match": {"is_read": False}},
+        {"$group": {"_id": "$user_id", "count": {"$sum": 1}}},
+    ]).to_list(None)
+    notifications_map = {r["_id"]: r["count"] for r in notification_rows if r.get("_id")}
+
+    unread_conversation_ids = await db.chat_messages.distinct("conversation_id", {"is_read": False})
+    chat_map = await count_unread_chat_by_conversation(unread_conversation_ids)
+
+    now = datetime.utcnow()
+    ops = []
+    seen: Set[str] = set()
+    async for row in db.user_counters.find({}, {"_id": 0, "user_id": 1, "notifications_unread": 1, "chat_unread": 1}):
+        uid = row.get("user_id")
+        seen.add(uid)
+        expected_notifications = notifications_map.get(uid, 0)
+        expected_chat = chat_map.get(uid, {})
+        if row.get("notifications_unread") != expected_notifications or (row.get("chat_unread") or {}) != expected_chat:
+            ops.append(UpdateOne(
+                {"user_id": uid},
+                {"$set": {"notifications_unread": expected_notifications, "chat_unread": expected_chat, "reconciled_at": now, "updated_at": now}},
+            ))
+    for uid in (set(notifications_map) | set(chat_map)) - seen:
+        ops.append(UpdateOne(
+            {"user_id": uid},
+            {"$set": {"notifications_unread": notifications_map.get(uid, 0), "chat_unread": chat_map.get(uid, {}), "reconciled_at": now, "updated_at": now}},
+            upsert=True,
+        ))
+    if ops:
+        await db.user_counters.bulk_write(ops, ordered=False)
+        logger.info(f"Unread counters reconciled: {len(ops)} user(s) corrected")
+
 async def create_notification(user_id: str, title: str, body: str, notif_type: str = "system", data: Optional[dict] = None):
     if not user_id:
         return
@@ -118,6 +717,7 @@ async def create_notification(user_id: str, title: str, body: str, notif_type: s
         "created_at": datetime.utcnow(),
         "updated_at": datetime.utcnow(),
     })
+    await bump_notifications_unread(user_id, 1)
 
 async def create_notifications_for_admins(title: str, body: str, notif_type: str = "admin", data: Optional[dict] = None):
     admins = await db.users.find({"$or": [{"is_admin": True}, {"role": "admin"}]}).to_list(500)
@@ -367,6 +967,8 @@ class LostFoundPost(BaseModel):
     last_seen_date: str
     contact_phone: str
     image: Optional[str] = None
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
     status: str = "active"  # active, resolved
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
@@ -380,6 +982,8 @@ class LostFoundCreate(BaseModel):
     last_seen_date: str
     contact_phone: str
     image: Optional[str] = None
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
 
 # Community Post
 class CommunityPost(BaseModel):
@@ -457,6 +1061,9 @@ class Order(BaseModel):
     shipping_phone: str
     payment_method: str = "cash_on_delivery"
     notes: Optional[str] = None
+    subtotal: Optional[float] = None
+    shipping_cost: Optional[float] = None
+    points_used: int = 0
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
 class OrderCreate(BaseModel):
@@ -502,6 +1109,7 @@ class PaymentRequest(BaseModel):
     appointment_id: Optional[str] = None
     sponsorship_id: Optional[str] = None
     points_to_use: int = 0
+    idempotency_key: Optional[str] = None  # Or send the Idempotency-Key header
 
 # Loyalty Points Models
 class LoyaltyPoints(BaseModel):
@@ -514,7 +1122,7 @@ class PointsTransaction(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     user_id: str
     points: int  # positive for earned, negative for redeemed
-    transaction_type: str  # earned, redeemed, bonus, expired
+    transaction_type: str  # earned, redeemed, refunded, bonus, expired, opening_balance
     description: str
     reference_id: Optional[str] = None  # order_id, appointment_id, etc.
     created_at: datetime = Field(default_factory=datetime.utcnow)
@@ -571,6 +1179,18 @@ def error_detail(code: str, message: str) -> dict:
     """
     return {"code": code, "message": message}
 
+async def run_in_transaction(callback):
+    """Run `callback(session)` inside a multi-document transaction.
+
+    Motor's `with_transaction` retries the callback on transient transaction
+    errors. Without MONGO_TRANSACTIONS the callback runs directly with
+    `session=None`, so callbacks must stay correct (if not atomic) on their own.
+    """
+    if not MONGO_TRANSACTIONS:
+        return await callback(None)
+    async with await client.start_session() as session:
+        return await session.with_transaction(callback)
+
 def hash_password(password: str) -> str:
     return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
 
@@ -594,6 +1214,108 @@ def generate_user_code(user_id: str) -> str:
     suffix = (user_id or '').replace('-', '')[-6:].upper()
     return f"PET-{suffix}"
 
+USERNAME_ALLOCATION_ATTEMPTS = 5
+
+def username_base(name: Optional[str]) -> str:
+    return normalize_username(name or "user") or f"user{random.randint(1000, 9999)}"
+
+async def next_username(base: str) -> str:
+    """Hand out base, base2, base3... from a per-base sequence in `username_counters`.
+
+    The unique index on users.username stays the arbiter: names taken before the
+    counter existed just cost the caller a retry.
+    """
+    counter = await db.username_counters.find_one_and_update(
+        {"base": base},
+        {"$inc": {"seq": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    seq = counter.get("seq", 1)
+    return base if seq == 1 else f"{base}{seq}"
+
+def is_username_conflict(error: DuplicateKeyError) -> bool:
+    return "username" in ((error.details or {}).get("keyPattern") or {})
+
+async def ensure_username_indexes():
+    await db.username_counters.create_index("base", unique=True)
+    await db.users.create_index(
+        "username", unique=True, name="username_unique",
+        partialFilterExpression={"username": {"$type": "string"}},
+    )
+
+async def allocate_username(base: str, claim) -> tuple:
+    """Find a free username for `claim(candidate)`, which raises DuplicateKeyError when it is taken.
+
+    Tries the per-base sequence first, then random suffixes, so a base whose
+    counter lags behind existing names still allocates. Returns (username, claim result).
+    """
+    for attempt in range(2 * USERNAME_ALLOCATION_ATTEMPTS):
+        if attempt < USERNAME_ALLOCATION_ATTEMPTS:
+            candidate = await next_username(base)
+        else:
+            candidate = f"{base}{random.randint(10000, 99999999)}"
+        try:
+            return candidate, await claim(candidate)
+        except DuplicateKeyError as e:
+            if not is_username_conflict(e):
+                raise
+    raise HTTPException(status_code=503, detail=error_detail("AUTH_USERNAME_UNAVAILABLE", "Could not allocate a username, please retry"))
+
+async def assign_username(user_id: str, name: Optional[str]) -> Optional[str]:
+    """Give an existing user without a username one. Used by the backfill migration."""
+    async def claim(candidate):
+        return await db.users.update_one(
+            {"id": user_id, "username": {"$in": [None, ""]}},
+            {"$set": {"username": candidate}},
+        )
+
+    candidate, result = await allocate_username(username_base(name), claim)
+    return candidate if result.modified_count else None
+
+async def seed_username_counters(batch_size: int = 500) -> int:
+    """One-off migration: start each base's sequence at its highest existing numeric suffix.
+
+    Without this, signups for a common base walk the counter through names that
+    were taken before it existed.
+    """
+    highest: Dict[str, int] = {}
+    async for user in db.users.find({"username": {"$type": "string"}}, {"_id": 0, "username": 1}):
+        match = re.fullmatch(r"(.*?)(\d*)", user["username"])
+        base, suffix = match.group(1) or user["username"], match.group(2)
+        # Random fallback suffixes (5+ digits) are not part of the sequence.
+        seq = int(suffix) if suffix and match.group(1) and len(suffix) < 5 else 1
+        highest[base] = max(highest.get(base, 0), seq)
+    ops = [UpdateOne({"base": base}, {"$max": {"seq": seq}}, upsert=True) for base, seq in highest.items()]
+    for start in range(0, len(ops), batch_size):
+        await db.username_counters.bulk_write(ops[start:start + batch_size], ordered=False)
+    return len(ops)
+
+async def backfill_usernames(batch_size: int = 500) -> dict:
+    """One-off migration: fill in missing usernames and user codes.
+
+    Run it with scripts/backfill_usernames.py; request paths no longer do this.
+    """
+    stats = {"usernames": 0, "user_codes": 0}
+    code_ops = []
+    cursor = db.users.find(
+        {"$or": [{"username": {"$in": [None, ""]}}, {"user_code": {"$in": [None, ""]}}]},
+        {"_id": 0, "id": 1, "name": 1, "username": 1, "user_code": 1},
+    )
+    async for user in cursor:
+        if not user.get("username") and await assign_username(user["id"], user.get("name")):
+            stats["usernames"] += 1
+        if not user.get("user_code"):
+            code_ops.append(UpdateOne({"id": user["id"]}, {"$set": {"user_code": generate_user_code(user["id"])}}))
+        if len(code_ops) >= batch_size:
+            await db.users.bulk_write(code_ops, ordered=False)
+            stats["user_codes"] += len(code_ops)
+            code_ops = []
+    if code_ops:
+        await db.users.bulk_write(code_ops, ordered=False)
+        stats["user_codes"] += len(code_ops)
+    return stats
+
 def smtp_is_configured() -> bool:
     return bool(
         os.environ.get("SMTP_HOST")
@@ -632,7 +1354,7 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         if not user_id:
             raise HTTPException(status_code=401, detail="Invalid token")
         user = await db.users.find_one({"id": user_id})
-        if not user:
+        if not user or user.get("deleted_at"):
             raise HTTPException(status_code=401, detail="User not found")
         return user
     except jwt.ExpiredSignatureError:
@@ -649,7 +1371,8 @@ async def get_current_user_optional(credentials: Optional[HTTPAuthorizationCrede
         user_id = payload.get("sub")
         if not user_id:
             return None
-        return await db.users.find_one({"id": user_id})
+        user = await db.users.find_one({"id": user_id})
+        return None if not user or user.get("deleted_at") else user
     except Exception:
         return None
 
@@ -677,7 +1400,8 @@ async def get_user_from_token(token: str) -> Optional[dict]:
         user_id = payload.get("sub")
         if not user_id:
             return None
-        return await db.users.find_one({"id": user_id})
+        user = await db.users.find_one({"id": user_id})
+        return None if not user or user.get("deleted_at") else user
     except Exception:
         return None
 
@@ -736,6 +1460,7 @@ async def chat_websocket(websocket: WebSocket):
                     {"conversation_id": conversation_id, "sender_id": {"$ne": user_id}, "is_read": False},
                     {"$set": {"is_read": True}},
                 )
+                await clear_chat_unread(user_id, conversation_id)
                 await notify_conversation_participants(
                     conversation_id,
                     "messages_read",
@@ -765,8 +1490,173 @@ DEFAULT_USER_SETTINGS = {
     "allow_friend_requests": "everyone",  # everyone | nobody
     "allow_direct_messages": "everyone",  # everyone | friends_only
     "language": "en",
+    "followed_post_types": [],  # community post types merged into the home timeline
 }
 
+# ========================= ACCOUNT DELETION =========================
+#
+# Deleting an account tombstones the user document (`deleted_at`), which makes
+# every auth path treat the user as gone, and records a job in
+# `account_deletions`. The tombstone's email and phone are replaced right away,
+# so the address can sign up again while the cascade is still running. The
+# cascade then runs the per-collection deletes concurrently, marking each step
+# done so an interrupted job resumes where it stopped; steps in
+# ACCOUNT_DELETION_FIRST read rows other steps delete and run before the rest.
+# Orders are kept for the books with their shipping details blanked. The user
+# document itself is removed last.
+
+ACCOUNT_DELETION_RESUME_SECONDS = float(os.environ.get("ACCOUNT_DELETION_RESUME_SECONDS", "60"))
+ACCOUNT_DELETION_LEASE_SECONDS = 300
+
+ACCOUNT_DELETION_STEPS = {
+    "pets": lambda uid: db.pets.delete_many({"owner_id": uid}),
+    "pet_tags": lambda uid: delete_owner_tags(uid),
+    "tag_scans": lambda uid: delete_owner_tag_scans(uid),
+    "orders": lambda uid: anonymise_orders(uid),
+    "comments": lambda uid: db.comments.delete_many({"user_id": uid}),
+    "community": lambda uid: db.community.delete_many({"user_id": uid}),
+    "conversations": lambda uid: db.conversations.delete_many({"participants": uid}),
+    "chat_messages": lambda uid: db.chat_messages.delete_many({"sender_id": uid}),
+    "favorites": lambda uid: forget_reactions("favorites", uid),
+    "likes": lambda uid: forget_reactions("likes", uid),
+    "friend_requests_sent": lambda uid: db.friend_requests.delete_many({"from_user_id": uid}),
+    "friend_requests_received": lambda uid: db.friend_requests.delete_many({"to_user_id": uid}),
+    "friendships": lambda uid: db.friendships.delete_many({"users": uid}),
+    "user_settings": lambda uid: db.user_settings.delete_many({"user_id": uid}),
+    "blocks_made": lambda uid: db.blocked_users.delete_many({"user_id": uid}),
+    "blocks_received": lambda uid: db.blocked_users.delete_many({"blocked_user_id": uid}),
+    "community_post_notifications": lambda uid: db.community_post_notifications.delete_many({"user_id": uid}),
+    "community_reports": lambda uid: db.community_reports.delete_many({"reported_by": uid}),
+    "notifications": lambda uid: db.notifications.delete_many({"user_id": uid}),
+    "user_counters": lambda uid: db.user_counters.delete_many({"user_id": uid}),
+    "loyalty_snapshots": lambda uid: db.loyalty_snapshots.delete_many({"user_id": uid}),
+    "timelines": lambda uid: db.timelines.delete_many({"$or": [{"user_id": uid}, {"author_id": uid}]}),
+    "lost_found_matches": lambda uid: db.lost_found_matches.delete_many({"user_ids": uid}),
+}
+ACCOUNT_DELETION_FIRST = {"tag_scans"}  # finds the scans through the user's pets
+
+async def delete_owner_tags(user_id: str) -> int:
+    tags = await db.pet_tags.find({"owner_id": user_id}, {"_id": 0, "tag_code": 1}).to_list(None)
+    result = await db.pet_tags.delete_many({"owner_id": user_id})
+    await tag_cards.invalidate(*[t["tag_code"] for t in tags if t.get("tag_code")])
+    return result.deleted_count
+
+async def delete_owner_tag_scans(user_id: str) -> int:
+    pets = await db.pets.find({"owner_id": user_id}, {"_id": 0, "id": 1}).to_list(None)
+    if not pets:
+        return 0
+    query = {"pet_id": {"$in": [p["id"] for p in pets]}}
+    live = await db.tag_scans.delete_many(query)
+    archived = await db.tag_scans_archive.delete_many(query)
+    return live.deleted_count + archived.deleted_count
+
+async def anonymise_orders(user_id: str) -> int:
+    result = await db.orders.update_many(
+        {"user_id": user_id, "anonymised_at": None},
+        {"$set": {"shipping_address": "", "shipping_city": "", "shipping_phone": "", "notes": None,
+                  "anonymised_at": datetime.utcnow()}},
+    )
+    return result.modified_count
+
+async def ensure_account_deletion_indexes():
+    await db.account_deletions.create_index("id", unique=True)
+    await db.account_deletions.create_index([("status", 1), ("lease_until", 1)])
+    await db.chat_messages.create_index("sender_id")
+    await db.friend_requests.create_index("from_user_id")
+    await db.friend_requests.create_index("to_user_id")
+    await db.friendships.create_index("users")
+    await db.blocked_users.create_index("user_id")
+    await db.blocked_users.create_index("blocked_user_id")
+    await db.conversations.create_index("participants")
+    await db.pets.create_index("owner_id")
+
+async def schedule_account_deletion(user_id: str, requested_by: str) -> str:
+    now = datetime.utcnow()
+    await db.users.update_one(
+        {"id": user_id}, {"$set": {"deleted_at": now, "email": f"deleted-{user_id}@deleted.invalid", "phone": None}},
+    )
+    await tag_cards.invalidate_where({"owner_id": user_id})  # cards show the owner's name and phone
+    existing = await db.account_deletions.find_one({"user_id": user_id, "status": {"$ne": "completed"}})
+    if existing:
+        return existing["id"]
+    job = {
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "requested_by": requested_by,
+        "status": "pending",
+        "steps": {name: "pending" for name in ACCOUNT_DELETION_STEPS},
+        "lease_until": None,
+        "created_at": now,
+        "updated_at": now,
+    }
+    await db.account_deletions.insert_one(job)
+    return job["id"]
+
+async def run_account_deletion(job_id: str):
+    now = datetime.utcnow()
+    claimed = await db.account_deletions.update_one(
+        {"id": job_id, "status": {"$ne": "completed"}, "$or": [{"lease_until": None}, {"lease_until": {"$lt": now}}]},
+        {"$set": {"status": "running", "lease_until": now + timedelta(seconds=ACCOUNT_DELETION_LEASE_SECONDS), "updated_at": now}},
+    )
+    if not claimed.modified_count:
+        return  # completed, or another worker holds the lease
+    job = await db.account_deletions.find_one({"id": job_id})
+    uid = job["user_id"]
+
+    async def run_step(name: str):
+        result = await ACCOUNT_DELETION_STEPS[name](uid)
+        count = result if isinstance(result, int) else result.deleted_count
+        await db.account_deletions.update_one(
+            {"id": job_id},
+            {"$set": {f"steps.{name}": "done", f"deleted_counts.{name}": count, "updated_at": datetime.utcnow()}},
+        )
+
+    steps = job.get("steps") or {}
+    # Jobs recorded before a step was added pick it up on resume.
+    pending = [name for name in ACCOUNT_DELETION_STEPS if steps.get(name) != "done"]
+    failures = []
+    for phase in ([n for n in pending if n in ACCOUNT_DELETION_FIRST], [n for n in pending if n not in ACCOUNT_DELETION_FIRST]):
+        results = await asyncio.gather(*(run_step(name) for name in phase), return_exceptions=True)
+        failures = [f"{name}: {r}" for name, r in zip(phase, results) if isinstance(r, Exception)]
+        if failures:
+            break
+    if failures:
+        logger.warning(f"Account deletion {job_id} incomplete, will resume: {failures}")
+        await db.account_deletions.update_one(
+            {"id": job_id},
+            {"$set": {"status": "pending", "lease_until": None, "last_error": "; ".join(failures), "updated_at": datetime.utcnow()}},
+        )
+        return
+
+    await db.users.delete_one({"id": uid})
+    await tag_cards.invalidate_where({"owner_id": uid})
+    await db.account_deletions.update_one(
+        {"id": job_id},
+        {"$set": {"status": "completed", "lease_until": None, "completed_at": datetime.utcnow(), "updated_at": datetime.utcnow()}},
+    )
+
+@periodic_job("resume_account_deletions", ACCOUNT_DELETION_RESUME_SECONDS)
+async def resume_account_deletions():
+    rows = await db.account_deletions.find(
+        {"status": {"$ne": "completed"}, "$or": [{"lease_until": None}, {"lease_until": {"$lt": datetime.utcnow()}}]},
+        {"_id": 0, "id": 1},
+    ).to_list(100)
+    for row in rows:
+        await run_account_deletion(row["id"])
+
+def account_deletion_progress(job: dict) -> dict:
+    steps = job.get("steps") or {}
+    return {
+        "job_id": job.get("id"),
+        "user_id": job.get("user_id"),
+        "status": job.get("status"),
+        "steps_done": len([v for v in steps.values() if v == "done"]),
+        "steps_total": len(steps),
+        "deleted_counts": job.get("deleted_counts", {}),
+        "created_at": job.get("created_at"),
+        "completed_at": job.get("completed_at"),
+    }
+
 # ========================= AUTH ROUTES =========================
 
 @api_router.post("/auth/signup", response_model=dict)
@@ -777,25 +1667,21 @@ async def signup(user_data: UserCreate):
     
     verification_code = generate_verification_code()
 
-    base_username = normalize_username(user_data.name) or f"user{random.randint(1000, 9999)}"
-    username = base_username
-    i = 1
-    while await db.users.find_one({"username": username}):
-        i += 1
-        username = f"{base_username}{i}"
-
     user = User(
         email=user_data.email,
         name=user_data.name,
-        username=username,
         phone=user_data.phone,
         verification_code=verification_code
     )
     user.user_code = generate_user_code(user.id)
     user_dict = user.dict()
     user_dict["password_hash"] = hash_password(user_data.password)
-    
-    await db.users.insert_one(user_dict)
+
+    # The unique username index settles races between concurrent signups; retry with the next name.
+    async def claim(candidate):
+        return await db.users.insert_one({**user_dict, "username": candidate})
+
+    user.username, _ = await allocate_username(username_base(user_data.name), claim)
     logger.info(f"User registered: {user.email}, verification code: {verification_code}")
 
     if smtp_is_configured():
@@ -948,7 +1834,7 @@ async def reset_password(req: ResetPasswordRequest):
 @api_router.post("/auth/login", response_model=TokenResponse)
 async def login(credentials: UserLogin):
     user = await db.users.find_one({"email": credentials.email})
-    if not user:
+    if not user or user.get("deleted_at"):
         raise HTTPException(status_code=401, detail=error_detail("AUTH_INVALID_CREDENTIALS", "Invalid credentials"))
 
     if not verify_password(credentials.password, user.get("password_hash", "")):
@@ -957,21 +1843,6 @@ async def login(credentials: UserLogin):
     if not user.get("is_verified", False):
         raise HTTPException(status_code=403, detail=error_detail("AUTH_NOT_VERIFIED", "Please verify your account before login"))
 
-    patch = {}
-    if not user.get("username"):
-        base = normalize_username(user.get("name") or "user") or f"user{random.randint(1000,9999)}"
-        candidate = base
-        i = 1
-        while await db.users.find_one({"username": candidate, "id": {"$ne": user["id"]}}):
-            i += 1
-            candidate = f"{base}{i}"
-        patch["username"] = candidate
-    if not user.get("user_code"):
-        patch["user_code"] = generate_user_code(user["id"])
-    if patch:
-        await db.users.update_one({"id": user["id"]}, {"$set": patch})
-        user.update(patch)
-
     token = create_access_token({"sub": user["id"]})
     return TokenResponse(
         access_token=token,
@@ -980,20 +1851,6 @@ async def login(credentials: UserLogin):
 
 @api_router.get("/auth/me", response_model=UserResponse)
 async def get_me(current_user: dict = Depends(get_current_user)):
-    patch = {}
-    if not current_user.get("username"):
-        base = normalize_username(current_user.get("name") or "user") or f"user{random.randint(1000,9999)}"
-        candidate = base
-        i = 1
-        while await db.users.find_one({"username": candidate, "id": {"$ne": current_user["id"]}}):
-            i += 1
-            candidate = f"{base}{i}"
-        patch["username"] = candidate
-    if not current_user.get("user_code"):
-        patch["user_code"] = generate_user_code(current_user["id"])
-    if patch:
-        await db.users.update_one({"id": current_user["id"]}, {"$set": patch})
-        current_user.update(patch)
     return UserResponse(**current_user)
 
 @api_router.put("/auth/update", response_model=UserResponse)
@@ -1001,6 +1858,8 @@ async def update_profile(update_data: UserUpdate, current_user: dict = Depends(g
     update_dict = {k: v for k, v in update_data.dict().items() if v is not None}
     if update_dict:
         await db.users.update_one({"id": current_user["id"]}, {"$set": update_dict})
+        if update_dict.keys() & {"name", "phone", "city"}:
+            await tag_cards.invalidate_where({"owner_id": current_user["id"]})
     updated = await db.users.find_one({"id": current_user["id"]})
     return UserResponse(**updated)
 
@@ -1014,27 +1873,14 @@ async def change_password(payload: ChangePasswordRequest, current_user: dict = D
     return {"message": "Password changed successfully"}
 
 @api_router.post('/auth/delete-account')
-async def delete_account(payload: DeleteAccountRequest, current_user: dict = Depends(get_current_user)):
+async def delete_account(payload: DeleteAccountRequest, background_tasks: BackgroundTasks, current_user: dict = Depends(get_current_user)):
     if current_user.get('password_hash'):
         if not payload.password or not verify_password(payload.password, current_user.get('password_hash', '')):
             raise HTTPException(status_code=400, detail='Password is required to delete account')
 
-    uid = current_user['id']
-    await db.users.delete_one({"id": uid})
-    await db.pets.delete_many({"owner_id": uid})
-    await db.comments.delete_many({"user_id": uid})
-    await db.community.delete_many({"user_id": uid})
-    await db.conversations.delete_many({"participants": uid})
-    await db.chat_messages.delete_many({"sender_id": uid})
-    await db.favorites.delete_many({"user_id": uid})
-    await db.friend_requests.delete_many({"$or": [{"from_user_id": uid}, {"to_user_id": uid}]})
-    await db.friendships.delete_many({"users": uid})
-    await db.user_settings.delete_many({"user_id": uid})
-    await db.blocked_users.delete_many({"$or": [{"user_id": uid}, {"blocked_user_id": uid}]})
-    await db.community_post_notifications.delete_many({"user_id": uid})
-    await db.community_reports.delete_many({"reported_by": uid})
-    await db.notifications.delete_many({"user_id": uid})
-    return {"message": "Account deleted"}
+    job_id = await schedule_account_deletion(current_user['id'], current_user['id'])
+    background_tasks.add_task(run_account_deletion, job_id)
+    return {"message": "Account deleted", "job_id": job_id}
 
 @api_router.get('/user-settings')
 async def get_user_settings(current_user: dict = Depends(get_current_user)):
@@ -1059,12 +1905,31 @@ async def update_user_settings(data: dict, current_user: dict = Depends(get_curr
     row = await db.user_settings.find_one({"user_id": current_user["id"]})
     return {k: row.get(k, DEFAULT_USER_SETTINGS.get(k)) for k in DEFAULT_USER_SETTINGS.keys()}
 
+def encode_created_at_cursor(row: dict) -> Optional[str]:
+    created_at = row.get("created_at")
+    if not isinstance(created_at, datetime) or not row.get("id"):
+        return None
+    return f"{created_at.isoformat()}|{row['id']}"
+
+def created_at_cursor_query(cursor: Optional[str]) -> dict:
+    """Keyset filter for rows sorted by (created_at desc, id desc) strictly after `cursor`."""
+    if not cursor:
+        return {}
+    try:
+        ts_raw, last_id = cursor.rsplit("|", 1)
+        ts = datetime.fromisoformat(ts_raw)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return {"$or": [{"created_at": {"$lt": ts}}, {"created_at": ts, "id": {"$lt": last_id}}]}
+
 @api_router.get('/notifications')
 async def get_my_notifications(
     unread_only: bool = False,
     notif_type: Optional[str] = None,
     limit: int = 20,
     offset: int = 0,
+    cursor: Optional[str] = None,
+    include_total: bool = True,
     current_user: dict = Depends(get_current_user)
 ):
     query: dict = {"user_id": current_user["id"]}
@@ -1074,28 +1939,41 @@ async def get_my_notifications(
         query["type"] = notif_type
 
     safe_limit = max(1, min(limit, 100))
-    safe_offset = max(0, offset)
-    rows = await db.notifications.find(query).sort("created_at", -1).skip(safe_offset).limit(safe_limit).to_list(safe_limit)
-    total = await db.notifications.count_documents(query)
+    safe_offset = 0 if cursor else max(0, offset)
+    page_query = {**query, **created_at_cursor_query(cursor)}
+    # Fetch one extra row to learn whether another page exists without counting the whole set.
+    rows = await db.notifications.find(page_query).sort([("created_at", -1), ("id", -1)]).skip(safe_offset).limit(safe_limit + 1).to_list(safe_limit + 1)
+    has_more = len(rows) > safe_limit
+    rows = rows[:safe_limit]
+
+    total = None
+    if include_total:
+        if unread_only and "type" not in query:
+            total = (await get_user_counters(current_user["id"]))["notifications_unread"]
+        else:
+            total = await db.notifications.count_documents(query)
     return {
         "items": [{k: v for k, v in row.items() if k != "_id"} for row in rows],
         "total": total,
         "limit": safe_limit,
         "offset": safe_offset,
-        "has_more": safe_offset + len(rows) < total,
+        "has_more": has_more,
+        "next_cursor": encode_created_at_cursor(rows[-1]) if has_more and rows else None,
     }
 
 @api_router.get('/notifications/unread-count')
 async def get_unread_notifications_count(current_user: dict = Depends(get_current_user)):
-    count = await db.notifications.count_documents({"user_id": current_user["id"], "is_read": False})
-    return {"count": count}
+    counters = await get_user_counters(current_user["id"])
+    return {"count": counters["notifications_unread"], "chat_count": counters["chat_unread_total"]}
 
 @api_router.put('/notifications/{notification_id}/read')
 async def mark_notification_read(notification_id: str, current_user: dict = Depends(get_current_user)):
-    await db.notifications.update_one(
-        {"id": notification_id, "user_id": current_user["id"]},
+    result = await db.notifications.update_one(
+        {"id": notification_id, "user_id": current_user["id"], "is_read": False},
         {"$set": {"is_read": True, "updated_at": datetime.utcnow()}},
     )
+    if result.modified_count:
+        await bump_notifications_unread(current_user["id"], -1)
     return {"success": True}
 
 @api_router.put('/notifications/read-all')
@@ -1104,15 +1982,519 @@ async def mark_all_notifications_read(current_user: dict = Depends(get_current_u
         {"user_id": current_user["id"], "is_read": False},
         {"$set": {"is_read": True, "updated_at": datetime.utcnow()}},
     )
+    await reset_notifications_unread(current_user["id"])
     return {"success": True}
 
 @api_router.delete('/notifications/clear-all')
 async def clear_all_notifications(current_user: dict = Depends(get_current_user)):
     await db.notifications.delete_many({"user_id": current_user["id"]})
+    await reset_notifications_unread(current_user["id"])
     return {"success": True}
 
+# ========================= WRITE-BEHIND COUNTERS =========================
+
+VIEW_COUNTER_FLUSH_SECONDS = float(os.environ.get("VIEW_COUNTER_FLUSH_SECONDS", "5"))
+VIEW_COUNTER_MAX_PENDING = int(os.environ.get("VIEW_COUNTER_MAX_PENDING", "10000"))
+VIEW_COUNTER_MAX_RETRIES = int(os.environ.get("VIEW_COUNTER_MAX_RETRIES", "5"))
+
+# Server error codes for failovers, shutdowns and timeouts; anything else fails the same way on retry.
+TRANSIENT_WRITE_ERROR_CODES = {6, 7, 50, 64, 89, 91, 189, 262, 9001, 10107, 11600, 11602, 13435, 13436}
+
+def is_transient_write_error(error) -> bool:
+    """Whether a failed write (an exception or a bulk `writeErrors` entry) may succeed if retried."""
+    if isinstance(error, dict):
+        return error.get("code") in TRANSIENT_WRITE_ERROR_CODES
+    if isinstance(error, (ConnectionFailure, ExecutionTimeout, WTimeoutError)):
+        return True
+    if isinstance(error, PyMongoError) and error.has_error_label("RetryableWriteError"):
+        return True
+    return getattr(error, "code", None) in TRANSIENT_WRITE_ERROR_CODES
+
+class WriteBehindCounters:
+    """Aggregates hot counter updates in memory and writes them with one bulk_write per collection.
+
+    Increments for the same document are summed, `$max` fields keep the
+    largest value and `$set` fields the last one, so N reads of a document cost
+    one write per flush. Append-only rows (`append`) are batched into one
+    insert_many per collection. Pending writes are flushed periodically, when
+    the buffer grows past `max_pending` and on shutdown; a crash loses at most
+    one flush interval.
+
+    Writes that fail transiently are requeued for at most `max_retries`
+    flushes; writes the server rejects outright are logged and dropped.
+    """
+
+    def __init__(self, max_pending: int, max_retries: int = VIEW_COUNTER_MAX_RETRIES):
+        self.pending: Dict[tuple, Dict[str, Dict[str, Any]]] = {}
+        self.inserts: Dict[str, List[dict]] = {}
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.failures: Dict[tuple, int] = {}  # consecutive failed flushes per pending key
+        self.insert_failures: Dict[str, int] = {}  # ... and per insert collection
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flushing: Optional[asyncio.Task] = None
+
+    def add(self, collection: str, match_field: str, match_value: str, inc: Dict[str, int], max_fields: Optional[Dict[str, Any]] = None, set_fields: Optional[Dict[str, Any]] = None):
+        entry = self.pending.setdefault((collection, match_field, match_value), {"$inc": {}, "$max": {}, "$set": {}})
+        self._merge(entry, {"$inc": inc, "$max": max_fields or {}, "$set": set_fields or {}})
+        self._maybe_flush()
+
+    def append(self, collection: str, doc: dict):
+        self.inserts.setdefault(collection, []).append(doc)
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        size = len(self.pending) + sum(len(rows) for rows in self.inserts.values())
+        if size >= self.max_pending and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self.flush())
+
+    @staticmethod
+    def _merge(entry: Dict[str, Dict[str, Any]], update: Dict[str, Dict[str, Any]]):
+        for field, delta in update.get("$inc", {}).items():
+            entry["$inc"][field] = entry["$inc"].get(field, 0) + delta
+        for field, value in update.get("$max", {}).items():
+            current = entry["$max"].get(field)
+            if current is None or value > current:
+                entry["$max"][field] = value
+        entry["$set"].update(update.get("$set", {}))
+
+    async def flush(self) -> int:
+        """Write everything buffered so far and return the number of writes applied.
+
+        The write runs in its own task: cancelling a caller (the periodic job on
+        shutdown) leaves it to finish, and a later flush waits for it first.
+        """
+        if self._flushing is not None and not self._flushing.done():
+            try:
+                await asyncio.shield(self._flushing)
+            except Exception:
+                pass
+        self._flushing = asyncio.create_task(self._write_pending())
+        return await asyncio.shield(self._flushing)
+
+    async def _write_pending(self) -> int:
+        written = await self._flush_inserts()
+        if not self.pending:
+            return written
+        batch, self.pending = self.pending, {}
+        grouped: Dict[str, List[tuple]] = {}
+        for key, update in batch.items():
+            grouped.setdefault(key[0], []).append((key, update))
+
+        collections = list(grouped.items())
+        for position, (collection, entries) in enumerate(collections):
+            ops = [UpdateOne({key[1]: key[2]}, {op: vals for op, vals in update.items() if vals}) for key, update in entries]
+            try:
+                await db[collection].bulk_write(ops, ordered=False)
+            except asyncio.CancelledError:
+                # Torn down mid-flush: hand this collection and the unwritten rest back to the buffer.
+                for _, rest in collections[position:]:
+                    self._requeue(rest, failed=False)
+                raise
+            except BulkWriteError as e:
+                errors = {err["index"]: err for err in e.details.get("writeErrors", [])}
+                retry = [entries[i] for i, err in errors.items() if is_transient_write_error(err)]
+                rejected = [(entries[i], err.get("errmsg")) for i, err in errors.items() if not is_transient_write_error(err)]
+                for (key, update), reason in rejected:
+                    logger.error(f"Counter write to {collection} {key[1]}={key[2]} rejected, dropped {update}: {reason}")
+                self._forget([entry for i, entry in enumerate(entries) if i not in errors] + [entry for entry, _ in rejected])
+                self._requeue(retry)
+                written += len(ops) - len(errors)
+            except Exception as e:
+                if is_transient_write_error(e):
+                    logger.warning(f"Counter flush for {collection} failed, requeued: {e}")
+                    self._requeue(entries)
+                else:
+                    logger.error(f"Counter flush for {collection} failed, dropped {len(entries)} writes: {e}")
+                    self._forget(entries)
+            else:
+                written += len(ops)
+                self._forget(entries)
+        return written
+
+    async def _flush_inserts(self) -> int:
+        batch, self.inserts = self.inserts, {}
+        written = 0
+        collections = list(batch.items())
+        for position, (collection, rows) in enumerate(collections):
+            try:
+                await db[collection].insert_many(rows, ordered=False)
+            except asyncio.CancelledError:
+                for name, rest in collections[position:]:
+                    self._requeue_inserts(name, rest, failed=False)
+                raise
+            except BulkWriteError as e:
+                # Duplicate keys were written by an earlier, partly failed flush.
+                errors = [err for err in e.details.get("writeErrors", []) if err.get("code") != 11000]
+                retry = [rows[err["index"]] for err in errors if is_transient_write_error(err)]
+                if len(retry) < len(errors):
+                    reason = next(err.get("errmsg") for err in errors if not is_transient_write_error(err))
+                    logger.error(f"Insert flush for {collection} rejected, dropped {len(errors) - len(retry)} rows: {reason}")
+                self._requeue_inserts(collection, retry)
+                written += len(rows) - len(errors)
+            except Exception as e:
+                if is_transient_write_error(e):
+                    logger.warning(f"Insert flush for {collection} failed, requeued: {e}")
+                    self._requeue_inserts(collection, rows)
+                else:
+                    logger.error(f"Insert flush for {collection} failed, dropped {len(rows)} rows: {e}")
+                    self.insert_failures.pop(collection, None)
+            else:
+                written += len(rows)
+                self.insert_failures.pop(collection, None)
+        return written
+
+    def _requeue(self, entries: List[tuple], failed: bool = True):
+        for key, update in entries:
+            if failed:
+                attempts = self.failures.get(key, 0) + 1
+                if attempts > self.max_retries:
+                    logger.error(f"Counter write to {key[0]} {key[1]}={key[2]} dropped after {self.max_retries} retries: {update}")
+                    self.failures.pop(key, None)
+                    continue
+                self.failures[key] = attempts
+            self._merge(self.pending.setdefault(key, {"$inc": {}, "$max": {}, "$set": {}}), update)
+
+    def _requeue_inserts(self, collection: str, rows: List[dict], failed: bool = True):
+        if not rows:
+            self.insert_failures.pop(collection, None)
+            return
+        if failed:
+            attempts = self.insert_failures.get(collection, 0) + 1
+            if attempts > self.max_retries:
+                logger.error(f"Insert flush for {collection} dropped {len(rows)} rows after {self.max_retries} retries")
+                self.insert_failures.pop(collection, None)
+                return
+            self.insert_failures[collection] = attempts
+        self.inserts.setdefault(collection, []).extend(rows)
+
+    def _forget(self, entries: List[tuple]):
+        for key, _ in entries:
+            self.failures.pop(key, None)
+
+view_counters = WriteBehindCounters(VIEW_COUNTER_MAX_PENDING)
+
+@periodic_job("flush_view_counters", VIEW_COUNTER_FLUSH_SECONDS)
+async def flush_view_counters():
+    await view_counters.flush()
+
+# ========================= LIKES (TOGGLE PRIMITIVE) =========================
+#
+# A like is a row keyed by (user_id, item_type, item_id) under a unique index;
+# the item's counter moves only when that row is actually inserted or deleted,
+# so concurrent taps cannot drift the count. Pets keep using `favorites` (a
+# liked pet is a favorite pet); posts and comments use `likes`.
+#
+# Every counter move stamps the item's `reacted_at`; `reconcile_like_counters`
+# recounts only items stamped since its last run (its watermark in `job_state`),
+# and every item on its first run.
+
+LIKE_COUNTER_RECONCILE_SECONDS = float(os.environ.get("LIKE_COUNTER_RECONCILE_SECONDS", "3600"))
+LIKE_COUNTER_RECONCILE_OVERLAP = timedelta(minutes=5)  # reactions stamped just before a run but written during it
+
+LIKE_TARGETS = {
+    # keep_legacy: counts from before likes were recorded per user have no rows;
+    # they are preserved in `legacy_<field>` instead of being reconciled away.
+    # legacy_key: rows from before keyed likes carry only this field (no item_type)
+    # until `migrate_legacy_favorites` has run; they are counted until then.
+    "pet": {"rows": "favorites", "items": "pets", "field": "likes", "keep_legacy": False, "legacy_key": "pet_id"},
+    "community_post": {"rows": "likes", "items": "community", "field": "likes", "keep_legacy": True, "legacy_key": None},
+    "comment": {"rows": "likes", "items": "comments", "field": "likes", "keep_legacy": True, "legacy_key": None},
+}
+
+async def ensure_like_indexes():
+    await db.favorites.create_index(
+        [("user_id", 1), ("item_type", 1), ("item_id", 1)],
+        unique=True, partialFilterExpression={"item_type": {"$exists": True}},
+    )
+    await db.likes.create_index([("user_id", 1), ("item_type", 1), ("item_id", 1)], unique=True)
+    await db.likes.create_index([("item_type", 1), ("item_id", 1)])
+
+async def migrate_legacy_favorites() -> int:
+    """One-off: give legacy {user_id, pet_id} favorites the keyed shape (scripts/migrate_legacy_favorites.py)."""
+    migrated = 0
+    async for row in db.favorites.find({"pet_id": {"$exists": True}, "item_type": {"$exists": False}}, {"_id": 1, "pet_id": 1}):
+        try:
+            await db.favorites.update_one({"_id": row["_id"]}, {"$set": {"item_type": "pet", "item_id": row["pet_id"]}})
+            migrated += 1
+        except DuplicateKeyError:
+            await db.favorites.delete_one({"_id": row["_id"]})
+    await db.job_state.update_one(
+        {"id": "migrate_legacy_favorites"}, {"$set": {"completed_at": datetime.utcnow(), "migrated": migrated}}, upsert=True,
+    )
+    return migrated
+
+async def legacy_favorites_migrated() -> bool:
+    return await db.job_state.find_one({"id": "migrate_legacy_favorites", "completed_at": {"$ne": None}}) is not None
+
+async def forget_reactions(rows_name: str, user_id: str):
+    """Delete a user's like rows, stamping the liked items so the next reconcile recounts them."""
+    rows = await db[rows_name].find({"user_id": user_id}, {"_id": 0, "item_type": 1, "item_id": 1, "pet_id": 1}).to_list(None)
+    for item_type, target in LIKE_TARGETS.items():
+        if target["rows"] != rows_name:
+            continue
+        legacy_key = target["legacy_key"]
+        item_ids = sorted({
+            r.get("item_id") or r.get(legacy_key) for r in rows
+            if r.get("item_type") == item_type or (legacy_key and "item_type" not in r and r.get(legacy_key))
+        })
+        if item_ids:
+            await db[target["items"]].update_many({"id": {"$in": item_ids}}, {"$set": {"reacted_at": datetime.utcnow()}})
+    return await db[rows_name].delete_many({"user_id": user_id})
+
+async def set_reaction(item_type: str, item_id: str, user_id: str, liked: Optional[bool] = None, extra: Optional[dict] = None) -> Optional[bool]:
+    """Set the user's like on an item, or flip it when `liked` is None.
+
+    Returns the new state, or None if the item does not exist.
+    """
+    target = LIKE_TARGETS[item_type]
+    rows = db[target["rows"]]
+    items = db[target["items"]]
+    field = target["field"]
+    key = {"user_id": user_id, "item_type": item_type, "item_id": item_id}
+
+    def move(by: int) -> dict:
+        return {"$inc": {field: by}, "$set": {"reacted_at": datetime.utcnow()}}
+
+    async def _set(session):
+        if liked is not True:
+            removed = await rows.delete_one(key, session=session)
+            if removed.deleted_count:
+                await items.update_one({"id": item_id}, move(-1), session=session)
+                return False
+            if liked is False:
+                return False
+        bumped = await items.update_one({"id": item_id}, move(1), session=session)
+        if not bumped.matched_count:
+            return None
+        try:
+            await rows.insert_one({"id": str(uuid.uuid4()), **key, **(extra or {}), "created_at": datetime.utcnow()}, session=session)
+        except DuplicateKeyError:
+            if session is None:
+                await items.update_one({"id": item_id}, move(-1))
+            raise
+        return True
+
+    try:
+        return await run_in_transaction(_set)
+    except DuplicateKeyError:
+        # A concurrent request liked it first; the item is liked either way.
+        return True
+
+async def toggle_reaction(item_type: str, item_id: str, user_id: str, extra: Optional[dict] = None) -> Optional[bool]:
+    """Flip the user's like on an item. Returns the new state, or None if the item does not exist."""
+    return await set_reaction(item_type, item_id, user_id, None, extra)
+
+async def count_like_rows(item_type: str, target: dict, item_ids: Optional[List[str]], legacy_pending: bool) -> Dict[str, int]:
+    """{item_id: likers} over `item_ids` (every item when None), one per user across row shapes."""
+    in_ids = {"$in": item_ids} if item_ids is not None else {"$exists": True}
+    shapes = [{"item_type": item_type, "item_id": in_ids}]
+    item_expr = "$item_id"
+    legacy_key = target["legacy_key"]
+    if legacy_key and legacy_pending:
+        shapes.append({"item_type": {"$exists": False}, legacy_key: in_ids})
+        item_expr = {"$ifNull": ["$item_id", f"${legacy_key}"]}
+    counts = await db[target["rows"]].aggregate([
+        {"$match": shapes[0] if len(shapes) == 1 else {"$or": shapes}},
+        {"$group": {"_id": {"item": item_expr, "user": "$user_id"}}},  # a legacy row and its keyed copy are one like
+        {"$group": {"_id": "$_id.item", "count": {"$sum": 1}}},
+    ]).to_list(None)
+    return {r["_id"]: r["count"] for r in counts}
+
+@periodic_job("reconcile_like_counters", LIKE_COUNTER_RECONCILE_SECONDS)
+async def reconcile_like_counters():
+    started = datetime.utcnow()
+    state = await db.job_state.find_one({"id": "reconcile_like_counters"}, {"_id": 0, "watermark": 1})
+    watermark = (state or {}).get("watermark")
+    legacy_pending = not await legacy_favorites_migrated()
+    for item_type, target in LIKE_TARGETS.items():
+        field = target["field"]
+        legacy_field = f"legacy_{field}"
+        items = db[target["items"]]
+        projection = {"_id": 0, "id": 1, field: 1, legacy_field: 1}
+        ops = []
+
+        def reconcile(item: dict):
+            current = item.get(field) or 0
+            rows_count = count_map.get(item.get("id"), 0)
+            patch = {}
+            if target["keep_legacy"]:
+                legacy = item.get(legacy_field)
+                if legacy is None:
+                    legacy = max(0, current - rows_count)
+                    patch[legacy_field] = legacy
+                expected = legacy + rows_count
+            else:
+                expected = rows_count
+            if current != expected:
+                patch[field] = expected
+            if patch:
+                ops.append(UpdateOne({"id": item.get("id")}, {"$set": patch}))
+
+        if watermark is None:
+            count_map = await count_like_rows(item_type, target, None, legacy_pending)
+            async for item in items.find({}, projection):
+                reconcile(item)
+        else:
+            changed = await items.find({"reacted_at": {"$gte": watermark - LIKE_COUNTER_RECONCILE_OVERLAP}}, projection).to_list(None)
+            if not changed:
+                continue
+            count_map = await count_like_rows(item_type, target, [item["id"] for item in changed], legacy_pending)
+            for item in changed:
+                reconcile(item)
+        if ops:
+            await items.bulk_write(ops, ordered=False)
+            logger.info(f"Like counters reconciled for {item_type}: {len(ops)} item(s)")
+    await db.job_state.update_one({"id": "reconcile_like_counters"}, {"$set": {"watermark": started}}, upsert=True)
+
+# ========================= REQUEST COALESCING =========================
+
+COALESCE_TTL_SECONDS = float(os.environ.get("COALESCE_TTL_SECONDS", "1.0"))
+COALESCE_MAX_ENTRIES = int(os.environ.get("COALESCE_MAX_ENTRIES", "2048"))
+
+class SingleFlight:
+    """Coalesce concurrent identical reads into one load and keep its result for a micro-TTL.
+
+    Keys are tuples starting with a read name, e.g. ("pet", pet_id). Followers await
+    the leader's future, so a burst of N identical requests costs one database round
+    trip; failures (404s included) are shared with the burst but never cached.
+    Cached values are shared between requests and must be treated as read-only.
+    """
+
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.in_flight: Dict[tuple, asyncio.Future] = {}
+        self.results: Dict[tuple, tuple] = {}  # key -> (expires_at, value)
+        self.loads = 0
+        self.coalesced = 0
+        self.hits = 0
+
+    async def do(self, key: tuple, load):
+        cached = self.results.get(key)
+        if cached and cached[0] > time.monotonic():
+            self.hits += 1
+            return cached[1]
+
+        future = self.in_flight.get(key)
+        if future is not None and future.get_loop() is asyncio.get_running_loop():
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise  # this follower was cancelled
+                return await self.do(key, load)  # the leader was cancelled; take over
+
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())  # followers are optional
+        self.in_flight[key] = future
+        self.loads += 1
+        try:
+            value = await load()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(value)
+            if self.ttl_seconds > 0 and self.in_flight.get(key) is future:  # not forgotten mid-load
+                self.results.pop(key, None)
+                self.results[key] = (time.monotonic() + self.ttl_seconds, value)
+                while len(self.results) > self.max_entries:
+                    self.results.pop(next(iter(self.results)))
+            return value
+        finally:
+            if self.in_flight.get(key) is future:
+                del self.in_flight[key]
+
+    def forget(self, *prefix):
+        """Drop cached results whose key starts with `prefix` (after a write).
+
+        Loads already in flight for those keys keep serving their followers, but
+        later callers start a fresh load instead of joining them.
+        """
+        for key in [k for k in self.results if k[:len(prefix)] == prefix]:
+            del self.results[key]
+        for key in [k for k in self.in_flight if k[:len(prefix)] == prefix]:
+            del self.in_flight[key]
+
+read_coalescer = SingleFlight(COALESCE_TTL_SECONDS, COALESCE_MAX_ENTRIES)
+
+# ========================= VERSIONED CACHES =========================
+
+class VersionedCache:
+    """Process-local TTL cache shared across workers through a version in `catalog_versions`.
+
+    Writers call `bump()`; every worker checks the version at most once per
+    `version_check_seconds` and clears its entries when it moved. Entries past
+    `max_entries` are evicted oldest first. Every clear or drop starts a new
+    `generation`, and `store` ignores loads begun in an older one, so a read that
+    raced an invalidation cannot put its stale result back.
+    """
+
+    def __init__(self, version_id: str, ttl_seconds: float, version_check_seconds: float, max_entries: int):
+        self.version_id = version_id
+        self.ttl_seconds = ttl_seconds
+        self.version_check_seconds = version_check_seconds
+        self.max_entries = max_entries
+        self.entries: Dict[Any, tuple] = {}  # key -> (loaded_at, value)
+        self.version = 0
+        self.checked_at = float("-inf")
+        self.generation = 0
+
+    async def _sync_version(self):
+        now = time.monotonic()
+        if now - self.checked_at < self.version_check_seconds:
+            return
+        self.checked_at = now
+        doc = await db.catalog_versions.find_one({"id": self.version_id}, {"_id": 0, "version": 1})
+        version = (doc or {}).get("version", 0)
+        if version != self.version:
+            self.version = version
+            self.clear()
+
+    def lookup(self, key) -> Optional[tuple]:
+        """The (loaded_at, value) entry for `key` if it is still fresh."""
+        entry = self.entries.get(key)
+        if entry and time.monotonic() - entry[0] < self.ttl_seconds:
+            return entry
+        return None
+
+    def store(self, key, value, generation: int):
+        if generation != self.generation:
+            return
+        self.entries.pop(key, None)
+        self.entries[key] = (time.monotonic(), value)
+        while len(self.entries) > self.max_entries:
+            self.entries.pop(next(iter(self.entries)))
+
+    def clear(self):
+        self.entries.clear()
+        self.generation += 1
+
+    def drop(self, *keys):
+        for key in keys:
+            self.entries.pop(key, None)
+        self.generation += 1
+
+    async def bump(self):
+        """Move the shared version and adopt it. Our own entries were dropped by the caller, so the
+        rest survive unless another worker bumped in between, in which case its change is unseen here."""
+        doc = await db.catalog_versions.find_one_and_update(
+            {"id": self.version_id}, {"$inc": {"version": 1}},
+            upsert=True, return_document=ReturnDocument.AFTER, projection={"_id": 0, "version": 1},
+        )
+        if doc["version"] != self.version + 1:
+            self.clear()
+        self.version = doc["version"]
+
 # ========================= PET ROUTES =========================
 
+PET_PROJECTION = TrustedProjection(Pet)
+
 @api_router.post("/pets", response_model=Pet)
 async def create_pet(pet_data: PetCreate, current_user: dict = Depends(get_current_user)):
     species = (pet_data.species or '').strip().lower()
@@ -1131,7 +2513,8 @@ async def get_pets(
     city: Optional[str] = None,
     gender: Optional[str] = None,
     limit: int = 50,
-    skip: int = 0
+    skip: int = 0,
+    fields: Optional[str] = None,
 ):
     query = {}
     if status:
@@ -1143,21 +2526,22 @@ async def get_pets(
     if gender:
         query["gender"] = gender
     
-    pets = await db.pets.find(query).skip(skip).limit(limit).to_list(limit)
-    return [Pet(**pet) for pet in pets]
+    view = PET_PROJECTION.only(fields)
+    pets = await db.pets.find(query, view.projection).skip(skip).limit(limit).to_list(limit)
+    return view.response(pets)
 
 @api_router.get("/pets/my", response_model=List[Pet])
-async def get_my_pets(current_user: dict = Depends(get_current_user)):
-    pets = await db.pets.find({"owner_id": current_user["id"]}).to_list(100)
-    return [Pet(**pet) for pet in pets]
+async def get_my_pets(fields: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    view = PET_PROJECTION.only(fields)
+    pets = await db.pets.find({"owner_id": current_user["id"]}, view.projection).to_list(100)
+    return view.response(pets)
 
 @api_router.get("/pets/{pet_id}", response_model=Pet)
 async def get_pet(pet_id: str):
-    pet = await db.pets.find_one({"id": pet_id})
+    pet = await read_coalescer.do(("pet", pet_id), lambda: db.pets.find_one({"id": pet_id}))
     if not pet:
         raise HTTPException(status_code=404, detail="Pet not found")
-    # Increment views
-    await db.pets.update_one({"id": pet_id}, {"$inc": {"views": 1}})
+    view_counters.add("pets", "id", pet_id, {"views": 1})
     return Pet(**pet)
 
 @api_router.put("/pets/{pet_id}", response_model=Pet)
@@ -1173,6 +2557,8 @@ async def update_pet(pet_id: str, pet_data: PetUpdate, current_user: dict = Depe
         if next_species == 'dog' and next_status == 'for_sale':
             raise HTTPException(status_code=400, detail='Dogs are adoption/rehoming only and cannot be listed for sale')
         await db.pets.update_one({"id": pet_id}, {"$set": update_dict})
+        read_coalescer.forget("pet", pet_id)
+        await tag_cards.invalidate_where({"pet_id": pet_id})
     
     updated = await db.pets.find_one({"id": pet_id})
     return Pet(**updated)
@@ -1182,27 +2568,17 @@ async def delete_pet(pet_id: str, current_user: dict = Depends(get_current_user)
     result = await db.pets.delete_one({"id": pet_id, "owner_id": current_user["id"]})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Pet not found or not authorized")
+    read_coalescer.forget("pet", pet_id)
+    await tag_cards.invalidate_where({"pet_id": pet_id})
     return {"message": "Pet deleted"}
 
 @api_router.post("/pets/{pet_id}/like")
 async def like_pet(pet_id: str, current_user: dict = Depends(get_current_user)):
-    pet = await db.pets.find_one({"id": pet_id})
-    if not pet:
+    # pet_id is kept on the row for readers of the legacy favorites shape
+    liked = await toggle_reaction("pet", pet_id, current_user["id"], extra={"pet_id": pet_id})
+    if liked is None:
         raise HTTPException(status_code=404, detail="Pet not found")
-    
-    # Check if already favorited
-    existing = await db.favorites.find_one({"user_id": current_user["id"], "pet_id": pet_id})
-    if existing:
-        # Unlike
-        await db.favorites.delete_one({"id": existing["id"]})
-        await db.pets.update_one({"id": pet_id}, {"$inc": {"likes": -1}})
-        return {"liked": False}
-    else:
-        # Like
-        favorite = Favorite(user_id=current_user["id"], pet_id=pet_id)
-        await db.favorites.insert_one(favorite.dict())
-        await db.pets.update_one({"id": pet_id}, {"$inc": {"likes": 1}})
-        return {"liked": True}
+    return {"liked": liked}
 
 @api_router.get("/favorites/pets", response_model=List[Pet])
 async def get_favorite_pets_legacy(current_user: dict = Depends(get_current_user)):
@@ -1232,18 +2608,96 @@ async def get_health_records(pet_id: str, current_user: dict = Depends(get_curre
     records = await db.health_records.find({"pet_id": pet_id}).to_list(100)
     return [HealthRecord(**r) for r in records]
 
+# ========================= CATALOGUE RESPONSE CACHE =========================
+# Public catalogue lists (/products, /vets, /emergency-contacts) are rendered once
+# per query string, tagged with an ETag and compressed lazily once per encoding.
+# Admin writes bump `catalog_versions` so every worker drops stale entries.
+
+CATALOG_RESPONSE_TTL_SECONDS = float(os.environ.get("CATALOG_RESPONSE_TTL_SECONDS", "30"))
+CATALOG_RESPONSE_VERSION_CHECK_SECONDS = float(os.environ.get("CATALOG_RESPONSE_VERSION_CHECK_SECONDS", "5"))
+CATALOG_RESPONSE_MAX_ENTRIES = int(os.environ.get("CATALOG_RESPONSE_MAX_ENTRIES", "256"))
+
+class CatalogEntry:
+    def __init__(self, body: bytes):
+        self.created_at = time.monotonic()
+        self.etag = f'W/"{hashlib.sha1(body).hexdigest()[:24]}"'
+        self.bodies = {None: body}  # encoding -> bytes; None is identity
+
+    def body_for(self, encoding: Optional[str]) -> bytes:
+        if encoding not in self.bodies:
+            self.bodies[encoding] = compress_body(encoding, self.bodies[None])
+        return self.bodies[encoding]
+
+    def response(self, request: Request) -> Response:
+        headers = {"ETag": self.etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+        if_none_match = request.headers.get("if-none-match", "")
+        if if_none_match.strip() == "*" or self.etag in [tag.strip() for tag in if_none_match.split(",")]:
+            return Response(status_code=304, headers=headers)
+        encoding = None
+        if COMPRESSION_ENABLED and len(self.bodies[None]) >= COMPRESSION_MIN_BYTES:
+            encoding = negotiate_encoding(request.headers.get("accept-encoding"))
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        return Response(self.body_for(encoding), media_type="application/json", headers=headers)
+
+class CatalogResponseCache:
+    """Rendered catalogue responses, one `VersionedCache` per collection."""
+
+    def __init__(self, ttl_seconds: float, version_check_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.version_check_seconds = version_check_seconds
+        self.max_entries = max_entries
+        self.collections: Dict[str, VersionedCache] = {}
+
+    def _cache(self, collection: str) -> VersionedCache:
+        if collection not in self.collections:
+            self.collections[collection] = VersionedCache(collection, self.ttl_seconds, self.version_check_seconds, self.max_entries)
+        return self.collections[collection]
+
+    async def respond(self, request: Request, collection: str, build) -> Response:
+        """Serve `build()` (async, returns models) for this request from the cache."""
+        cache = self._cache(collection)
+        await cache._sync_version()
+        key = (collection, request.url.path, "&".join(sorted(request.url.query.split("&"))))
+        entry = cache.lookup(key)
+        if entry is not None:
+            return entry[1].response(request)
+        generation = cache.generation
+        rendered = await read_coalescer.do(("catalog", *key), lambda: self._fill(build))
+        cache.store(key, rendered, generation)
+        return rendered.response(request)
+
+    async def _fill(self, build) -> CatalogEntry:
+        return CatalogEntry(DefaultJSONResponse(jsonable_encoder(await build())).body)
+
+    def drop(self, collection: str):
+        self._cache(collection).clear()
+        read_coalescer.forget("catalog", collection)
+
+    async def invalidate(self, collection: str):
+        cache = self._cache(collection)
+        self.drop(collection)
+        await cache.bump()
+
+catalog_responses = CatalogResponseCache(
+    CATALOG_RESPONSE_TTL_SECONDS, CATALOG_RESPONSE_VERSION_CHECK_SECONDS, CATALOG_RESPONSE_MAX_ENTRIES
+)
+
 # ========================= VETS =========================
 
 @api_router.get("/vets", response_model=List[Vet])
-async def get_vets(city: Optional[str] = None, specialty: Optional[str] = None):
+async def get_vets(request: Request, city: Optional[str] = None, specialty: Optional[str] = None):
     query = {}
     if city:
         query["city"] = {"$regex": city, "$options": "i"}
     if specialty:
         query["specialty"] = specialty
-    
-    vets = await db.vets.find(query).to_list(100)
-    return [Vet(**v) for v in vets]
+
+    async def build():
+        vets = await db.vets.find(query).to_list(100)
+        return [Vet(**v) for v in vets]
+
+    return await catalog_responses.respond(request, "vets", build)
 
 @api_router.get("/vets/{vet_id}", response_model=Vet)
 async def get_vet(vet_id: str):
@@ -1294,58 +2748,122 @@ async def cancel_appointment(appointment_id: str, current_user: dict = Depends(g
     return {"message": "Appointment cancelled"}
 
 # ========================= CART =========================
+# Carts store only {product_id, quantity}; names, prices and images come from the
+# catalogue at read time through `product_cache`, never from what the client sent.
+
+PRODUCT_CACHE_TTL_SECONDS = float(os.environ.get("PRODUCT_CACHE_TTL_SECONDS", "300"))
+PRODUCT_CACHE_VERSION_CHECK_SECONDS = float(os.environ.get("PRODUCT_CACHE_VERSION_CHECK_SECONDS", "5"))
+PRODUCT_CACHE_MAX_ENTRIES = int(os.environ.get("PRODUCT_CACHE_MAX_ENTRIES", "5000"))
+
+class ProductCache(VersionedCache):
+    """Process-local product snapshots used to price carts.
+
+    Product writes bump the "products" version, which also drops the rendered
+    /products responses in `catalog_responses`.
+    """
+
+    FIELDS = {"_id": 0, "id": 1, "name": 1, "price": 1, "image": 1, "in_stock": 1}
+
+    def __init__(self, ttl_seconds: float, version_check_seconds: float, max_entries: int):
+        super().__init__("products", ttl_seconds, version_check_seconds, max_entries)
+
+    async def get_many(self, product_ids: List[str]) -> Dict[str, Optional[dict]]:
+        """Return {product_id: snapshot or None}, loading misses with a single `$in` query."""
+        await self._sync_version()
+        found: Dict[str, Optional[dict]] = {}
+        missing: List[str] = []
+        for product_id in dict.fromkeys(product_ids):
+            entry = self.lookup(product_id)
+            if entry is not None:
+                found[product_id] = entry[1]
+            else:
+                missing.append(product_id)
+        if missing:
+            generation = self.generation
+            rows = await db.products.find({"id": {"$in": missing}}, self.FIELDS).to_list(None)
+            loaded = {row["id"]: row for row in rows}
+            for product_id in missing:
+                self.store(product_id, loaded.get(product_id), generation)
+                found[product_id] = loaded.get(product_id)
+        return found
+
+    async def invalidate(self, *product_ids: str):
+        """Drop `product_ids` (every product when none are given) here and on every worker."""
+        if product_ids:
+            self.drop(*product_ids)
+        else:
+            self.clear()
+        await self.bump()
+
+product_cache = ProductCache(PRODUCT_CACHE_TTL_SECONDS, PRODUCT_CACHE_VERSION_CHECK_SECONDS, PRODUCT_CACHE_MAX_ENTRIES)
 
 class CartItemAdd(BaseModel):
     product_id: str
-    name: str
-    price: float
     quantity: int = 1
+    # Accepted for older clients but ignored; the catalogue is authoritative.
+    name: Optional[str] = None
+    price: Optional[float] = None
     image: Optional[str] = None
 
 class CartItemUpdate(BaseModel):
     quantity: int
 
+async def price_cart(lines: List[dict]) -> dict:
+    products = await product_cache.get_many([line["product_id"] for line in lines])
+    items = []
+    total = 0.0
+    for line in lines:
+        product = products.get(line["product_id"])
+        if not product:
+            items.append({"product_id": line["product_id"], "quantity": line["quantity"], "available": False})
+            continue
+        price = float(product.get("price") or 0)
+        total += price * line["quantity"]
+        items.append({
+            "product_id": line["product_id"],
+            "quantity": line["quantity"],
+            "name": product.get("name"),
+            "price": price,
+            "image": product.get("image"),
+            "in_stock": product.get("in_stock", True),
+            "available": True,
+        })
+    return {"items": items, "total": round(total, 2)}
+
 @api_router.get("/cart")
 async def get_cart(current_user: dict = Depends(get_current_user)):
-    cart = await db.carts.find_one({"user_id": current_user["id"]})
+    cart = await db.carts.find_one({"user_id": current_user["id"]}, {"_id": 0, "items": 1})
     if not cart:
         return {"items": [], "total": 0}
-    
-    total = sum(item["price"] * item["quantity"] for item in cart.get("items", []))
-    return {"items": cart.get("items", []), "total": total}
+    return await price_cart(cart.get("items", []))
 
 @api_router.post("/cart/add")
 async def add_to_cart(item: CartItemAdd, current_user: dict = Depends(get_current_user)):
-    cart = await db.carts.find_one({"user_id": current_user["id"]})
-    
-    if not cart:
-        # Create new cart
-        cart = {
-            "user_id": current_user["id"],
-            "items": [item.dict()],
-            "created_at": datetime.utcnow()
-        }
-        await db.carts.insert_one(cart)
-    else:
-        # Check if item already in cart
-        existing_item = next(
-            (i for i in cart.get("items", []) if i["product_id"] == item.product_id),
-            None
-        )
-        
-        if existing_item:
-            # Update quantity
-            await db.carts.update_one(
-                {"user_id": current_user["id"], "items.product_id": item.product_id},
-                {"$inc": {"items.$.quantity": item.quantity}}
-            )
-        else:
-            # Add new item
-            await db.carts.update_one(
-                {"user_id": current_user["id"]},
-                {"$push": {"items": item.dict()}}
-            )
-    
+    if item.quantity <= 0:
+        raise HTTPException(status_code=400, detail="Quantity must be positive")
+    if not (await product_cache.get_many([item.product_id])).get(item.product_id):
+        raise HTTPException(status_code=404, detail="Product not found")
+
+    now = datetime.utcnow()
+    items = {"$ifNull": ["$items", []]}
+    # One upserting pipeline update: bump the line if present, otherwise append it.
+    await db.carts.update_one(
+        {"user_id": current_user["id"]},
+        [{"$set": {
+            "items": {"$cond": [
+                {"$in": [item.product_id, {"$map": {"input": items, "as": "line", "in": "$$line.product_id"}}]},
+                {"$map": {"input": items, "as": "line", "in": {"$cond": [
+                    {"$eq": ["$$line.product_id", item.product_id]},
+                    {"product_id": item.product_id, "quantity": {"$add": ["$$line.quantity", item.quantity]}},
+                    "$$line",
+                ]}}},
+                {"$concatArrays": [items, [{"product_id": item.product_id, "quantity": item.quantity}]]},
+            ]},
+            "created_at": {"$ifNull": ["$created_at", now]},
+            "updated_at": now,
+        }}],
+        upsert=True,
+    )
     return {"message": "Item added to cart"}
 
 @api_router.put("/cart/update/{product_id}")
@@ -1390,20 +2908,153 @@ async def clear_cart(current_user: dict = Depends(get_current_user)):
 
 # ========================= ORDERS (SHOP CHECKOUT) =========================
 
+PRICE_TOLERANCE = 0.005
+FREE_SHIPPING_OVER = 50.0  # same rule as the checkout screen
+SHIPPING_FEE = 5.99
+
+async def resolve_order_items(items: List[OrderItem]) -> tuple:
+    """Validate order lines against the catalogue with one `$in` query per source collection.
+
+    Returns (items with seller ids attached, {product_id: quantity to reserve}, subtotal).
+    Shop products are checked for price and stock; marketplace listings for price and status.
+    """
+    ids = list({i.product_id for i in items})
+    products, listings = await asyncio.gather(
+        db.products.find({"id": {"$in": ids}}, {"_id": 0, "id": 1, "price": 1, "quantity": 1, "in_stock": 1}).to_list(None),
+        db.marketplace_listings.find({"id": {"$in": ids}}, {"_id": 0, "id": 1, "user_id": 1, "price": 1, "status": 1}).to_list(None),
+    )
+    product_map = {p["id"]: p for p in products}
+    listing_map = {l["id"]: l for l in listings}
+
+    resolved: List[OrderItem] = []
+    reserve: Dict[str, int] = {}
+    subtotal = 0.0
+    for item in items:
+        if item.quantity <= 0:
+            raise HTTPException(status_code=400, detail=error_detail("ORDER_INVALID_QUANTITY", f"Invalid quantity for {item.name}"))
+        source = product_map.get(item.product_id) or listing_map.get(item.product_id)
+        if not source:
+            raise HTTPException(status_code=400, detail=error_detail("ORDER_ITEM_NOT_FOUND", f"{item.name} is no longer available"))
+        if abs(float(source.get("price") or 0) - item.price) > PRICE_TOLERANCE:
+            raise HTTPException(status_code=409, detail=error_detail("ORDER_PRICE_CHANGED", f"The price of {item.name} has changed"))
+
+        item_data = item.dict()
+        if item.product_id in product_map:
+            if source.get("in_stock") is False:
+                raise HTTPException(status_code=409, detail=error_detail("ORDER_OUT_OF_STOCK", f"{item.name} is out of stock"))
+            if isinstance(source.get("quantity"), (int, float)):
+                reserve[item.product_id] = reserve.get(item.product_id, 0) + item.quantity
+        else:
+            if source.get("status") != "active":
+                raise HTTPException(status_code=409, detail=error_detail("ORDER_ITEM_NOT_FOUND", f"{item.name} is no longer available"))
+            item_data["seller_user_id"] = source.get("user_id")
+        resolved.append(OrderItem(**item_data))
+        subtotal += item.price * item.quantity
+
+    for product_id, qty in reserve.items():
+        if product_map[product_id]["quantity"] < qty:
+            raise HTTPException(status_code=409, detail=error_detail("ORDER_OUT_OF_STOCK", "Not enough stock for one of the items"))
+    return resolved, reserve, round(subtotal, 2)
+
+async def reserve_stock(reserve: Dict[str, int], session) -> bool:
+    """Decrement product stock, failing the checkout if any product ran out concurrently.
+
+    Returns True when a product sold out, so the caller can refresh `product_cache`
+    once the checkout is committed.
+    """
+    if not reserve:
+        return False
+    pids = list(reserve.keys())
+    decrements = [({"id": pid, "quantity": {"$gte": qty}}, {"$inc": {"quantity": -qty}}) for pid, qty in reserve.items()]
+    if session is not None:
+        result = await db.products.bulk_write([UpdateOne(f, u) for f, u in decrements], ordered=True, session=session)
+        if result.matched_count != len(decrements):
+            raise HTTPException(status_code=409, detail=error_detail("ORDER_OUT_OF_STOCK", "Not enough stock for one of the items"))
+    else:
+        # Without a transaction, decrement concurrently and give back whatever was taken on failure.
+        results = await asyncio.gather(*(db.products.update_one(f, u) for f, u in decrements))
+        if any(r.matched_count == 0 for r in results):
+            await release_stock({pid: reserve[pid] for pid, r in zip(pids, results) if r.matched_count})
+            raise HTTPException(status_code=409, detail=error_detail("ORDER_OUT_OF_STOCK", "Not enough stock for one of the items"))
+    sold_out = await db.products.update_many(
+        {"id": {"$in": pids}, "quantity": {"$lt": 1}, "in_stock": {"$ne": False}},
+        {"$set": {"in_stock": False}},
+        session=session,
+    )
+    return sold_out.modified_count > 0
+
+async def release_stock(reserve: Dict[str, int]) -> None:
+    if reserve:
+        await db.products.bulk_write([UpdateOne({"id": pid}, {"$inc": {"quantity": qty}}) for pid, qty in reserve.items()], ordered=False)
+        restocked = await db.products.update_many(
+            {"id": {"$in": list(reserve.keys())}, "quantity": {"$gt": 0}, "in_stock": False},
+            {"$set": {"in_stock": True}},
+        )
+        if restocked.modified_count:
+            await product_cache.invalidate(*reserve.keys())
+
+async def redeem_points(user_id: str, points: int, reference_id: str, session) -> None:
+    await post_points(
+        user_id, -points, "redeemed", f"Redeemed {points} points for ${points / 100:.2f} discount",
+        reference_id=reference_id, session=session,
+    )
+
+async def refund_points(user_id: str, points: int, reference_id: str) -> None:
+    """Compensate a redemption whose order was never written (non-transactional checkout)."""
+    await post_points(
+        user_id, points, "refunded", f"Refunded {points} points from a failed checkout",
+        reference_id=reference_id, lifetime=False,
+    )
+
+def shipping_cost(subtotal: float) -> float:
+    return 0.0 if subtotal > FREE_SHIPPING_OVER else SHIPPING_FEE
+
 @api_router.post("/orders", response_model=Order)
 async def create_order(order_data: OrderCreate, current_user: dict = Depends(get_current_user)):
-    enriched_items = []
-    for item in order_data.items:
-        item_data = item.dict()
-        listing = await db.marketplace_listings.find_one({"id": item.product_id})
-        if listing:
-            item_data["seller_user_id"] = listing.get("user_id")
-        enriched_items.append(OrderItem(**item_data))
+    if not order_data.items:
+        raise HTTPException(status_code=400, detail=error_detail("ORDER_EMPTY", "Order has no items"))
+    points_used = max(0, order_data.points_used)
+    items, reserve, subtotal = await resolve_order_items(order_data.items)
+    shipping = shipping_cost(subtotal)
+    total = round(max(0.0, subtotal + shipping - points_used / 100), 2)
+    if order_data.total < total - PRICE_TOLERANCE:
+        raise HTTPException(status_code=409, detail=error_detail("ORDER_TOTAL_MISMATCH", "Order total does not match the item prices"))
 
     order_payload = order_data.dict()
-    order_payload["items"] = [i.dict() for i in enriched_items]
+    order_payload["items"] = [i.dict() for i in items]
+    order_payload["subtotal"] = subtotal
+    order_payload["shipping_cost"] = shipping
+    order_payload["total"] = total
+    order_payload["points_used"] = points_used
     order = Order(**order_payload, user_id=current_user["id"])
-    await db.orders.insert_one(order.dict())
+
+    sold_out = False
+
+    async def _checkout(session):
+        nonlocal sold_out
+        sold_out = await reserve_stock(reserve, session)
+        redeemed = False
+        try:
+            if points_used:
+                await redeem_points(current_user["id"], points_used, order.id, session)
+                redeemed = True
+            await db.orders.insert_one(order.dict(), session=session)
+        except Exception:
+            if session is None:
+                await release_stock(reserve)
+                if redeemed:
+                    await refund_points(current_user["id"], points_used, order.id)
+            raise
+        await db.carts.update_one(
+            {"user_id": current_user["id"]},
+            {"$pull": {"items": {"product_id": {"$in": [i.product_id for i in items]}}}},
+            session=session,
+        )
+
+    await run_in_transaction(_checkout)
+    if sold_out:
+        await product_cache.invalidate(*reserve.keys())
+        catalog_responses.drop("products")
     return order
 
 @api_router.get("/orders", response_model=List[Order])
@@ -1423,6 +3074,75 @@ async def get_order(order_id: str, current_user: dict = Depends(get_current_user
         raise HTTPException(status_code=404, detail="Order not found")
     return Order(**order)
 
+# ========================= BLOCK LISTS =========================
+# Feeds, marketplace and friend search hide users on either side of a block. Each
+# worker keeps a per-user BlockSet; the block/unblock routes drop the affected users
+# locally and bump a shared `catalog_versions` "blocks" version so other workers
+# flush within BLOCK_CACHE_VERSION_CHECK_SECONDS. Message/conversation guards still
+# read `blocked_users` directly.
+
+BLOCK_CACHE_TTL_SECONDS = float(os.environ.get("BLOCK_CACHE_TTL_SECONDS", "300"))
+BLOCK_CACHE_VERSION_CHECK_SECONDS = float(os.environ.get("BLOCK_CACHE_VERSION_CHECK_SECONDS", "5"))
+BLOCK_CACHE_MAX_ENTRIES = int(os.environ.get("BLOCK_CACHE_MAX_ENTRIES", "20000"))
+BLOCK_NIN_MAX = int(os.environ.get("BLOCK_NIN_MAX", "200"))  # larger sets are filtered in-process
+
+class BlockSet:
+    def __init__(self, blocked: Set[str], blocked_by: Set[str]):
+        self.blocked = frozenset(blocked)  # users this user blocked
+        self.blocked_by = frozenset(blocked_by)  # users who blocked this user
+        self.ids = self.blocked | self.blocked_by
+        self.nin = sorted(self.ids) if 0 < len(self.ids) <= BLOCK_NIN_MAX else None
+
+    def hides(self, user_id: Optional[str]) -> bool:
+        return user_id in self.ids
+
+    def apply(self, query: dict, field: str = "user_id") -> bool:
+        """Push the exclusion into `query` when small; returns True when rows must be post-filtered."""
+        if self.nin is not None:
+            query[field] = {"$nin": self.nin}
+        return self.nin is None and bool(self.ids)
+
+EMPTY_BLOCK_SET = BlockSet(set(), set())
+
+class BlockListCache(VersionedCache):
+    def __init__(self, ttl_seconds: float, version_check_seconds: float, max_entries: int):
+        super().__init__("blocks", ttl_seconds, version_check_seconds, max_entries)  # user_id -> BlockSet
+
+    async def get(self, user_id: Optional[str]) -> BlockSet:
+        if not user_id:
+            return EMPTY_BLOCK_SET
+        await self._sync_version()
+        entry = self.lookup(user_id)
+        if entry is not None:
+            return entry[1]
+        generation = self.generation
+        rows = await db.blocked_users.find(
+            {"$or": [{"user_id": user_id}, {"blocked_user_id": user_id}]},
+            {"_id": 0, "user_id": 1, "blocked_user_id": 1},
+        ).to_list(None)
+        blocks = BlockSet(
+            {r.get("blocked_user_id") for r in rows if r.get("user_id") == user_id and r.get("blocked_user_id")},
+            {r.get("user_id") for r in rows if r.get("blocked_user_id") == user_id and r.get("user_id")},
+        )
+        self.store(user_id, blocks, generation)
+        return blocks
+
+    async def invalidate(self, *user_ids: str):
+        self.drop(*user_ids)
+        await self.bump()
+
+block_lists = BlockListCache(BLOCK_CACHE_TTL_SECONDS, BLOCK_CACHE_VERSION_CHECK_SECONDS, BLOCK_CACHE_MAX_ENTRIES)
+
+async def collect_visible(cursor, blocks: BlockSet, limit: int, field: str = "user_id") -> List[dict]:
+    """Read `cursor` until `limit` rows not hidden by `blocks` are collected."""
+    rows = []
+    async for row in cursor:
+        if not blocks.hides(row.get(field)):
+            rows.append(row)
+            if len(rows) >= limit:
+                break
+    return rows
+
 # ========================= CONVERSATIONS (CHAT) =========================
 
 @api_router.post("/conversations")
@@ -1465,6 +3185,7 @@ async def create_conversation(data: ConversationCreate, current_user: dict = Dep
             {"id": existing["id"]},
             {"$set": {"last_message": initial_message, "last_message_time": datetime.utcnow()}}
         )
+        await record_chat_unread(existing["id"], current_user["id"], existing.get("participants", []))
 
         await notify_conversation_participants(
             existing["id"],
@@ -1498,6 +3219,7 @@ async def create_conversation(data: ConversationCreate, current_user: dict = Dep
         content=initial_message
     )
     await db.chat_messages.insert_one(chat_msg.dict())
+    await record_chat_unread(conversation.id, current_user["id"], conversation.participants)
 
     await notify_conversation_participants(
         conversation.id,
@@ -1508,25 +3230,33 @@ async def create_conversation(data: ConversationCreate, current_user: dict = Dep
 
     return {"conversation_id": conversation.id, "is_new": True}
 
+CONVERSATION_LIST_FIELDS = ("id", "participants", "pet_id", "last_message", "last_message_time", "created_at")
+CONVERSATION_RESPONSE_FIELDS = CONVERSATION_LIST_FIELDS + ("other_user", "unread_count")
+USER_CARD_FIELDS = ("id", "name", "avatar")
+
 @api_router.get("/conversations")
-async def get_conversations(current_user: dict = Depends(get_current_user)):
+async def get_conversations(fields: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    selected = parse_fields(fields, CONVERSATION_RESPONSE_FIELDS)
     conversations = await db.conversations.find({
         "participants": current_user["id"]
-    }).sort("last_message_time", -1).to_list(100)
+    }, mongo_projection(*CONVERSATION_LIST_FIELDS)).sort("last_message_time", -1).to_list(100)
     
+    counters = await get_user_counters(current_user["id"])
+
+    other_ids = {p for conv in conversations for p in conv.get("participants", []) if p != current_user["id"]}
+    users_by_id = {}
+    if other_ids and (selected is None or "other_user" in selected):
+        users = await db.users.find({"id": {"$in": list(other_ids)}}, mongo_projection(*USER_CARD_FIELDS)).to_list(len(other_ids))
+        users_by_id = {u["id"]: u for u in users}
+
     # Enrich with user info
     result = []
     for conv in conversations:
         other_candidates = [p for p in conv.get("participants", []) if p != current_user["id"]]
         other_user_id = other_candidates[0] if other_candidates else None
-        other_user = await db.users.find_one({"id": other_user_id}) if other_user_id else None
+        other_user = users_by_id.get(other_user_id)
         
-        # Get unread count
-        unread = await db.chat_messages.count_documents({
-            "conversation_id": conv["id"],
-            "sender_id": {"$ne": current_user["id"]},
-            "is_read": False
-        })
+        unread = counters["chat_unread"].get(conv["id"], 0)
         
         # Create a clean dict without MongoDB ObjectId
         clean_conv = {
@@ -1544,7 +3274,7 @@ async def get_conversations(current_user: dict = Depends(get_current_user)):
             },
             "unread_count": unread
         }
-        result.append(clean_conv)
+        result.append(pick_fields(clean_conv, selected))
     
     return result
 
@@ -1554,13 +3284,7 @@ async def search_users_for_friends(q: str = '', current_user: dict = Depends(get
     if len(keyword) < 2:
         return []
 
-    blocked_rows = await db.blocked_users.find({"$or": [{"user_id": current_user["id"]}, {"blocked_user_id": current_user["id"]}]}).to_list(5000)
-    blocked_ids = set()
-    for row in blocked_rows:
-        if row.get("user_id") == current_user["id"]:
-            blocked_ids.add(row.get("blocked_user_id"))
-        if row.get("blocked_user_id") == current_user["id"]:
-            blocked_ids.add(row.get("user_id"))
+    blocks = await block_lists.get(current_user["id"])
 
     regex_query = {
         "$or": [
@@ -1568,9 +3292,13 @@ async def search_users_for_friends(q: str = '', current_user: dict = Depends(get
             {"username": {"$regex": keyword, "$options": "i"}},
             {"user_code": {"$regex": keyword, "$options": "i"}},
         ],
-        "id": {"$ne": current_user["id"], "$nin": list(blocked_ids)}
+        "id": {"$ne": current_user["id"], **({"$nin": blocks.nin} if blocks.nin else {})},
     }
-    users = await db.users.find(regex_query).limit(30).to_list(30)
+    cursor = db.users.find(regex_query, mongo_projection("id", "name", "avatar", "username", "user_code"))
+    if blocks.nin is None and blocks.ids:
+        users = await collect_visible(cursor.batch_size(60), blocks, 30, field="id")
+    else:
+        users = await cursor.limit(30).to_list(30)
 
     outgoing = await db.friend_requests.find({"from_user_id": current_user["id"], "status": "pending"}).to_list(500)
     incoming = await db.friend_requests.find({"to_user_id": current_user["id"], "status": "pending"}).to_list(500)
@@ -1599,9 +3327,12 @@ async def search_users_for_friends(q: str = '', current_user: dict = Depends(get
         })
     return result
 
+FRIEND_RESPONSE_FIELDS = ("id", "name", "avatar", "username", "user_code", "mutual_count", "is_online")
+
 @api_router.get('/friends')
-async def get_friends(current_user: dict = Depends(get_current_user)):
-    rows = await db.friendships.find({"users": current_user["id"]}).sort("created_at", -1).to_list(2000)
+async def get_friends(fields: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    selected = parse_fields(fields, FRIEND_RESPONSE_FIELDS)
+    rows = await db.friendships.find({"users": current_user["id"]}, mongo_projection("users")).sort("created_at", -1).to_list(2000)
     friend_ids = []
     for fr in rows:
         for uid in fr.get("users", []):
@@ -1609,14 +3340,14 @@ async def get_friends(current_user: dict = Depends(get_current_user)):
                 friend_ids.append(uid)
     if not friend_ids:
         return []
-    users = await db.users.find({"id": {"$in": friend_ids}}).to_list(2000)
+    users = await db.users.find({"id": {"$in": friend_ids}}, mongo_projection("id", "name", "avatar", "username", "user_code")).to_list(2000)
     umap = {u.get("id"): u for u in users}
-    my_friend_ids = await get_friend_ids_set(current_user["id"])
+    with_mutuals = selected is None or "mutual_count" in selected
+    my_friend_ids = await get_friend_ids_set(current_user["id"]) if with_mutuals else set()
     result = []
     for uid in friend_ids:
-        target_friend_ids = await get_friend_ids_set(uid)
-        mutual_count = len(my_friend_ids.intersection(target_friend_ids))
-        result.append({
+        mutual_count = len(my_friend_ids.intersection(await get_friend_ids_set(uid))) if with_mutuals else 0
+        result.append(pick_fields({
             "id": uid,
             "name": umap.get(uid, {}).get("name", "Unknown"),
             "avatar": umap.get(uid, {}).get("avatar"),
@@ -1624,7 +3355,7 @@ async def get_friends(current_user: dict = Depends(get_current_user)):
             "user_code": umap.get(uid, {}).get("user_code") or generate_user_code(uid),
             "mutual_count": mutual_count,
             "is_online": chat_ws_manager.is_online(uid),
-        })
+        }, selected))
     return result
 
 @api_router.get('/friends/requests')
@@ -1711,6 +3442,7 @@ async def send_friend_request(payload: dict, current_user: dict = Depends(get_cu
             "users": [current_user["id"], target_user_id],
             "created_at": datetime.utcnow(),
         })
+        await backfill_friend_timelines(current_user["id"], target_user_id)
         return {"success": True, "status": "friends"}
 
     row = {
@@ -1753,6 +3485,7 @@ async def review_friend_request(request_id: str, payload: dict, current_user: di
                 "users": [current_user["id"], req.get("from_user_id")],
                 "created_at": datetime.utcnow(),
             })
+            await backfill_friend_timelines(current_user["id"], req.get("from_user_id"))
 
     await create_notification(
         req.get("from_user_id"),
@@ -1801,11 +3534,13 @@ async def block_user_in_friends(target_user_id: str, current_user: dict = Depend
         {"from_user_id": target_user_id, "to_user_id": current_user["id"]},
     ]})
     await db.friendships.delete_many({"users": {"$all": [current_user["id"], target_user_id]}})
+    await block_lists.invalidate(current_user["id"], target_user_id)
     return {"success": True}
 
 @api_router.delete('/friends/{target_user_id}/block')
 async def unblock_user_in_friends(target_user_id: str, current_user: dict = Depends(get_current_user)):
     await db.blocked_users.delete_one({"user_id": current_user["id"], "blocked_user_id": target_user_id})
+    await block_lists.invalidate(current_user["id"], target_user_id)
     return {"success": True}
 
 @api_router.post('/friends/report')
@@ -1895,6 +3630,7 @@ async def review_friend_report_admin(report_id: str, payload: dict, admin_user:
                     "blocked_user_id": target_user_id,
                     "created_at": datetime.utcnow(),
                 })
+                await block_lists.invalidate(reporter_id, target_user_id)
 
     await db.friend_reports.update_one(
         {"id": report_id},
@@ -1960,6 +3696,7 @@ async def get_chat_messages(conversation_id: str, current_user: dict = Depends(g
         {"conversation_id": conversation_id, "sender_id": {"$ne": current_user["id"]}, "is_read": False},
         {"$set": {"is_read": True}}
     )
+    await clear_chat_unread(current_user["id"], conversation_id)
 
     if read_result.modified_count > 0:
         await notify_conversation_participants(
@@ -2009,6 +3746,7 @@ async def mark_conversation_read(conversation_id: str, current_user: dict = Depe
         {"conversation_id": conversation_id, "sender_id": {"$ne": current_user["id"]}, "is_read": False},
         {"$set": {"is_read": True}}
     )
+    await clear_chat_unread(current_user["id"], conversation_id)
 
     if read_result.modified_count > 0:
         await notify_conversation_participants(
@@ -2045,6 +3783,7 @@ async def send_chat_message(conversation_id: str, content: str, current_user: di
         {"id": conversation_id},
         {"$set": {"last_message": clean_content, "last_message_time": datetime.utcnow()}}
     )
+    await record_chat_unread(conversation_id, current_user["id"], conversation.get("participants", []))
 
     await notify_conversation_participants(
         conversation_id,
@@ -2078,6 +3817,7 @@ async def get_map_locations(
 
 @api_router.get("/products", response_model=List[Product])
 async def get_products(
+    request: Request,
     category: Optional[str] = None,
     pet_type: Optional[str] = None,
     limit: int = 50,
@@ -2088,9 +3828,12 @@ async def get_products(
         query["category"] = category
     if pet_type:
         query["pet_type"] = pet_type
-    
-    products = await db.products.find(query).skip(skip).limit(limit).to_list(limit)
-    return [Product(**p) for p in products]
+
+    async def build():
+        products = await db.products.find(query).skip(skip).limit(limit).to_list(limit)
+        return [Product(**p) for p in products]
+
+    return await catalog_responses.respond(request, "products", build)
 
 @api_router.get("/products/{product_id}", response_model=Product)
 async def get_product(product_id: str):
@@ -2102,12 +3845,16 @@ async def get_product(product_id: str):
 # ========================= EMERGENCY CONTACTS =========================
 
 @api_router.get("/emergency-contacts", response_model=List[EmergencyContact])
-async def get_emergency_contacts(city: Optional[str] = None):
+async def get_emergency_contacts(request: Request, city: Optional[str] = None):
     query = {}
     if city:
         query["city"] = {"$regex": city, "$options": "i"}
-    contacts = await db.emergency_contacts.find(query).to_list(100)
-    return [EmergencyContact(**c) for c in contacts]
+
+    async def build():
+        contacts = await db.emergency_contacts.find(query).to_list(100)
+        return [EmergencyContact(**c) for c in contacts]
+
+    return await catalog_responses.respond(request, "emergency_contacts", build)
 
 # ========================= MESSAGES =========================
 
@@ -2138,9 +3885,11 @@ async def mark_message_read(message_id: str, current_user: dict = Depends(get_cu
 # ========================= LOST & FOUND =========================
 
 @api_router.post("/lost-found", response_model=LostFoundPost)
-async def create_lost_found(post: LostFoundCreate, current_user: dict = Depends(get_current_user)):
+async def create_lost_found(post: LostFoundCreate, background_tasks: BackgroundTasks, current_user: dict = Depends(get_current_user)):
     lost_found = LostFoundPost(**post.dict(), user_id=current_user["id"])
-    await db.lost_found.insert_one(lost_found.dict())
+    doc = {**lost_found.dict(), **lost_found_match_keys(lost_found.dict())}
+    await db.lost_found.insert_one(doc)
+    background_tasks.add_task(match_lost_found_post, doc)
     return lost_found
 
 @api_router.get("/lost-found", response_model=List[LostFoundPost])
@@ -2158,49 +3907,313 @@ async def get_lost_found_by_id(post_id: str):
         raise HTTPException(status_code=404, detail="Post not found")
     return LostFoundPost(**post)
 
+# ========================= LOST & FOUND MATCHING =========================
+#
+# Posts are stamped on write with normalised match keys (`match_species`,
+# `match_breed`, `match_colors`, `match_place`, `match_seen_on`, `match_cell`), so
+# candidates for a new post come from one indexed prefilter on the opposite type,
+# species, a date window and the geo cells around it; only that shortlist is
+# scored. Matching runs once per new post or tag scan and never walks the archive.
+# Each pair is recorded once in `lost_found_matches` (unique `pair`), and both
+# parties are notified when it is first recorded.
+
+LOST_FOUND_MATCH_WINDOW_DAYS = int(os.environ.get("LOST_FOUND_MATCH_WINDOW_DAYS", "14"))
+LOST_FOUND_MATCH_RADIUS_KM = float(os.environ.get("LOST_FOUND_MATCH_RADIUS_KM", "15"))
+LOST_FOUND_MATCH_MIN_SCORE = float(os.environ.get("LOST_FOUND_MATCH_MIN_SCORE", "0.5"))
+LOST_FOUND_MATCH_CANDIDATES = 200
+LOST_FOUND_MATCHES_PER_REPORT = 10
+GEO_CELL_DEGREES = 0.1
+MATCH_STOPWORDS = {"and", "with", "the", "near", "of", "in", "at", "on"}
+LOST_FOUND_MATCH_FIELDS = (
+    "id", "user_id", "type", "pet_species", "last_seen_location", "latitude", "longitude",
+    "match_species", "match_breed", "match_colors", "match_place", "match_seen_on", "match_cell",
+)
+
+def match_tokens(text: Optional[str]) -> List[str]:
+    return sorted({t for t in re.findall(r"[a-z0-9]+", (text or "").lower()) if len(t) > 1 and t not in MATCH_STOPWORDS})
+
+def geo_cell(latitude: Optional[float], longitude: Optional[float]) -> Optional[str]:
+    if latitude is None or longitude is None:
+        return None
+    return f"{math.floor(latitude / GEO_CELL_DEGREES)}:{math.floor(longitude / GEO_CELL_DEGREES)}"
+
+def geo_cells_around(latitude: float, longitude: float, radius_km: float) -> List[str]:
+    cell_km = 111.32 * GEO_CELL_DEGREES
+    lat_steps = math.ceil(radius_km / cell_km)
+    lng_steps = math.ceil(radius_km / (cell_km * max(math.cos(math.radians(latitude)), 0.01)))
+    row, col = (math.floor(v / GEO_CELL_DEGREES) for v in (latitude, longitude))
+    return [f"{row + i}:{col + j}" for i in range(-lat_steps, lat_steps + 1) for j in range(-lng_steps, lng_steps + 1)]
+
+def distance_km(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    dlat, dlng = math.radians(lat2 - lat1), math.radians(lng2 - lng1)
+    a = math.sin(dlat / 2) ** 2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlng / 2) ** 2
+    return 6371.0 * 2 * math.asin(math.sqrt(a))
+
+def parse_seen_on(value: Optional[str], fallback: Optional[datetime]) -> datetime:
+    try:
+        return datetime.strptime((value or "")[:10], "%Y-%m-%d")
+    except ValueError:
+        day = fallback or datetime.utcnow()
+        return datetime(day.year, day.month, day.day)
+
+def match_keys(species, breed, color, place, seen_on: datetime, latitude, longitude) -> dict:
+    return {
+        "match_species": (species or "").strip().lower(),
+        "match_breed": (breed or "").strip().lower() or None,
+        "match_colors": match_tokens(color),
+        "match_place": match_tokens(place),
+        "match_seen_on": seen_on,
+        "match_cell": geo_cell(latitude, longitude),
+    }
+
+def lost_found_match_keys(post: dict) -> dict:
+    return match_keys(
+        post.get("pet_species"), post.get("breed"), post.get("color"), post.get("last_seen_location"),
+        parse_seen_on(post.get("last_seen_date"), post.get("created_at")), post.get("latitude"), post.get("longitude"),
+    )
+
+def tag_scan_match_keys(scan: dict, pet: dict) -> dict:
+    scanned = scan.get("created_at") or datetime.utcnow()
+    return {
+        **match_keys(pet.get("species"), pet.get("breed"), pet.get("color"), scan.get("location"),
+                     datetime(scanned.year, scanned.month, scanned.day), scan.get("latitude"), scan.get("longitude")),
+        "latitude": scan.get("latitude"),
+        "longitude": scan.get("longitude"),
+    }
+
+def candidate_query(keys: dict, post_type: str) -> dict:
+    window = timedelta(days=LOST_FOUND_MATCH_WINDOW_DAYS)
+    query = {
+        "type": post_type,
+        "status": "active",
+        "match_species": keys["match_species"],
+        "match_seen_on": {"$gte": keys["match_seen_on"] - window, "$lte": keys["match_seen_on"] + window},
+    }
+    if keys.get("match_cell"):
+        # Reports without coordinates stay candidates; they are scored on place names instead.
+        query["match_cell"] = {"$in": [*geo_cells_around(keys["latitude"], keys["longitude"], LOST_FOUND_MATCH_RADIUS_KM), None]}
+    return query
+
+def overlap(a, b) -> float:
+    a, b = set(a or []), set(b or [])
+    return len(a & b) / len(a | b) if a and b else 0.0
+
+def match_score(a: dict, b: dict) -> tuple:
+    """Weighted similarity in [0, 1]: breed .3, colour .3, date .2, place .2. Unknown breed/colour scores a neutral .1."""
+    score, reasons = 0.0, []
+    if a.get("match_breed") and b.get("match_breed"):
+        if a["match_breed"] == b["match_breed"]:
+            score += 0.3
+            reasons.append("breed")
+    else:
+        score += 0.1
+    if a.get("match_colors") and b.get("match_colors"):
+        colors = overlap(a["match_colors"], b["match_colors"])
+        score += 0.3 * colors
+        if colors:
+            reasons.append("color")
+    else:
+        score += 0.1
+    days = abs((a["match_seen_on"] - b["match_seen_on"]).days)
+    score += 0.2 * max(0.0, 1 - days / max(LOST_FOUND_MATCH_WINDOW_DAYS, 1))
+    if None not in (a.get("latitude"), a.get("longitude"), b.get("latitude"), b.get("longitude")):
+        km = distance_km(a["latitude"], a["longitude"], b["latitude"], b["longitude"])
+        nearby = max(0.0, 1 - km / LOST_FOUND_MATCH_RADIUS_KM)
+    else:
+        nearby = overlap(a.get("match_place"), b.get("match_place"))
+    score += 0.2 * nearby
+    if nearby:
+        reasons.append("location")
+    return round(score, 3), reasons
+
+async def find_match_candidates(keys: dict, post_type: str, exclude_user_id: Optional[str]) -> List[tuple]:
+    rows = await db.lost_found.find(candidate_query(keys, post_type), mongo_projection(*LOST_FOUND_MATCH_FIELDS)).limit(
+        LOST_FOUND_MATCH_CANDIDATES).to_list(LOST_FOUND_MATCH_CANDIDATES)
+    scored = [(row, *match_score(keys, row)) for row in rows if row.get("user_id") != exclude_user_id]
+    scored = [item for item in scored if item[1] >= LOST_FOUND_MATCH_MIN_SCORE]
+    return sorted(scored, key=lambda item: item[1], reverse=True)[:LOST_FOUND_MATCHES_PER_REPORT]
+
+async def record_match(ids: Dict[str, str], score: float, reasons: List[str], notices: List[tuple]) -> bool:
+    """Store a match once per pair and notify each (user_id, title, body). Returns False if it was already known."""
+    row = {
+        "id": str(uuid.uuid4()),
+        "pair": "|".join(sorted(ids.values())),
+        **ids,
+        "user_ids": sorted({user_id for user_id, _, _ in notices if user_id}),
+        "score": score,
+        "reasons": reasons,
+        "created_at": datetime.utcnow(),
+    }
+    try:
+        await db.lost_found_matches.insert_one(row)
+    except DuplicateKeyError:
+        return False
+    data = {k: v for k, v in row.items() if k in ("id", "lost_id", "found_id", "scan_id")}
+    for user_id, title, body in notices:
+        await create_notification(user_id, title, body, "lost_found_match", data)
+    return True
+
+async def match_lost_found_post(post: dict):
+    species = post.get("pet_species") or "pet"
+    if post.get("type") == "lost":
+        for found, score, reasons in await find_match_candidates(post, "found", post["user_id"]):
+            await record_match({"lost_id": post["id"], "found_id": found["id"]}, score, reasons, [
+                (post["user_id"], "Possible match for your lost pet", f"A found {species} report may be your pet."),
+                (found["user_id"], "Possible owner found", f"A lost {species} report may match the pet you found."),
+            ])
+        # The owner's own tags may already have been scanned since the pet went missing.
+        pets = await db.pets.find({"owner_id": post["user_id"]}, {"_id": 0, "id": 1, "species": 1, "breed": 1, "color": 1}).to_list(50)
+        pets = [p for p in pets if (p.get("species") or "").strip().lower() == post["match_species"]]
+        since = post["match_seen_on"] - timedelta(days=LOST_FOUND_MATCH_WINDOW_DAYS)
+        scans = await find_tag_scans({"pet_id": {"$in": [p["id"] for p in pets]}, "created_at": {"$gte": since}}, 50) if pets else []
+        by_pet = {p["id"]: p for p in pets}
+        for scan in scans:
+            score, reasons = match_score(post, tag_scan_match_keys(scan, by_pet[scan["pet_id"]]))
+            await record_match({"lost_id": post["id"], "scan_id": scan["id"]}, score, ["tag", *reasons], [
+                (post["user_id"], "Your pet's tag was scanned", f"Your {species}'s tag was scanned at {scan.get('location') or 'an unknown location'}."),
+            ])
+    elif post.get("type") == "found":
+        for lost, score, reasons in await find_match_candidates(post, "lost", post["user_id"]):
+            await record_match({"lost_id": lost["id"], "found_id": post["id"]}, score, reasons, [
+                (lost["user_id"], "Possible match for your lost pet", f"A found {species} report may be your pet."),
+                (post["user_id"], "Possible owner found", f"A lost {species} report may match the pet you found."),
+            ])
+
+async def find_tag_scans(query: dict, limit: int) -> List[dict]:
+    """Tag scans matching `query`, topped up from `tag_scans_archive` once retention has moved them."""
+    scans = await db.tag_scans.find(query, {"_id": 0}).to_list(limit)
+    if len(scans) < limit:
+        seen = [s["id"] for s in scans]
+        archived = await db.tag_scans_archive.find(
+            {"$and": [query, {"id": {"$nin": seen}}]}, {"_id": 0, "archived_at": 0},
+        ).to_list(limit - len(scans))
+        scans += archived
+    return scans
+
+async def match_tag_scan(scan: dict, tag: dict):
+    pet = await db.pets.find_one({"id": tag["pet_id"]}, {"_id": 0, "species": 1, "breed": 1, "color": 1})
+    if not pet:
+        return
+    keys = tag_scan_match_keys(scan, pet)
+    owner_id = tag.get("owner_id")
+    species = pet.get("species") or "pet"
+    # The scanned pet is known, so the owner's open lost report is the match; score only picks between several.
+    lost_posts = await db.lost_found.find(
+        {"user_id": owner_id, "type": "lost", "status": "active", "match_species": keys["match_species"]},
+        mongo_projection(*LOST_FOUND_MATCH_FIELDS),
+    ).to_list(20)
+    if lost_posts:
+        best = max(lost_posts, key=lambda row: match_score(keys, row)[0])
+        score, reasons = match_score(keys, best)
+        await record_match({"lost_id": best["id"], "scan_id": scan["id"]}, score, ["tag", *reasons], [
+            (owner_id, "Your pet's tag was scanned", f"Your {species}'s tag was scanned at {scan.get('location') or 'an unknown location'}."),
+        ])
+    for found, score, reasons in await find_match_candidates(keys, "found", owner_id):
+        await record_match({"found_id": found["id"], "scan_id": scan["id"]}, score, reasons, [
+            (owner_id, "Your pet may have been found", f"A found {species} report matches where your pet's tag was scanned."),
+            (found["user_id"], "Possible owner found", f"A tagged {species} scanned nearby may be the pet you found."),
+        ])
+
+async def ensure_lost_found_indexes():
+    await db.lost_found.create_index([("type", 1), ("status", 1), ("match_species", 1), ("match_seen_on", 1)])
+    await db.lost_found_matches.create_index("pair", unique=True)
+    await db.lost_found_matches.create_index([("lost_id", 1), ("score", -1)])
+    await db.lost_found_matches.create_index([("found_id", 1), ("score", -1)])
+
+async def backfill_lost_found_match_keys() -> int:
+    """One-off: stamp reports from before matching existed so new reports can find them."""
+    stamped = 0
+    async for row in db.lost_found.find({"status": "active", "match_species": {"$exists": False}}):
+        await db.lost_found.update_one({"id": row["id"]}, {"$set": lost_found_match_keys(row)})
+        stamped += 1
+    return stamped
+
+@api_router.get("/lost-found/{post_id}/matches")
+async def get_lost_found_matches(post_id: str, current_user: dict = Depends(get_current_user)):
+    """Matches for the caller's report. Tag scan details go only to the owner of the scanned pet;
+    a found report's author sees just each match's id and score."""
+    post = await db.lost_found.find_one({"id": post_id, "user_id": current_user["id"]}, {"_id": 0, "id": 1, "type": 1})
+    if not post:
+        raise HTTPException(status_code=404, detail="Post not found")
+    if post.get("type") != "lost":
+        matches = await db.lost_found_matches.find({"found_id": post_id}, {"_id": 0, "id": 1, "score": 1}).sort(
+            "score", -1).to_list(LOST_FOUND_MATCHES_PER_REPORT * 5)
+        return matches
+
+    matches = await db.lost_found_matches.find({"lost_id": post_id}, {"_id": 0, "pair": 0, "user_ids": 0}).sort(
+        "score", -1).to_list(LOST_FOUND_MATCHES_PER_REPORT * 5)
+    found_ids = [m["found_id"] for m in matches if m.get("found_id")]
+    posts = await db.lost_found.find({"id": {"$in": found_ids}}, {"_id": 0}).to_list(len(found_ids)) if found_ids else []
+    by_id = {p["id"]: LostFoundPost(**p).dict() for p in posts}
+    scan_ids = [m["scan_id"] for m in matches if m.get("scan_id")]
+    scans = await find_tag_scans({"id": {"$in": scan_ids}}, len(scan_ids)) if scan_ids else []
+    owned = await db.pets.find({"owner_id": current_user["id"], "id": {"$in": [s["pet_id"] for s in scans]}}, {"_id": 0, "id": 1}).to_list(None) if scans else []
+    owned_ids = {p["id"] for p in owned}
+    scans_by_id = {s["id"]: s for s in scans if s.get("pet_id") in owned_ids}
+    return [
+        {**m, "post": by_id.get(m.get("found_id")), "scan": scans_by_id.get(m.get("scan_id"))}
+        for m in matches
+    ]
+
 # ========================= COMMUNITY =========================
 
+COMMUNITY_POST_PROJECTION = TrustedProjection(CommunityPost)
+
 @api_router.post("/community", response_model=CommunityPost)
-async def create_community_post(post: CommunityPostCreate, current_user: dict = Depends(get_current_user)):
+async def create_community_post(post: CommunityPostCreate, background_tasks: BackgroundTasks, current_user: dict = Depends(get_current_user)):
     community_post = CommunityPost(
         **post.dict(),
         user_id=current_user["id"],
         user_name=current_user["name"],
         user_avatar=current_user.get("avatar")
     )
-    await db.community.insert_one(community_post.dict())
+    doc = {
+        **community_post.dict(),
+        "score": hot_score(0, 0, community_post.created_at),
+        "trending_score": decayed_score(0, community_post.created_at),
+    }
+    await db.community.insert_one(doc)
+    read_coalescer.forget("community")
+    background_tasks.add_task(fan_out_post, doc)
     return community_post
 
 @api_router.get("/community", response_model=List[CommunityPost])
-async def get_community_posts(type: Optional[str] = None, limit: int = 50, current_user: Optional[dict] = Depends(get_current_user_optional)):
+async def get_community_posts(type: Optional[str] = None, limit: int = 50, fields: Optional[str] = None, sort: str = "recent", current_user: Optional[dict] = Depends(get_current_user_optional)):
     query = {}
     if type:
         query["type"] = type
+    sort_field = "created_at"
+    if parse_sort(sort) == "trending":
+        query["created_at"] = {"$gte": trending_cutoff()}
+        sort_field = "trending_score"
 
-    # Hide posts from blocked users for the current user
-    if current_user:
-        blocked_rows = await db.blocked_users.find({"user_id": current_user["id"]}).to_list(1000)
-        blocked_ids = [r.get("blocked_user_id") for r in blocked_rows if r.get("blocked_user_id")]
-        if blocked_ids:
-            query["user_id"] = {"$nin": blocked_ids}
+    # Hide posts from users on either side of a block
+    blocks = await block_lists.get(current_user["id"]) if current_user else EMPTY_BLOCK_SET
+    post_filter = blocks.apply(query)
 
-    posts = await db.community.find(query).sort("created_at", -1).limit(limit).to_list(limit)
+    view = COMMUNITY_POST_PROJECTION.only(fields)
 
-    enriched = []
-    for p in posts:
-      clean = {k: v for k, v in p.items() if k != "_id"}
-      comments_count = await db.comments.count_documents({"post_id": clean.get("id")})
-      clean["comments_count"] = comments_count
-      clean["comments"] = comments_count
-      enriched.append(CommunityPost(**clean))
+    async def load():
+        cursor = db.community.find(query, {**view.projection, "user_id": 1, "comments": 1}).sort(sort_field, -1)
+        if post_filter:
+            posts = await collect_visible(cursor.batch_size(limit * 2), blocks, limit)
+        else:
+            posts = await cursor.limit(limit).to_list(limit)
+        for p in posts:
+            p["comments_count"] = p.get("comments", 0)
+        return posts
 
-    return enriched
+    # Anonymous feeds are identical for everyone, so bursts share one load.
+    posts = await read_coalescer.do(("community", type, limit, fields, sort), load) if not current_user else await load()
+    return view.response(posts)
 
 @api_router.get("/community/post/{post_id}", response_model=CommunityPost)
 async def get_community_post_by_id(post_id: str):
     post = await db.community.find_one({"id": post_id})
     if not post:
         raise HTTPException(status_code=404, detail="Post not found")
+    view_counters.add("community", "id", post_id, {"views": 1})
+    mark_trending("community", post_id)
 
     clean = {k: v for k, v in post.items() if k != "_id"}
     comments_count = await db.comments.count_documents({"post_id": clean.get("id")})
@@ -2210,8 +4223,11 @@ async def get_community_post_by_id(post_id: str):
 
 @api_router.post("/community/{post_id}/like")
 async def like_community_post(post_id: str, current_user: dict = Depends(get_current_user)):
-    await db.community.update_one({"id": post_id}, {"$inc": {"likes": 1}})
-    return {"message": "Liked"}
+    liked = await toggle_reaction("community_post", post_id, current_user["id"])
+    if liked is None:
+        raise HTTPException(status_code=404, detail="Post not found")
+    await rescore_post(post_id)
+    return {"message": "Liked" if liked else "Unliked", "liked": liked}
 
 @api_router.post("/community/{post_id}/report")
 async def report_community_post(post_id: str, data: dict = {}, current_user: dict = Depends(get_current_user)):
@@ -2229,6 +4245,8 @@ async def report_community_post(post_id: str, data: dict = {}, current_user: dic
         "created_at": datetime.utcnow(),
     }
     await db.community_reports.insert_one(row)
+    await db.community.update_one({"id": post_id}, {"$inc": {"reports": 1}})
+    mark_trending("community", post_id)
     return {"message": "Report submitted"}
 
 @api_router.post("/community/users/{target_user_id}/block")
@@ -2244,11 +4262,13 @@ async def block_community_user(target_user_id: str, current_user: dict = Depends
             "blocked_user_id": target_user_id,
             "created_at": datetime.utcnow(),
         })
+        await block_lists.invalidate(current_user["id"], target_user_id)
     return {"message": "User blocked"}
 
 @api_router.delete("/community/users/{target_user_id}/block")
 async def unblock_community_user(target_user_id: str, current_user: dict = Depends(get_current_user)):
     await db.blocked_users.delete_one({"user_id": current_user["id"], "blocked_user_id": target_user_id})
+    await block_lists.invalidate(current_user["id"], target_user_id)
     return {"message": "User unblocked"}
 
 @api_router.get("/community/blocked-users")
@@ -2278,15 +4298,309 @@ async def enable_post_notifications(post_id: str, current_user: dict = Depends(g
         })
     return {"message": "Notifications enabled"}
 
-@api_router.delete("/community/{post_id}/notify")
-async def disable_post_notifications(post_id: str, current_user: dict = Depends(get_current_user)):
-    await db.community_post_notifications.delete_one({"user_id": current_user["id"], "post_id": post_id})
-    return {"message": "Notifications disabled"}
+@api_router.delete("/community/{post_id}/notify")
+async def disable_post_notifications(post_id: str, current_user: dict = Depends(get_current_user)):
+    await db.community_post_notifications.delete_one({"user_id": current_user["id"], "post_id": post_id})
+    return {"message": "Notifications disabled"}
+
+@api_router.get("/community/notifications/subscriptions")
+async def get_notification_subscriptions(current_user: dict = Depends(get_current_user)):
+    rows = await db.community_post_notifications.find({"user_id": current_user["id"]}).to_list(2000)
+    return [r.get("post_id") for r in rows if r.get("post_id")]
+
+# ========================= COMMUNITY TIMELINE =========================
+#
+# The home timeline is the caller's own and friends' posts plus posts of the types
+# they follow (`followed_post_types` in user settings), ranked by `hot_score`.
+# Posts are fanned out on write into `timelines` ({user_id, post_id, author_id,
+# score}) so a page is one indexed range query on (user_id, score). Authors with
+# more than TIMELINE_FANOUT_MAX_FRIENDS friends are flagged high-degree and, like
+# followed types, pulled from `community` on read instead. Pages are keyset on
+# (score, post_id), so posts with equal scores are neither skipped nor repeated.
+# `trim_timelines` caps the timelines written to since its last run at
+# TIMELINE_MAX_ENTRIES. Engagement re-ranks a post's timeline rows in batches
+# (`flush_timeline_scores`) rather than one update_many per like. A new friendship
+# backfills each side with the other's recent posts.
+
+TIMELINE_MAX_ENTRIES = int(os.environ.get("TIMELINE_MAX_ENTRIES", "500"))
+TIMELINE_FANOUT_MAX_FRIENDS = int(os.environ.get("TIMELINE_FANOUT_MAX_FRIENDS", "1000"))
+TIMELINE_PAGE_MAX = 50
+TIMELINE_TRIM_SECONDS = float(os.environ.get("TIMELINE_TRIM_SECONDS", "3600"))
+TIMELINE_RESCORE_SECONDS = float(os.environ.get("TIMELINE_RESCORE_SECONDS", "5"))
+TIMELINE_RESCORE_BATCH = 500
+TIMELINE_TRIM_BATCH = 500
+TIMELINE_BACKFILL_POSTS = int(os.environ.get("TIMELINE_BACKFILL_POSTS", "50"))
+HIGH_DEGREE_AUTHORS_TTL_SECONDS = 60
+HOT_SCORE_DECAY_SECONDS = 45000  # 12.5h newer outweighs 10x the engagement
+HOT_SCORE_EPOCH = datetime(2024, 1, 1)
+
+def decayed_score(points: float, created_at: Optional[datetime]) -> float:
+    """Signed log10 of `points` plus a recency term; grows with time, so newer wins ties."""
+    magnitude = math.log10(max(1.0, abs(points)))
+    age = ((created_at or datetime.utcnow()) - HOT_SCORE_EPOCH).total_seconds()
+    return math.copysign(magnitude, points) + age / HOT_SCORE_DECAY_SECONDS
+
+def hot_score(likes: int, comments: int, created_at: Optional[datetime]) -> float:
+    """Timeline rank: comments count double."""
+    return decayed_score((likes or 0) + 2 * (comments or 0), created_at)
+
+def post_score(post: dict) -> float:
+    return hot_score(post.get("likes", 0), post.get("comments", 0), post.get("created_at"))
+
+async def ensure_timeline_indexes():
+    await db.timelines.create_index([("user_id", 1), ("post_id", 1)], unique=True)
+    await db.timelines.create_index([("user_id", 1), ("score", -1), ("post_id", -1)])
+    await db.timelines.create_index("post_id")
+    await db.community.create_index([("type", 1), ("score", -1), ("id", -1)])
+    await db.community.create_index([("user_id", 1), ("score", -1), ("id", -1)])
+
+def encode_score_cursor(score: float, post_id: str) -> str:
+    return f"{score!r}|{post_id}"
+
+def score_cursor_query(cursor: Optional[str], id_field: str) -> dict:
+    """Keyset filter for rows sorted by (score desc, `id_field` desc) strictly after `cursor`."""
+    if not cursor:
+        return {}
+    try:
+        score_raw, last_id = cursor.rsplit("|", 1)
+        score = float(score_raw)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return {"$or": [{"score": {"$lt": score}}, {"score": score, id_field: {"$lt": last_id}}]}
+
+timeline_trim_owners: Set[str] = set()  # timelines written to since the last trim
+
+async def write_timeline_entries(user_ids, posts: List[dict]):
+    rows = [
+        {"user_id": uid, "post_id": p["id"], "author_id": p.get("user_id"), "score": p.get("score") or post_score(p),
+         "created_at": p.get("created_at")}
+        for uid in user_ids for p in posts
+    ]
+    if not rows:
+        return
+    timeline_trim_owners.update(user_ids)
+    try:
+        await db.timelines.insert_many(rows, ordered=False)
+    except BulkWriteError:
+        pass  # entries already present from a retried or overlapping fan-out
+
+async def fan_out_post(post: dict):
+    author_id = post["user_id"]
+    friend_ids = await get_friend_ids_set(author_id)
+    recipients = {author_id}
+    if len(friend_ids) > TIMELINE_FANOUT_MAX_FRIENDS:
+        await db.users.update_one({"id": author_id}, {"$set": {"timeline_high_degree": True}})
+    else:
+        recipients |= friend_ids
+    await write_timeline_entries(recipients, [post])
+
+async def rescore_post(post_id: str):
+    post = await db.community.find_one({"id": post_id}, {"_id": 0, "likes": 1, "comments": 1, "created_at": 1})
+    if not post:
+        return
+    score = post_score(post)
+    await db.community.update_one({"id": post_id}, {"$set": {"score": score}})
+    timeline_rescores[post_id] = score
+    mark_trending("community", post_id)
+
+timeline_rescores: Dict[str, float] = {}  # post_id -> latest score, not yet copied to its timeline rows
+
+@periodic_job("flush_timeline_scores", TIMELINE_RESCORE_SECONDS)
+async def flush_timeline_scores():
+    scores = list(timeline_rescores.items())
+    timeline_rescores.clear()
+    for start in range(0, len(scores), TIMELINE_RESCORE_BATCH):
+        batch = scores[start:start + TIMELINE_RESCORE_BATCH]
+        try:
+            await db.timelines.bulk_write(
+                [UpdateMany({"post_id": post_id}, {"$set": {"score": score}}) for post_id, score in batch], ordered=False,
+            )
+        except Exception as e:
+            logger.warning(f"Timeline rescore failed, requeued: {e}")
+            for post_id, score in batch:
+                timeline_rescores.setdefault(post_id, score)  # a newer score may have arrived meanwhile
+
+high_degree_cache = {"loaded_at": float("-inf"), "ids": frozenset()}
+
+async def high_degree_authors() -> frozenset:
+    if time.monotonic() - high_degree_cache["loaded_at"] >= HIGH_DEGREE_AUTHORS_TTL_SECONDS:
+        rows = await db.users.find({"timeline_high_degree": True}, {"_id": 0, "id": 1}).to_list(None)
+        high_degree_cache.update(loaded_at=time.monotonic(), ids=frozenset(r["id"] for r in rows))
+    return high_degree_cache["ids"]
+
+async def warm_timeline(user_id: str) -> int:
+    """Materialise a first timeline from recent own/friends' posts (users who predate fan-out).
+
+    Runs once per user: fan-out keeps the timeline current afterwards, even when
+    there was nothing to warm it with.
+    """
+    authors = [user_id, *await get_friend_ids_set(user_id)]
+    posts = await db.community.find(
+        {"user_id": {"$in": authors}}, {"_id": 0, "id": 1, "user_id": 1, "likes": 1, "comments": 1, "score": 1, "created_at": 1},
+    ).sort("created_at", -1).limit(TIMELINE_MAX_ENTRIES).to_list(TIMELINE_MAX_ENTRIES)
+    await write_timeline_entries([user_id], posts)
+    await db.users.update_one({"id": user_id}, {"$set": {"timeline_warmed": True}})
+    return len(posts)
+
+async def backfill_friend_timelines(user_id: str, friend_id: str):
+    """Give each side of a new friendship the other's recent posts; fan-out only covers posts made afterwards."""
+    hd_authors = await high_degree_authors()
+    for owner, author in ((user_id, friend_id), (friend_id, user_id)):
+        if author in hd_authors:
+            continue  # pulled on read
+        posts = await db.community.find(
+            {"user_id": author}, {"_id": 0, "id": 1, "user_id": 1, "likes": 1, "comments": 1, "score": 1, "created_at": 1},
+        ).sort("created_at", -1).limit(TIMELINE_BACKFILL_POSTS).to_list(TIMELINE_BACKFILL_POSTS)
+        await write_timeline_entries([owner], posts)
+
+@periodic_job("trim_timelines", TIMELINE_TRIM_SECONDS)
+async def trim_timelines():
+    owners = sorted(timeline_trim_owners)
+    timeline_trim_owners.clear()
+    for start in range(0, len(owners), TIMELINE_TRIM_BATCH):
+        batch = owners[start:start + TIMELINE_TRIM_BATCH]
+        try:
+            over = await db.timelines.aggregate([
+                {"$match": {"user_id": {"$in": batch}}},
+                {"$group": {"_id": "$user_id", "entries": {"$sum": 1}}},
+                {"$match": {"entries": {"$gt": TIMELINE_MAX_ENTRIES}}},
+            ]).to_list(None)
+            for row in over:
+                edge = await db.timelines.find({"user_id": row["_id"]}, {"_id": 0, "score": 1}).sort("score", -1).skip(TIMELINE_MAX_ENTRIES).limit(1).to_list(1)
+                if edge:
+                    await db.timelines.delete_many({"user_id": row["_id"], "score": {"$lte": edge[0]["score"]}})
+        except Exception as e:
+            logger.warning(f"Timeline trim failed, requeued: {e}")
+            timeline_trim_owners.update(batch)
+
+@api_router.get("/community/timeline")
+async def get_community_timeline(limit: int = 20, cursor: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    """Ranked home timeline; pass `next_cursor` back as `cursor` for the next page."""
+    user_id = current_user["id"]
+    limit = max(1, min(limit, TIMELINE_PAGE_MAX))
+    entry_query = {"user_id": user_id, **score_cursor_query(cursor, "post_id")}
+
+    async def read_entries():
+        return await db.timelines.find(entry_query, {"_id": 0, "post_id": 1, "score": 1}).sort(
+            [("score", -1), ("post_id", -1)]).limit(limit).to_list(limit)
+
+    settings, entries, hd_authors, blocks = await asyncio.gather(
+        db.user_settings.find_one({"user_id": user_id}, {"_id": 0, "followed_post_types": 1}),
+        read_entries(),
+        high_degree_authors(),
+        block_lists.get(user_id),
+    )
+    if not entries and cursor is None and not current_user.get("timeline_warmed") and await warm_timeline(user_id):
+        entries = await read_entries()
+
+    pull = []
+    followed = (settings or {}).get("followed_post_types") or []
+    if followed:
+        pull.append({"type": {"$in": followed}})
+    if hd_authors:
+        pulled_authors = (await get_friend_ids_set(user_id) | {user_id}) & hd_authors
+        if pulled_authors:
+            pull.append({"user_id": {"$in": sorted(pulled_authors)}})
+    ranked = {row["post_id"]: row["score"] for row in entries}
+    if pull:
+        pull_query = {"$or": pull}
+        if cursor:
+            pull_query = {"$and": [pull_query, score_cursor_query(cursor, "id")]}
+        pulled = await db.community.find(pull_query, {"_id": 0, "id": 1, "score": 1}).sort(
+            [("score", -1), ("id", -1)]).limit(limit).to_list(limit)
+        for row in pulled:
+            ranked.setdefault(row["id"], row.get("score") or 0)
+
+    page = sorted(ranked.items(), key=lambda item: (item[1], item[0]), reverse=True)[:limit]
+    projection = {**COMMUNITY_POST_PROJECTION.projection, "comments": 1}
+    posts = await db.community.find({"id": {"$in": [post_id for post_id, _ in page]}}, projection).to_list(limit)
+    by_id = {p["id"]: p for p in posts}
+
+    items = []
+    for post_id, score in page:
+        post = by_id.get(post_id)
+        if not post or blocks.hides(post.get("user_id")):
+            continue
+        post["comments_count"] = post.get("comments", 0)
+        items.append({**COMMUNITY_POST_PROJECTION.row(post), "score": score})
+    return {"items": items, "next_cursor": encode_score_cursor(page[-1][1], page[-1][0]) if len(page) == limit else None}
+
+# ========================= TRENDING =========================
+#
+# `trending_score` is a decayed hot score over an item's own counters (likes,
+# comments, views; reports count against it), stored on the item and indexed so
+# `sort=trending` is an index walk. As with `hot_score` the decay is a recency
+# term fixed at creation, so scores only change when counters move: writers call
+# `mark_trending` and `refresh_trending_scores` rescores just those items. Items
+# older than TRENDING_WINDOW_HOURS slide out of the window and lose their score.
+
+TRENDING_WINDOW_HOURS = float(os.environ.get("TRENDING_WINDOW_HOURS", "72"))
+TRENDING_REFRESH_SECONDS = float(os.environ.get("TRENDING_REFRESH_SECONDS", "60"))
+TRENDING_BATCH = 500
+
+TRENDING_TARGETS = {
+    # collection -> weight per counter field on the item
+    "community": {"likes": 1.0, "comments": 2.0, "views": 0.05, "reports": -5.0},
+    "marketplace_listings": {"views": 0.1, "reports": -5.0},
+}
+
+trending_dirty: Dict[str, Set[str]] = {collection: set() for collection in TRENDING_TARGETS}
+
+def trending_score(collection: str, item: dict) -> float:
+    points = sum(weight * (item.get(field) or 0) for field, weight in TRENDING_TARGETS[collection].items())
+    return decayed_score(points, item.get("created_at"))
+
+def trending_cutoff() -> datetime:
+    return datetime.utcnow() - timedelta(hours=TRENDING_WINDOW_HOURS)
 
-@api_router.get("/community/notifications/subscriptions")
-async def get_notification_subscriptions(current_user: dict = Depends(get_current_user)):
-    rows = await db.community_post_notifications.find({"user_id": current_user["id"]}).to_list(2000)
-    return [r.get("post_id") for r in rows if r.get("post_id")]
+def mark_trending(collection: str, item_id: str):
+    trending_dirty[collection].add(item_id)
+
+def parse_sort(sort: str) -> str:
+    if sort not in ("recent", "trending"):
+        raise HTTPException(status_code=400, detail=error_detail("INVALID_SORT", "sort must be recent or trending"))
+    return sort
+
+async def ensure_trending_indexes():
+    await db.community.create_index([("trending_score", -1)])
+    await db.community.create_index([("type", 1), ("trending_score", -1)])
+    await db.marketplace_listings.create_index([("status", 1), ("trending_score", -1)])
+
+async def backfill_trending_scores() -> int:
+    """One-off: score items in the window from before scoring existed (scripts/backfill_derived_fields.py)."""
+    scored = 0
+    for collection, weights in TRENDING_TARGETS.items():
+        cursor = db[collection].find(
+            {"trending_score": {"$exists": False}, "created_at": {"$gte": trending_cutoff()}},
+            mongo_projection("id", "created_at", *weights),
+        )
+        ops = [UpdateOne({"id": r["id"]}, {"$set": {"trending_score": trending_score(collection, r)}}) async for r in cursor]
+        for start in range(0, len(ops), TRENDING_BATCH):
+            await db[collection].bulk_write(ops[start:start + TRENDING_BATCH], ordered=False)
+        scored += len(ops)
+    return scored
+
+@periodic_job("refresh_trending_scores", TRENDING_REFRESH_SECONDS)
+async def refresh_trending_scores():
+    await view_counters.flush()  # score the views buffered so far
+    cutoff = trending_cutoff()
+    for collection, weights in TRENDING_TARGETS.items():
+        ids, trending_dirty[collection] = list(trending_dirty[collection]), set()
+        for start in range(0, len(ids), TRENDING_BATCH):
+            batch = ids[start:start + TRENDING_BATCH]
+            try:
+                rows = await db[collection].find(
+                    {"id": {"$in": batch}, "created_at": {"$gte": cutoff}}, mongo_projection("id", "created_at", *weights),
+                ).to_list(None)
+                ops = [UpdateOne({"id": r["id"]}, {"$set": {"trending_score": trending_score(collection, r)}}) for r in rows]
+                if ops:
+                    await db[collection].bulk_write(ops, ordered=False)
+            except Exception as e:
+                logger.warning(f"Trending refresh for {collection} failed, requeued: {e}")
+                trending_dirty[collection].update(batch)
+        await db[collection].update_many(
+            {"trending_score": {"$exists": True}, "created_at": {"$lt": cutoff}}, {"$unset": {"trending_score": ""}},
+        )
 
 # ========================= COMMUNITY COMMENTS =========================
 
@@ -2317,6 +4631,7 @@ async def create_comment(post_id: str, comment: CommentCreate, current_user: dic
     )
     await db.comments.insert_one(new_comment.dict())
     await db.community.update_one({"id": post_id}, {"$inc": {"comments": 1}})
+    await rescore_post(post_id)
     return new_comment
 
 @api_router.get("/community/{post_id}/comments", response_model=List[Comment])
@@ -2326,10 +4641,10 @@ async def get_comments(post_id: str):
 
 @api_router.post('/community/comments/{comment_id}/like')
 async def like_comment(comment_id: str, current_user: dict = Depends(get_current_user)):
-    result = await db.comments.update_one({'id': comment_id}, {'$inc': {'likes': 1}})
-    if result.matched_count == 0:
+    liked = await toggle_reaction("comment", comment_id, current_user["id"])
+    if liked is None:
         raise HTTPException(status_code=404, detail='Comment not found')
-    return {'message': 'Comment liked'}
+    return {'message': 'Comment liked' if liked else 'Comment unliked', 'liked': liked}
 
 # ========================= HEALTH RECORDS =========================
 
@@ -2392,6 +4707,15 @@ async def delete_health_record(record_id: str, current_user: dict = Depends(get_
 @api_router.post("/favorites/{item_type}/{item_id}")
 async def add_favorite(item_type: str, item_id: str, current_user: dict = Depends(get_current_user)):
     """Add pet or product to favorites. item_type: 'pet' or 'product'"""
+    if item_type == "pet":
+        # A favorite pet is a liked pet: same row, and `pets.likes` moves with it.
+        existing = await db.favorites.find_one({"user_id": current_user["id"], "item_type": "pet", "item_id": item_id})
+        if existing:
+            return {"message": "Already in favorites", "is_favorite": True}
+        if await set_reaction("pet", item_id, current_user["id"], True, extra={"pet_id": item_id}) is None:
+            raise HTTPException(status_code=404, detail="Pet not found")
+        return {"message": "Added to favorites", "is_favorite": True}
+
     favorite = {
         "id": str(uuid.uuid4()),
         "user_id": current_user["id"],
@@ -2408,11 +4732,17 @@ async def add_favorite(item_type: str, item_id: str, current_user: dict = Depend
     if existing:
         return {"message": "Already in favorites", "is_favorite": True}
     
-    await db.favorites.insert_one(favorite)
+    try:
+        await db.favorites.insert_one(favorite)
+    except DuplicateKeyError:
+        return {"message": "Already in favorites", "is_favorite": True}
     return {"message": "Added to favorites", "is_favorite": True}
 
 @api_router.delete("/favorites/{item_type}/{item_id}")
 async def remove_favorite(item_type: str, item_id: str, current_user: dict = Depends(get_current_user)):
+    if item_type == "pet":
+        await set_reaction("pet", item_id, current_user["id"], False)
+        return {"message": "Removed from favorites", "is_favorite": False}
     await db.favorites.delete_one({
         "user_id": current_user["id"],
         "item_type": item_type,
@@ -2508,6 +4838,8 @@ class MarketplaceListing(BaseModel):
     status: str = "active"  # active, sold, archived
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
+LISTING_PROJECTION = TrustedProjection(MarketplaceListing)
+
 @api_router.post("/sponsorships")
 async def create_sponsorship(sponsorship: SponsorshipCreate, current_user: dict = Depends(get_current_user)):
     new_sponsorship = Sponsorship(
@@ -2581,7 +4913,7 @@ async def create_marketplace_listing(payload: MarketplaceListingCreate, current_
         user_name=current_user.get("name", "User"),
         user_avatar=current_user.get("avatar")
     )
-    await db.marketplace_listings.insert_one(listing.dict())
+    await db.marketplace_listings.insert_one({**listing.dict(), "trending_score": decayed_score(0, listing.created_at)})
     return listing
 
 @api_router.get("/marketplace/listings", response_model=List[MarketplaceListing])
@@ -2591,9 +4923,15 @@ async def get_marketplace_listings(
     city: Optional[str] = None,
     min_price: Optional[float] = None,
     max_price: Optional[float] = None,
+    fields: Optional[str] = None,
+    sort: str = "recent",
     current_user: Optional[dict] = Depends(get_current_user_optional),
 ):
     query: dict = {"status": {"$in": ["active", "sold"]}}
+    sort_field = "created_at"
+    if parse_sort(sort) == "trending":
+        query["created_at"] = {"$gte": trending_cutoff()}
+        sort_field = "trending_score"
     if category and category != "all":
         query["category"] = category
     if city:
@@ -2606,13 +4944,18 @@ async def get_marketplace_listings(
             rng["$lte"] = max_price
         query["price"] = rng
 
-    if current_user:
-        blocked_rows = await db.blocked_users.find({"user_id": current_user["id"]}).to_list(1000)
-        blocked_ids = [r.get("blocked_user_id") for r in blocked_rows if r.get("blocked_user_id")]
-        if blocked_ids:
-            query["user_id"] = {"$nin": blocked_ids}
+    blocks = await block_lists.get(current_user["id"]) if current_user else EMPTY_BLOCK_SET
+    post_filter = blocks.apply(query)
 
-    rows = await db.marketplace_listings.find(query).sort("created_at", -1).to_list(200)
+    view = LISTING_PROJECTION.only(fields)
+    projection = {**view.projection, "user_id": 1}
+    if q:
+        projection.update(mongo_projection("title", "description", "location"))
+    cursor = db.marketplace_listings.find(query, projection).sort(sort_field, -1)
+    if post_filter:
+        rows = await collect_visible(cursor.batch_size(400), blocks, 200)
+    else:
+        rows = await cursor.to_list(200)
 
     if q:
         ql = q.lower().strip()
@@ -2621,20 +4964,21 @@ async def get_marketplace_listings(
             if ql in f"{r.get('title','')} {r.get('description','')} {r.get('location','')}".lower()
         ]
 
-    clean_rows = [{k: v for k, v in r.items() if k != "_id"} for r in rows]
-    return [MarketplaceListing(**r) for r in clean_rows]
+    return view.response(rows)
 
 @api_router.get("/marketplace/listings/my", response_model=List[MarketplaceListing])
-async def get_my_marketplace_listings(current_user: dict = Depends(get_current_user)):
-    rows = await db.marketplace_listings.find({"user_id": current_user["id"]}).sort("created_at", -1).to_list(200)
-    clean_rows = [{k: v for k, v in r.items() if k != "_id"} for r in rows]
-    return [MarketplaceListing(**r) for r in clean_rows]
+async def get_my_marketplace_listings(fields: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    view = LISTING_PROJECTION.only(fields)
+    rows = await db.marketplace_listings.find({"user_id": current_user["id"]}, view.projection).sort("created_at", -1).to_list(200)
+    return view.response(rows)
 
 @api_router.get("/marketplace/listings/{listing_id}", response_model=MarketplaceListing)
 async def get_marketplace_listing_by_id(listing_id: str):
     row = await db.marketplace_listings.find_one({"id": listing_id})
     if not row:
         raise HTTPException(status_code=404, detail="Listing not found")
+    view_counters.add("marketplace_listings", "id", listing_id, {"views": 1})
+    mark_trending("marketplace_listings", listing_id)
     clean_row = {k: v for k, v in row.items() if k != "_id"}
     return MarketplaceListing(**clean_row)
 
@@ -2698,6 +5042,8 @@ async def report_marketplace_listing(listing_id: str, data: dict = {}, current_u
         "notes": data.get("notes"),
         "created_at": datetime.utcnow(),
     })
+    await db.marketplace_listings.update_one({"id": listing_id}, {"$inc": {"reports": 1}})
+    mark_trending("marketplace_listings", listing_id)
     return {"message": "Report submitted"}
 
 # ========================= CARE REQUESTS / ROLE MODULES =========================
@@ -2909,8 +5255,9 @@ async def get_care_request_timeline(request_id: str, current_user: dict = Depend
         if uid not in allowed:
             raise HTTPException(status_code=403, detail="Access denied")
 
+    archived = await db.care_request_events_archive.find({"request_id": request_id}).sort("created_at", 1).to_list(300)
     events = await db.care_request_events.find({"request_id": request_id}).sort("created_at", 1).to_list(300)
-    return [{k: v for k, v in e.items() if k != "_id"} for e in events]
+    return [{k: v for k, v in e.items() if k != "_id"} for e in archived + events]
 
 @api_router.get("/market-owner/overview")
 async def get_market_owner_overview(current_user: dict = Depends(require_roles("market_owner"))):
@@ -2957,6 +5304,76 @@ class TagScan(BaseModel):
     message: Optional[str] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
+# A scan resolves through `tag_cards`: the tag plus the pre-joined public pet and
+# owner card, cached per code (misses included) so a burst on one shared QR code
+# is served from memory. Tag, pet and profile writes invalidate the affected codes
+# and bump the shared `catalog_versions` "pet_tags" version for other workers.
+# Scan counts and last-seen fields go through `view_counters`; reported scans are written directly.
+
+TAG_CACHE_TTL_SECONDS = float(os.environ.get("TAG_CACHE_TTL_SECONDS", "300"))
+TAG_CACHE_VERSION_CHECK_SECONDS = float(os.environ.get("TAG_CACHE_VERSION_CHECK_SECONDS", "5"))
+TAG_CACHE_MAX_ENTRIES = int(os.environ.get("TAG_CACHE_MAX_ENTRIES", "10000"))
+
+def public_tag_card(tag: dict, pet: Optional[dict], owner: Optional[dict]) -> dict:
+    return {
+        "pet": {
+            "name": pet["name"] if pet else "Unknown",
+            "species": pet.get("species") if pet else None,
+            "breed": pet.get("breed") if pet else None,
+            "image": pet.get("image") if pet else None,
+            "description": pet.get("description") if pet else None,
+        },
+        "owner": {
+            "name": owner["name"] if owner else "Unknown",
+            "phone": owner.get("phone") if owner else None,
+            "city": owner.get("city") if owner else None,
+        },
+        "tag": {k: v for k, v in tag.items() if k != '_id'}
+    }
+
+class TagCardCache(VersionedCache):
+    def __init__(self, ttl_seconds: float, version_check_seconds: float, max_entries: int):
+        super().__init__("pet_tags", ttl_seconds, version_check_seconds, max_entries)  # tag_code -> {"tag", "card"} or None
+
+    async def get(self, tag_code: str) -> Optional[dict]:
+        """The tag and, when it is active, its public card; None for unknown codes."""
+        await self._sync_version()
+        entry = self.lookup(tag_code)
+        if entry is not None:
+            return entry[1]
+
+        async def load():
+            tag = await db.pet_tags.find_one({"tag_code": tag_code}, {"_id": 0})
+            if not tag:
+                return None
+            if not tag.get("is_active"):
+                return {"tag": tag, "card": None}
+            pet, owner = await asyncio.gather(
+                db.pets.find_one({"id": tag["pet_id"]}, {"_id": 0, "name": 1, "species": 1, "breed": 1, "image": 1, "description": 1}),
+                db.users.find_one({"id": tag["owner_id"], "deleted_at": None}, {"_id": 0, "name": 1, "phone": 1, "city": 1}),
+            )
+            return {"tag": tag, "card": public_tag_card(tag, pet, owner)}
+
+        generation = self.generation
+        resolved = await read_coalescer.do(("pet_tag_scan", tag_code), load)
+        self.store(tag_code, resolved, generation)
+        return resolved
+
+    async def invalidate(self, *tag_codes: str):
+        if not tag_codes:
+            return
+        self.drop(*tag_codes)
+        for tag_code in tag_codes:
+            read_coalescer.forget("pet_tag_scan", tag_code)
+        await self.bump()
+
+    async def invalidate_where(self, query: dict):
+        """Drop the cards of every tag matching `query` (a pet's or an owner's tags)."""
+        rows = await db.pet_tags.find(query, {"_id": 0, "tag_code": 1}).to_list(None)
+        await self.invalidate(*[r["tag_code"] for r in rows if r.get("tag_code")])
+
+tag_cards = TagCardCache(TAG_CACHE_TTL_SECONDS, TAG_CACHE_VERSION_CHECK_SECONDS, TAG_CACHE_MAX_ENTRIES)
+
 @api_router.post("/pet-tags")
 async def register_pet_tag(tag: PetTagCreate, current_user: dict = Depends(get_current_user)):
     # Verify pet belongs to user
@@ -2982,6 +5399,7 @@ async def register_pet_tag(tag: PetTagCreate, current_user: dict = Depends(get_c
             {"id": existing_code["id"]},
             {"$set": {"pet_id": tag.pet_id, "is_active": True}}
         )
+        await tag_cards.invalidate(normalized_code)
         updated = await db.pet_tags.find_one({"id": existing_code["id"]})
         return {**updated, "message": "Tag activated"}
 
@@ -2997,6 +5415,7 @@ async def register_pet_tag(tag: PetTagCreate, current_user: dict = Depends(get_c
         await db.pet_tags.delete_one({"id": existing_pet_tag["id"]})
 
     await db.pet_tags.insert_one(new_tag.dict())
+    await tag_cards.invalidate(normalized_code, *([existing_pet_tag["tag_code"]] if existing_pet_tag else []))
     return {**new_tag.dict(), "message": "Tag registered and activated"}
 
 @api_router.get("/pet-tags/{pet_id}")
@@ -3013,6 +5432,7 @@ async def set_pet_tag_status(pet_id: str, data: dict = Body(default={}), current
         raise HTTPException(status_code=404, detail='Tag not found')
     is_active = bool(data.get('is_active', True))
     await db.pet_tags.update_one({"id": tag["id"]}, {"$set": {"is_active": is_active}})
+    await tag_cards.invalidate(tag["tag_code"])
     updated = await db.pet_tags.find_one({"id": tag["id"]})
     return {k: v for k, v in updated.items() if k != '_id'}
 
@@ -3020,41 +5440,20 @@ async def set_pet_tag_status(pet_id: str, data: dict = Body(default={}), current
 async def scan_pet_tag(tag_code: str):
     """Public endpoint - anyone can scan a tag"""
     tag_code = tag_code.upper()
-    tag = await db.pet_tags.find_one({"tag_code": tag_code, "is_active": True})
-    if not tag:
+    resolved = await tag_cards.get(tag_code)
+    if not resolved or not resolved["card"]:
         raise HTTPException(status_code=404, detail="Tag not found or inactive")
-    
-    pet = await db.pets.find_one({"id": tag["pet_id"]})
-    owner = await db.users.find_one({"id": tag["owner_id"]})
-    
-    # Increment scan count
-    await db.pet_tags.update_one(
-        {"tag_code": tag_code},
-        {"$inc": {"scan_count": 1}, "$set": {"last_scanned": datetime.utcnow()}}
-    )
-    
-    return {
-        "pet": {
-            "name": pet["name"] if pet else "Unknown",
-            "species": pet.get("species") if pet else None,
-            "breed": pet.get("breed") if pet else None,
-            "image": pet.get("image") if pet else None,
-            "description": pet.get("description") if pet else None,
-        },
-        "owner": {
-            "name": owner["name"] if owner else "Unknown",
-            "phone": owner.get("phone") if owner else None,
-            "city": owner.get("city") if owner else None,
-        },
-        "tag": {k: v for k, v in tag.items() if k != '_id'}
-    }
+
+    view_counters.add("pet_tags", "tag_code", tag_code, {"scan_count": 1}, {"last_scanned": datetime.utcnow()})
+    return resolved["card"]
 
 @api_router.post("/pet-tags/scan/{tag_code}/report")
-async def report_tag_scan(tag_code: str, data: dict = Body(default={})):
+async def report_tag_scan(tag_code: str, background_tasks: BackgroundTasks, data: dict = Body(default={})):
     """Report a found pet via tag scan"""
-    tag = await db.pet_tags.find_one({"tag_code": tag_code.upper()})
-    if not tag:
+    resolved = await tag_cards.get(tag_code.upper())
+    if not resolved:
         raise HTTPException(status_code=404, detail="Tag not found")
+    tag = resolved["tag"]
 
     scan = TagScan(
         tag_code=tag_code.upper(),
@@ -3066,24 +5465,24 @@ async def report_tag_scan(tag_code: str, data: dict = Body(default={})):
         longitude=data.get('longitude'),
         message=data.get('message')
     )
+    # Written right away: the matcher and the owner's match list look the scan up by id.
     await db.tag_scans.insert_one(scan.dict())
     
     # Update tag with last location
-    await db.pet_tags.update_one(
-        {"tag_code": tag_code.upper()},
-        {"$set": {"last_location": data.get('location'), "last_scanned": datetime.utcnow()}}
-    )
+    view_counters.add("pet_tags", "tag_code", tag_code.upper(), {}, {"last_scanned": scan.created_at}, {"last_location": data.get('location')})
+    background_tasks.add_task(match_tag_scan, scan.dict(), tag)
     
     return {"message": "Scan reported successfully", "scan_id": scan.id}
 
 @api_router.get("/pet-tags/{pet_id}/scans")
-async def get_tag_scans(pet_id: str, current_user: dict = Depends(get_current_user)):
-    """Get scan history for a pet's tag"""
+async def get_tag_scans(pet_id: str, archived: bool = False, current_user: dict = Depends(get_current_user)):
+    """Get scan history for a pet's tag (`archived=true` reads the cold tier)"""
     tag = await db.pet_tags.find_one({"pet_id": pet_id, "owner_id": current_user["id"]})
     if not tag:
         raise HTTPException(status_code=404, detail="Tag not found")
     
-    scans = await db.tag_scans.find({"pet_id": pet_id}).sort("created_at", -1).to_list(50)
+    collection = db.tag_scans_archive if archived else db.tag_scans
+    scans = await collection.find({"pet_id": pet_id}).sort("created_at", -1).to_list(50)
     return [{k: v for k, v in s.items() if k != '_id'} for s in scans]
 
 # ========================= AI ASSISTANT =========================
@@ -3264,6 +5663,9 @@ async def seed_data():
         existing = await db.emergency_contacts.find_one({"name": contact["name"]})
         if not existing:
             await db.emergency_contacts.insert_one(EmergencyContact(**contact).dict())
+
+    for collection in ("vets", "products", "emergency_contacts"):
+        await catalog_responses.invalidate(collection)
     
     # Seed Sample Pets for Adoption
     sample_pets = [
@@ -3317,112 +5719,247 @@ async def get_payment_config():
         "points_redemption_rate": 100,  # 100 points = $1 discount
     }
 
+# Allowed status transitions; every status change goes through `transition_payment`.
+PAYMENT_TRANSITIONS: Dict[str, Set[str]] = {
+    "pending": {"processing", "succeeded", "failed", "cancelled"},
+    "processing": {"succeeded", "failed"},
+    "succeeded": set(),
+    "failed": set(),
+    "cancelled": set(),
+}
+PAYMENT_IDEMPOTENCY_TTL_HOURS = int(os.environ.get("PAYMENT_IDEMPOTENCY_TTL_HOURS", "24"))
+PAYMENT_IDEMPOTENCY_LEASE_SECONDS = int(os.environ.get("PAYMENT_IDEMPOTENCY_LEASE_SECONDS", "120"))
+PAYMENT_PROCESSOR_LATENCY_MS = int(os.environ.get("PAYMENT_PROCESSOR_LATENCY_MS", "0"))
+PAYMENT_PROCESSOR_FAILURE_RATE = float(os.environ.get("PAYMENT_PROCESSOR_FAILURE_RATE", "0"))
+
+class SimulatedPaymentProcessor:
+    """Stand-in for the external processors.
+
+    Produces the method-specific fields the app expects and the initial payment status.
+    `latency_ms` and `failure_rate` let load tests model a slow or flaky processor.
+    """
+
+    def __init__(self, latency_ms: int = 0, failure_rate: float = 0.0):
+        self.latency_ms = latency_ms
+        self.failure_rate = failure_rate
+
+    async def authorize(self, method: str, amount: float) -> dict:
+        if self.latency_ms:
+            await asyncio.sleep(self.latency_ms / 1000)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise HTTPException(status_code=402, detail=error_detail("PAYMENT_DECLINED", "Payment was declined"))
+
+        if method == "stripe":
+            # In production, use real Stripe API:
+            # stripe.api_key = STRIPE_SECRET_KEY
+            # payment_intent = stripe.PaymentIntent.create(...)
+            return {
+                "status": "pending",
+                "stripe_client_secret": f"pi_{uuid.uuid4().hex[:24]}_secret_{uuid.uuid4().hex[:24]}",
+                "message": "Stripe payment initiated",
+            }
+        if method == "paypal":
+            return {
+                "status": "pending",
+                "paypal_order_id": f"PAYPAL-{uuid.uuid4().hex[:16].upper()}",
+                "message": "PayPal payment initiated",
+            }
+        if method == "shamcash":
+            # Generate QR code data for ShamCash
+            qr_data = {
+                "merchant_id": "PETSY_MERCHANT_001",
+                "amount": amount,
+                "currency": "USD",
+                "reference": str(uuid.uuid4()),
+                "timestamp": datetime.utcnow().isoformat()
+            }
+            return {
+                "status": "pending",
+                "shamcash_qr_data": str(qr_data),
+                "shamcash_reference": qr_data["reference"],
+                "message": "ShamCash QR generated",
+            }
+        if method == "cash_on_delivery":
+            return {"status": "succeeded", "message": "Cash on delivery confirmed"}
+        raise HTTPException(status_code=400, detail=error_detail("PAYMENT_METHOD_UNSUPPORTED", f"Unsupported payment method: {method}"))
+
+payment_processor = SimulatedPaymentProcessor(PAYMENT_PROCESSOR_LATENCY_MS, PAYMENT_PROCESSOR_FAILURE_RATE)
+
+async def ensure_payment_indexes():
+    await db.payment_idempotency.create_index([("user_id", 1), ("key", 1)], unique=True)
+    await ensure_ttl_index(
+        db.payment_idempotency, "created_at", PAYMENT_IDEMPOTENCY_TTL_HOURS * 3600, "payment_idempotency_ttl",
+    )
+    await db.payments.create_index("id", unique=True)
+
+async def transition_payment(payment_id: str, to_status: str, session=None, **fields) -> bool:
+    """Move a payment to `to_status` if its current status allows it. Returns False otherwise."""
+    allowed_from = [s for s, targets in PAYMENT_TRANSITIONS.items() if to_status in targets]
+    result = await db.payments.update_one(
+        {"id": payment_id, "status": {"$in": allowed_from}},
+        {"$set": {"status": to_status, f"{to_status}_at": datetime.utcnow(), **fields}},
+        session=session,
+    )
+    return bool(result.modified_count)
+
+def payment_request_hash(payment: PaymentRequest) -> str:
+    # Card details are never part of the fingerprint (or stored).
+    fingerprint = payment.dict(exclude={"card_number", "card_expiry", "card_cvc", "idempotency_key"})
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True, default=str).encode()).hexdigest()
+
+async def claim_idempotency_key(user_id: str, key: str, request_hash: str) -> Optional[dict]:
+    """Reserve `key` for this request. Returns the stored response if the key was already completed.
+
+    A claim holds a lease; a retry may take over an `in_progress` key whose lease
+    expired, unless the crashed attempt had started writing its ledger entries.
+    Such keys, and keys whose attempt failed half-way, are `failed` and wait for
+    reconciliation instead of being charged again.
+    """
+    now = datetime.utcnow()
+    lease_until = now + timedelta(seconds=PAYMENT_IDEMPOTENCY_LEASE_SECONDS)
+    try:
+        await db.payment_idempotency.insert_one({
+            "user_id": user_id,
+            "key": key,
+            "request_hash": request_hash,
+            "status": "in_progress",
+            "lease_until": lease_until,
+            "created_at": now,
+        })
+        return None
+    except DuplicateKeyError:
+        existing = await db.payment_idempotency.find_one({"user_id": user_id, "key": key}, {"_id": 0})
+    if not existing:
+        # Expired between the insert and the read; treat as a fresh claim.
+        return await claim_idempotency_key(user_id, key, request_hash)
+    if existing.get("request_hash") != request_hash:
+        raise HTTPException(status_code=422, detail=error_detail("IDEMPOTENCY_KEY_REUSED", "Idempotency key was used for a different payment"))
+    if existing.get("status") == "completed":
+        return existing["response"]
+
+    expired = existing.get("status") == "in_progress" and (existing.get("lease_until") or existing.get("created_at") or now) <= now
+    if expired and existing.get("writes_started"):
+        await db.payment_idempotency.update_one(
+            {"user_id": user_id, "key": key, "status": "in_progress"},
+            {"$set": {"status": "failed", "error": "lease expired during ledger writes", "failed_at": now}},
+        )
+        existing["status"] = "failed"
+    elif expired:
+        taken = await db.payment_idempotency.find_one_and_update(
+            {"user_id": user_id, "key": key, "status": "in_progress", "lease_until": existing.get("lease_until")},
+            {"$set": {"lease_until": lease_until}},
+        )
+        if taken:
+            return None
+    if existing.get("status") == "failed":
+        raise HTTPException(status_code=409, detail=error_detail("PAYMENT_NEEDS_RECONCILIATION", "A payment with this idempotency key failed part-way and is being reconciled"))
+    raise HTTPException(status_code=409, detail=error_detail("PAYMENT_IN_PROGRESS", "A payment with this idempotency key is in progress"))
+
 @api_router.post("/payments/process")
-async def process_payment(payment: PaymentRequest, current_user: dict = Depends(get_current_user)):
-    """Process a payment"""
+async def process_payment(
+    payment: PaymentRequest,
+    current_user: dict = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
+    """Process a payment.
+
+    Retries carrying the same idempotency key replay the first response instead of
+    charging again. Points and the payment record are written in one transaction.
+    """
+    user_id = current_user["id"]
+    key = idempotency_key or payment.idempotency_key
+    if key:
+        replay = await claim_idempotency_key(user_id, key, payment_request_hash(payment))
+        if replay is not None:
+            return replay
+
+    partial: List[str] = []  # non-transactional writes that already landed
+    payment_id = None
     try:
         # Calculate final amount after points discount
         points_discount = payment.points_to_use / 100  # 100 points = $1
         final_amount = max(0, payment.amount - points_discount)
-        
-        # Simulate payment processing based on method
+        processor_result = await payment_processor.authorize(payment.payment_method, final_amount)
+        initial_status = processor_result.pop("status")
+
+        payment_id = str(uuid.uuid4())
+        points_earned = int(final_amount)  # 1 point per $1 spent
         payment_result = {
             "success": True,
-            "payment_id": str(uuid.uuid4()),
+            "payment_id": payment_id,
             "amount": final_amount,
             "original_amount": payment.amount,
             "points_used": payment.points_to_use,
             "points_discount": points_discount,
             "method": payment.payment_method,
+            "status": initial_status,
+            **processor_result,
         }
-        
-        if payment.payment_method == "stripe":
-            # In production, use real Stripe API:
-            # stripe.api_key = STRIPE_SECRET_KEY
-            # payment_intent = stripe.PaymentIntent.create(...)
-            payment_result["stripe_client_secret"] = f"pi_{uuid.uuid4().hex[:24]}_secret_{uuid.uuid4().hex[:24]}"
-            payment_result["message"] = "Stripe payment initiated"
-            
-        elif payment.payment_method == "paypal":
-            payment_result["paypal_order_id"] = f"PAYPAL-{uuid.uuid4().hex[:16].upper()}"
-            payment_result["message"] = "PayPal payment initiated"
-            
-        elif payment.payment_method == "shamcash":
-            # Generate QR code data for ShamCash
-            qr_data = {
-                "merchant_id": "PETSY_MERCHANT_001",
-                "amount": final_amount,
-                "currency": "USD",
-                "reference": str(uuid.uuid4()),
-                "timestamp": datetime.utcnow().isoformat()
-            }
-            payment_result["shamcash_qr_data"] = str(qr_data)
-            payment_result["shamcash_reference"] = qr_data["reference"]
-            payment_result["message"] = "ShamCash QR generated"
-            
-        elif payment.payment_method == "cash_on_delivery":
-            payment_result["message"] = "Cash on delivery confirmed"
-        
-        # If points were used, deduct them
-        if payment.points_to_use > 0:
-            await db.users.update_one(
-                {"id": current_user["id"]},
-                {"$inc": {"loyalty_points": -payment.points_to_use}}
-            )
-            # Record the points transaction
-            await db.points_transactions.insert_one({
-                "id": str(uuid.uuid4()),
-                "user_id": current_user["id"],
-                "points": -payment.points_to_use,
-                "transaction_type": "redeemed",
-                "description": f"Redeemed {payment.points_to_use} points for ${points_discount:.2f} discount",
-                "reference_id": payment_result["payment_id"],
-                "created_at": datetime.utcnow()
-            })
-        
-        # Award points for the purchase (1 point per $1 spent)
-        points_earned = int(final_amount)
         if points_earned > 0:
-            await db.users.update_one(
-                {"id": current_user["id"]},
-                {
-                    "$inc": {
-                        "loyalty_points": points_earned,
-                        "lifetime_points": points_earned
-                    }
-                }
-            )
-            # Record earned points
-            await db.points_transactions.insert_one({
-                "id": str(uuid.uuid4()),
-                "user_id": current_user["id"],
-                "points": points_earned,
-                "transaction_type": "earned",
-                "description": f"Earned {points_earned} points from purchase",
-                "reference_id": payment_result["payment_id"],
-                "created_at": datetime.utcnow()
-            })
             payment_result["points_earned"] = points_earned
-        
-        # Store payment record
-        await db.payments.insert_one({
-            "id": payment_result["payment_id"],
-            "user_id": current_user["id"],
-            "amount": final_amount,
-            "original_amount": payment.amount,
-            "payment_method": payment.payment_method,
-            "status": "succeeded" if payment.payment_method == "cash_on_delivery" else "pending",
-            "order_id": payment.order_id,
-            "appointment_id": payment.appointment_id,
-            "sponsorship_id": payment.sponsorship_id,
-            "points_used": payment.points_to_use,
-            "points_earned": points_earned,
-            "created_at": datetime.utcnow()
-        })
-        
+
+        # Orders redeem their points at checkout; don't debit them a second time here.
+        points_to_debit = payment.points_to_use
+        if payment.order_id and points_to_debit > 0:
+            order = await db.orders.find_one({"id": payment.order_id, "user_id": user_id}, {"_id": 0, "points_used": 1})
+            if order and order.get("points_used"):
+                points_to_debit = 0
+
+        async def _write_ledger(session):
+            if session is None and key:
+                # Without a transaction the writes below can land part-way; a crash from
+                # here on must not let a retry take the key over and charge again.
+                await db.payment_idempotency.update_one({"user_id": user_id, "key": key}, {"$set": {"writes_started": True}})
+            if points_to_debit > 0:
+                await redeem_points(user_id, points_to_debit, payment_id, session)
+                if session is None:
+                    partial.append("points_redeemed")
+            if points_earned > 0:
+                await post_points(
+                    user_id, points_earned, "earned", f"Earned {points_earned} points from purchase",
+                    reference_id=payment_id, session=session,
+                )
+                if session is None:
+                    partial.append("points_earned")
+            await db.payments.insert_one({
+                "id": payment_id,
+                "user_id": user_id,
+                "amount": final_amount,
+                "original_amount": payment.amount,
+                "payment_method": payment.payment_method,
+                "status": initial_status,
+                "order_id": payment.order_id,
+                "appointment_id": payment.appointment_id,
+                "sponsorship_id": payment.sponsorship_id,
+                "points_used": payment.points_to_use,
+                "points_earned": points_earned,
+                "idempotency_key": key,
+                "created_at": datetime.utcnow()
+            }, session=session)
+            if session is None:
+                partial.append("payment_recorded")
+            if key:
+                await db.payment_idempotency.update_one(
+                    {"user_id": user_id, "key": key},
+                    {"$set": {"status": "completed", "payment_id": payment_id, "response": jsonable_encoder(payment_result)}},
+                    session=session,
+                )
+
+        await run_in_transaction(_write_ledger)
         return payment_result
-        
+
     except Exception as e:
+        if key and partial:
+            # Some writes landed; keep the key so a retry can't repeat them, and record what to reconcile.
+            await db.payment_idempotency.update_one(
+                {"user_id": user_id, "key": key},
+                {"$set": {"status": "failed", "payment_id": payment_id, "partial": partial, "error": str(e), "failed_at": datetime.utcnow()}},
+            )
+        elif key:
+            # Nothing was written; release the key so the client can retry.
+            await db.payment_idempotency.delete_one({"user_id": user_id, "key": key, "status": "in_progress"})
+        if isinstance(e, HTTPException):
+            raise
         logger.error(f"Payment error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Payment processing failed: {str(e)}")
 
@@ -3432,12 +5969,14 @@ async def confirm_payment(payment_id: str, current_user: dict = Depends(get_curr
     payment = await db.payments.find_one({"id": payment_id, "user_id": current_user["id"]})
     if not payment:
         raise HTTPException(status_code=404, detail="Payment not found")
-    
-    await db.payments.update_one(
-        {"id": payment_id},
-        {"$set": {"status": "succeeded", "confirmed_at": datetime.utcnow()}}
-    )
-    
+    if payment.get("status") == "succeeded":
+        return {"success": True, "message": "Payment confirmed"}
+
+    if not await transition_payment(payment_id, "succeeded", confirmed_at=datetime.utcnow()):
+        raise HTTPException(
+            status_code=409,
+            detail=error_detail("PAYMENT_INVALID_STATE", f"Payment cannot be confirmed from status {payment.get('status')}"),
+        )
     return {"success": True, "message": "Payment confirmed"}
 
 @api_router.get("/payments/history")
@@ -3458,52 +5997,235 @@ async def get_payment_history(current_user: dict = Depends(get_current_user)):
         for p in payments
     ]
 
+# ========================= LOYALTY LEDGER =========================
+# points_transactions is the ledger and the source of truth. users.loyalty_points /
+# lifetime_points are a materialised balance kept for guarded debits and admin lists.
+# loyalty_snapshots caches {balance, lifetime, tier} as of a ledger position, so reads
+# only replay the entries written since; the nightly job re-snapshots and repairs drift.
+# Balances from before the ledger enter it once, as an `opening_balance` entry written
+# by whoever first flips `users.loyalty_ledger_opened`; every ledger write flips (or
+# finds flipped) first, so the figure carried over never includes a ledger entry.
+
+LOYALTY_TIERS = [  # (tier, lifetime points threshold, earn multiplier), highest first
+    ("platinum", 5000, 2.0),
+    ("gold", 2000, 1.5),
+    ("silver", 500, 1.25),
+    ("bronze", 0, 1.0),
+]
+LOYALTY_RECONCILE_SECONDS = int(os.environ.get("LOYALTY_RECONCILE_SECONDS", "86400"))
+LOYALTY_SNAPSHOT_TAIL = int(os.environ.get("LOYALTY_SNAPSHOT_TAIL", "100"))
+
+def loyalty_tier(lifetime_points: int) -> tuple:
+    """Return (tier, multiplier, lifetime points needed for the next tier)."""
+    next_threshold = None
+    for tier, threshold, multiplier in LOYALTY_TIERS:
+        if lifetime_points >= threshold:
+            return tier, multiplier, max(0, next_threshold - lifetime_points) if next_threshold else 0
+        next_threshold = threshold
+    return LOYALTY_TIERS[-1][0], LOYALTY_TIERS[-1][2], 0
+
+async def ensure_loyalty_indexes():
+    await db.points_transactions.create_index([("user_id", 1), ("created_at", 1), ("id", 1)])
+    await db.points_transactions.create_index("created_at")
+    await db.loyalty_snapshots.create_index("user_id", unique=True)
+
+async def post_points(
+    user_id: str,
+    points: int,
+    transaction_type: str,
+    description: str,
+    reference_id: Optional[str] = None,
+    session=None,
+    lifetime: bool = True,
+) -> None:
+    """Append a ledger entry and apply it to the materialised balance.
+
+    Debits only go through when the balance covers them. Credits count towards
+    lifetime points unless `lifetime` is False (refunds of redeemed points).
+    """
+    await open_loyalty_ledger(user_id, session)
+    if points < 0:
+        result = await db.users.update_one(
+            {"id": user_id, "loyalty_points": {"$gte": -points}},
+            {"$inc": {"loyalty_points": points}},
+            session=session,
+        )
+        if not result.modified_count:
+            raise HTTPException(status_code=400, detail=error_detail("INSUFFICIENT_POINTS", "Not enough loyalty points"))
+    else:
+        await db.users.update_one(
+            {"id": user_id},
+            {"$inc": {"loyalty_points": points, "lifetime_points": points if lifetime else 0}},
+            session=session,
+        )
+    entry = PointsTransaction(
+        user_id=user_id,
+        points=points,
+        transaction_type=transaction_type,
+        description=description,
+        reference_id=reference_id,
+    ).dict()
+    if not lifetime:
+        entry["lifetime_points"] = 0
+    await db.points_transactions.insert_one(entry, session=session)
+
+async def open_loyalty_ledger(user_id: str, session=None) -> bool:
+    """Carry a pre-ledger balance into the ledger, once per user. Returns True if this call opened it."""
+    opened_at = datetime.utcnow()
+    user = await db.users.find_one_and_update(
+        {"id": user_id, "loyalty_ledger_opened": {"$ne": True}},
+        {"$set": {"loyalty_ledger_opened": True}},
+        projection={"_id": 0, "loyalty_points": 1, "lifetime_points": 1},
+        return_document=ReturnDocument.BEFORE,
+        session=session,
+    )
+    if user is None:
+        return False
+    # Entries that predate the flip (written before the ledger existed) already count.
+    legacy = await db.points_transactions.find(
+        {"user_id": user_id, "created_at": {"$lt": opened_at}}, {"_id": 0, "points": 1, "lifetime_points": 1},
+    ).to_list(None)
+    balance_drift = user.get("loyalty_points", 0) - sum(e.get("points", 0) for e in legacy)
+    lifetime_drift = user.get("lifetime_points", 0) - sum(ledger_entry_lifetime(e) for e in legacy)
+    if balance_drift or lifetime_drift:
+        await db.points_transactions.insert_one({
+            **PointsTransaction(
+                user_id=user_id,
+                points=balance_drift,
+                transaction_type="opening_balance",
+                description="Balance carried over to the points ledger",
+                created_at=opened_at,
+            ).dict(),
+            "lifetime_points": lifetime_drift,
+        }, session=session)
+    return True
+
+def ledger_entry_lifetime(entry: dict) -> int:
+    # Only credits count towards lifetime points; opening balances carry their own figure.
+    if "lifetime_points" in entry:
+        return entry["lifetime_points"]
+    return max(0, entry.get("points", 0))
+
+async def replay_ledger(user_id: str, snapshot: Optional[dict]) -> dict:
+    """Fold the ledger entries written after `snapshot` onto it."""
+    query: dict = {"user_id": user_id}
+    if snapshot and snapshot.get("as_of_id"):
+        ts, last_id = snapshot["as_of_created_at"], snapshot["as_of_id"]
+        query["$or"] = [{"created_at": {"$gt": ts}}, {"created_at": ts, "id": {"$gt": last_id}}]
+    rows = await db.points_transactions.find(
+        query, {"_id": 0, "id": 1, "points": 1, "lifetime_points": 1, "created_at": 1}
+    ).sort([("created_at", 1), ("id", 1)]).to_list(None)
+
+    balance = (snapshot or {}).get("balance", 0)
+    lifetime = (snapshot or {}).get("lifetime", 0)
+    for row in rows:
+        balance += row.get("points", 0)
+        lifetime += ledger_entry_lifetime(row)
+    tier = snapshot.get("tier") if snapshot and lifetime == snapshot.get("lifetime") else loyalty_tier(lifetime)[0]
+    return {"balance": balance, "lifetime": lifetime, "tier": tier, "tail": len(rows), "last": rows[-1] if rows else None}
+
+async def snapshot_loyalty(user_id: str, full: bool = False) -> dict:
+    """Write a fresh snapshot for `user_id`, computed from the ledger alone, and return the account.
+
+    `full` replays the whole ledger instead of the entries after the current
+    snapshot, which also picks up rows that landed behind its position.
+    """
+    snapshot = await db.loyalty_snapshots.find_one({"user_id": user_id}, {"_id": 0})
+    if snapshot is None:
+        await open_loyalty_ledger(user_id)
+    account = await replay_ledger(user_id, None if full else snapshot)
+
+    last = account["last"] or {}
+    await db.loyalty_snapshots.update_one(
+        {"user_id": user_id},
+        {"$set": {
+            "balance": account["balance"],
+            "lifetime": account["lifetime"],
+            "tier": account["tier"],
+            "as_of_created_at": last.get("created_at", (snapshot or {}).get("as_of_created_at")),
+            "as_of_id": last.get("id", (snapshot or {}).get("as_of_id")),
+            "updated_at": datetime.utcnow(),
+        }},
+        upsert=True,
+    )
+    return {**account, "tail": 0}
+
+async def loyalty_account(user_id: str) -> dict:
+    snapshot = await db.loyalty_snapshots.find_one({"user_id": user_id}, {"_id": 0})
+    if snapshot is None:
+        return await snapshot_loyalty(user_id)
+    account = await replay_ledger(user_id, snapshot)
+    if account["tail"] > LOYALTY_SNAPSHOT_TAIL:
+        return await snapshot_loyalty(user_id)
+    return account
+
+@periodic_job("reconcile_loyalty_ledgers", LOYALTY_RECONCILE_SECONDS)
+async def reconcile_loyalty_ledgers():
+    """Rebuild recently active ledgers from zero and repair drift in the materialised balances.
+
+    The repair only applies if the user's balances are still the ones observed
+    before the replay; a concurrent post_points makes it a no-op until the next run.
+    """
+    since = datetime.utcnow() - timedelta(seconds=LOYALTY_RECONCILE_SECONDS + 3600)
+    user_ids = await db.points_transactions.distinct("user_id", {"created_at": {"$gte": since}})
+    for user_id in user_ids:
+        user = await db.users.find_one({"id": user_id}, {"_id": 0, "loyalty_points": 1, "lifetime_points": 1})
+        if not user:
+            continue
+        account = await snapshot_loyalty(user_id, full=True)
+        observed = {"loyalty_points": user.get("loyalty_points", 0), "lifetime_points": user.get("lifetime_points", 0)}
+        if (account["balance"], account["lifetime"]) == (observed["loyalty_points"], observed["lifetime_points"]):
+            continue
+        repaired = await db.users.update_one(
+            {"id": user_id, **{field: user.get(field) for field in observed}},
+            {"$set": {"loyalty_points": account["balance"], "lifetime_points": account["lifetime"]}},
+        )
+        if repaired.modified_count:
+            logger.warning(
+                f"Loyalty balance drift for {user_id}: balance {account['balance'] - observed['loyalty_points']:+d}, "
+                f"lifetime {account['lifetime'] - observed['lifetime_points']:+d}"
+            )
+
 # ========================= LOYALTY POINTS ENDPOINTS =========================
 
 @api_router.get("/loyalty/points")
 async def get_loyalty_points(current_user: dict = Depends(get_current_user)):
     """Get user's loyalty points balance and tier"""
-    user = await db.users.find_one({"id": current_user["id"]})
-    total_points = user.get("loyalty_points", 0)
-    lifetime_points = user.get("lifetime_points", 0)
-    
-    # Calculate tier based on lifetime points
-    if lifetime_points >= 5000:
-        tier = "platinum"
-        tier_multiplier = 2.0
-    elif lifetime_points >= 2000:
-        tier = "gold"
-        tier_multiplier = 1.5
-    elif lifetime_points >= 500:
-        tier = "silver"
-        tier_multiplier = 1.25
-    else:
-        tier = "bronze"
-        tier_multiplier = 1.0
-    
-    # Calculate points value in dollars
-    points_value = total_points / 100
-    
+    account = await loyalty_account(current_user["id"])
+    total_points = account["balance"]
+    lifetime_points = account["lifetime"]
+    tier, tier_multiplier, points_to_next_tier = loyalty_tier(lifetime_points)
+
     return {
         "total_points": total_points,
         "lifetime_points": lifetime_points,
-        "tier": tier,
+        "tier": account["tier"] or tier,
         "tier_multiplier": tier_multiplier,
-        "points_value": points_value,
-        "points_to_next_tier": {
-            "bronze": max(0, 500 - lifetime_points),
-            "silver": max(0, 2000 - lifetime_points),
-            "gold": max(0, 5000 - lifetime_points),
-        }.get(tier, 0)
+        "points_value": total_points / 100,  # 100 points = $1
+        "points_to_next_tier": points_to_next_tier,
     }
 
 @api_router.get("/loyalty/transactions")
-async def get_points_transactions(current_user: dict = Depends(get_current_user)):
-    """Get user's points transaction history"""
-    transactions = await db.points_transactions.find(
-        {"user_id": current_user["id"]}
-    ).sort("created_at", -1).to_list(50)
-    
+async def get_points_transactions(
+    response: Response,
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user),
+):
+    """Get user's points transaction history, newest first.
+
+    When more rows exist the `X-Next-Cursor` header carries the `cursor` for the next page.
+    """
+    safe_limit = max(1, min(limit, 100))
+    query = {"user_id": current_user["id"], **created_at_cursor_query(cursor)}
+    rows = await db.points_transactions.find(
+        query, {"_id": 0, "id": 1, "points": 1, "transaction_type": 1, "description": 1, "created_at": 1}
+    ).sort([("created_at", -1), ("id", -1)]).limit(safe_limit + 1).to_list(safe_limit + 1)
+    has_more = len(rows) > safe_limit
+    rows = rows[:safe_limit]
+
+    if has_more and rows:
+        response.headers["X-Next-Cursor"] = encode_created_at_cursor(rows[-1])
     return [
         {
             "id": t.get("id"),
@@ -3512,7 +6234,7 @@ async def get_points_transactions(current_user: dict = Depends(get_current_user)
             "description": t.get("description"),
             "created_at": t.get("created_at"),
         }
-        for t in transactions
+        for t in rows
     ]
 
 @api_router.post("/loyalty/bonus")
@@ -3522,25 +6244,7 @@ async def award_bonus_points(
     current_user: dict = Depends(get_current_user)
 ):
     """Award bonus points to user (for promotions, etc.)"""
-    await db.users.update_one(
-        {"id": current_user["id"]},
-        {
-            "$inc": {
-                "loyalty_points": points,
-                "lifetime_points": points
-            }
-        }
-    )
-    
-    await db.points_transactions.insert_one({
-        "id": str(uuid.uuid4()),
-        "user_id": current_user["id"],
-        "points": points,
-        "transaction_type": "bonus",
-        "description": description,
-        "created_at": datetime.utcnow()
-    })
-    
+    await post_points(current_user["id"], points, "bonus", description)
     return {"success": True, "points_awarded": points}
 
 # ========================= ADMIN ENDPOINTS =========================
@@ -3614,24 +6318,33 @@ async def get_admin_stats(admin_user: dict = Depends(get_admin_user)):
             "monthlyStats": [], "recentOrders": [], "recentUsers": [],
         }
 
+ADMIN_USER_LIST_FIELDS = ("id", "name", "email", "phone", "city", "is_verified", "is_admin", "role", "created_at", "loyalty_points")
+ADMIN_USER_RESPONSE_FIELDS = ADMIN_USER_LIST_FIELDS + ("friend_reports_count", "friend_reports_open_count", "is_blocked_by_admin")
+
 @api_router.get("/admin/users")
-async def get_all_users(admin_user: dict = Depends(get_admin_user)):
+async def get_all_users(fields: Optional[str] = None, admin_user: dict = Depends(get_admin_user)):
     """Get all users for admin"""
-    users = await db.users.find({}).to_list(1000)
+    selected = parse_fields(fields, ADMIN_USER_RESPONSE_FIELDS)
+    stored = ADMIN_USER_LIST_FIELDS if selected is None else [f for f in ADMIN_USER_LIST_FIELDS if f == "id" or f in selected]
+    users = await db.users.find({}, mongo_projection(*stored)).to_list(1000)
     user_ids = [u.get("id") for u in users if u.get("id")]
 
     # friend report counts per target user
-    pipeline = [
-        {"$group": {"_id": "$target_user_id", "count": {"$sum": 1}, "open_count": {"$sum": {"$cond": [{"$eq": ["$status", "open"]}, 1, 0]}}}},
-    ]
-    report_rows = await db.friend_reports.aggregate(pipeline).to_list(2000)
-    report_map = {r.get("_id"): r for r in report_rows}
+    report_map = {}
+    if selected is None or {"friend_reports_count", "friend_reports_open_count"} & set(selected):
+        pipeline = [
+            {"$group": {"_id": "$target_user_id", "count": {"$sum": 1}, "open_count": {"$sum": {"$cond": [{"$eq": ["$status", "open"]}, 1, 0]}}}},
+        ]
+        report_rows = await db.friend_reports.aggregate(pipeline).to_list(2000)
+        report_map = {r.get("_id"): r for r in report_rows}
 
-    blocked_rows = await db.blocked_users.find({"user_id": admin_user["id"], "blocked_user_id": {"$in": user_ids}}).to_list(2000)
-    blocked_set = {r.get("blocked_user_id") for r in blocked_rows}
+    blocked_set = set()
+    if selected is None or "is_blocked_by_admin" in selected:
+        blocked_rows = await db.blocked_users.find({"user_id": admin_user["id"], "blocked_user_id": {"$in": user_ids}}).to_list(2000)
+        blocked_set = {r.get("blocked_user_id") for r in blocked_rows}
 
     return [
-        {
+        pick_fields({
             "id": u.get("id"),
             "name": u.get("name"),
             "email": u.get("email"),
@@ -3645,7 +6358,7 @@ async def get_all_users(admin_user: dict = Depends(get_admin_user)):
             "friend_reports_count": (report_map.get(u.get("id")) or {}).get("count", 0),
             "friend_reports_open_count": (report_map.get(u.get("id")) or {}).get("open_count", 0),
             "is_blocked_by_admin": u.get("id") in blocked_set,
-        }
+        }, selected)
         for u in users
     ]
 
@@ -3658,15 +6371,28 @@ async def update_user_admin(user_id: str, data: dict, admin_user: dict = Depends
           raise HTTPException(status_code=400, detail=f"Invalid role. Allowed: {', '.join(sorted(ALLOWED_ROLES))}")
       data["is_admin"] = role == "admin"
     await db.users.update_one({"id": user_id}, {"$set": data})
+    if data.keys() & {"name", "phone", "city"}:
+        await tag_cards.invalidate_where({"owner_id": user_id})
     await audit_admin_action(admin_user, "update_user", "user", user_id, data)
     return {"success": True}
 
 @api_router.delete("/admin/users/{user_id}")
-async def delete_user_admin(user_id: str, admin_user: dict = Depends(get_admin_user)):
-    """Delete user (admin)"""
-    await db.users.delete_one({"id": user_id})
-    await audit_admin_action(admin_user, "delete_user", "user", user_id)
-    return {"success": True}
+async def delete_user_admin(user_id: str, background_tasks: BackgroundTasks, admin_user: dict = Depends(get_admin_user)):
+    """Delete user and cascade their data (admin)"""
+    if not await db.users.find_one({"id": user_id}, {"_id": 0, "id": 1}):
+        raise HTTPException(status_code=404, detail=error_detail("AUTH_USER_NOT_FOUND", "User not found"))
+    job_id = await schedule_account_deletion(user_id, admin_user["id"])
+    background_tasks.add_task(run_account_deletion, job_id)
+    await audit_admin_action(admin_user, "delete_user", "user", user_id, {"job_id": job_id})
+    return {"success": True, "job_id": job_id}
+
+@api_router.get("/admin/account-deletions/{job_id}")
+async def get_account_deletion_admin(job_id: str, admin_user: dict = Depends(get_admin_user)):
+    """Progress of an account deletion cascade (admin)"""
+    job = await db.account_deletions.find_one({"id": job_id})
+    if not job:
+        raise HTTPException(status_code=404, detail="Deletion job not found")
+    return account_deletion_progress(job)
 
 @api_router.post("/admin/users/{user_id}/make-admin")
 async def make_user_admin(user_id: str, admin_user: dict = Depends(get_admin_user)):
@@ -3754,12 +6480,14 @@ async def block_user_admin(user_id: str, admin_user: dict = Depends(get_admin_us
             "blocked_user_id": user_id,
             "created_at": datetime.utcnow(),
         })
+        await block_lists.invalidate(admin_user["id"], user_id)
     await audit_admin_action(admin_user, "block_user", "user", user_id)
     return {"success": True}
 
 @api_router.delete('/admin/users/{user_id}/block')
 async def unblock_user_admin(user_id: str, admin_user: dict = Depends(get_admin_user)):
     await db.blocked_users.delete_one({"user_id": admin_user["id"], "blocked_user_id": user_id})
+    await block_lists.invalidate(admin_user["id"], user_id)
     await audit_admin_action(admin_user, "unblock_user", "user", user_id)
     return {"success": True}
 
@@ -3874,6 +6602,7 @@ async def get_admin_audit_logs(
     action: Optional[str] = None,
     from_date: Optional[str] = None,
     to_date: Optional[str] = None,
+    archived: bool = False,
     admin_user: dict = Depends(get_admin_user)
 ):
     query: dict = {}
@@ -3891,6 +6620,26 @@ async def get_admin_audit_logs(
                 {"admin_email": {"$regex": qv, "$options": "i"}},
             ]
 
+    date_query = created_at_range(from_date, to_date)
+    if date_query:
+        query['created_at'] = date_query
+
+    collection = db.admin_audit_logs_archive if archived else db.admin_audit_logs
+    rows = await collection.find(query).sort("created_at", -1).limit(max(1, min(limit, 1000))).to_list(1000)
+    return [{k: v for k, v in r.items() if k != "_id"} for r in rows]
+
+# ========================= ADMIN EXPORTS =========================
+# The admin list endpoints above cap at 1000 rows. Exports stream whole datasets as
+# NDJSON or CSV: rows come off a Motor cursor `batch_size` at a time and are written
+# out per batch, so memory stays flat regardless of size. Rows are ordered newest
+# first by (created_at, id); to resume an interrupted export pass
+# `cursor=<created_at>|<id>` of the last row received.
+
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", "500"))
+EXPORT_MAX_BATCH_SIZE = 5000
+
+def created_at_range(from_date: Optional[str], to_date: Optional[str]) -> dict:
+    """`created_at` bounds from ISO dates; a bare YYYY-MM-DD `to_date` includes that whole day."""
     date_query: dict = {}
     if from_date:
         try:
@@ -3899,26 +6648,157 @@ async def get_admin_audit_logs(
             pass
     if to_date:
         try:
-            # inclusive day if YYYY-MM-DD provided
             to_dt = datetime.fromisoformat(str(to_date))
             if len(str(to_date)) == 10:
                 to_dt = to_dt + timedelta(days=1)
             date_query['$lt'] = to_dt
         except Exception:
             pass
+    return date_query
+
+async def attach_order_user_names(rows: List[dict]):
+    user_ids = list({r.get("user_id") for r in rows if r.get("user_id")})
+    users = await db.users.find({"id": {"$in": user_ids}}, {"_id": 0, "id": 1, "name": 1}).to_list(len(user_ids) or 1)
+    names = {u["id"]: u.get("name") for u in users}
+    for row in rows:
+        row["user_name"] = names.get(row.get("user_id"), "Unknown")
+
+EXPORT_DATASETS = {
+    "users": {
+        "collection": "users",
+        "columns": ADMIN_USER_LIST_FIELDS,
+        "filters": ("role", "city"),
+    },
+    "orders": {
+        "collection": "orders",
+        "columns": ("id", "user_id", "user_name", "items", "subtotal", "points_used", "total", "status", "payment_method",
+                    "shipping_address", "shipping_city", "created_at"),
+        "filters": ("status", "user_id", "payment_method"),
+        "derived": ("user_name",),
+        "enrich": attach_order_user_names,
+    },
+    "payments": {
+        "collection": "payments",
+        "columns": ("id", "user_id", "order_id", "appointment_id", "sponsorship_id", "amount", "original_amount",
+                    "payment_method", "status", "points_used", "points_earned", "created_at"),
+        "filters": ("status", "user_id", "payment_method"),
+    },
+    "sponsorships": {
+        "collection": "sponsorships",
+        "columns": ("id", "pet_id", "user_id", "user_name", "amount", "message", "is_anonymous", "is_recurring", "status", "created_at"),
+        "filters": ("status", "pet_id", "user_id"),
+    },
+    "role-requests": {
+        "collection": "role_requests",
+        "columns": ("id", "user_id", "user_name", "user_email", "target_role", "reason", "status", "created_at", "updated_at"),
+        "filters": ("status", "target_role"),
+    },
+    "audit-logs": {
+        "collection": "admin_audit_logs",
+        "columns": ("id", "admin_user_id", "admin_email", "action", "target_type", "target_id", "payload", "created_at"),
+        "filters": ("action", "target_type", "admin_email"),
+    },
+    "audit-logs-archive": {
+        "collection": "admin_audit_logs_archive",
+        "columns": ("id", "admin_user_id", "admin_email", "action", "target_type", "target_id", "payload", "created_at"),
+        "filters": ("action", "target_type", "admin_email"),
+    },
+}
+
+def export_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str, separators=(",", ":"))
+    return value
+
+def encode_ndjson_row(row: dict) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(row, default=str) + b"\n"
+    return (json.dumps(row, default=lambda v: v.isoformat() if isinstance(v, datetime) else str(v)) + "\n").encode()
+
+async def render_export_batch(rows: List[dict], spec: dict, fmt: str) -> bytes:
+    if spec.get("enrich"):
+        await spec["enrich"](rows)
+    columns = spec["columns"]
+    if fmt == "ndjson":
+        return b"".join(encode_ndjson_row({c: row.get(c) for c in columns}) for row in rows)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerows([export_value(row.get(c)) for c in columns] for row in rows)
+    return buffer.getvalue().encode()
+
+async def stream_export(cursor, spec: dict, fmt: str, batch_size: int):
+    if fmt == "csv":
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(spec["columns"])
+        yield buffer.getvalue().encode()
+    batch = []
+    async for row in cursor:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield await render_export_batch(batch, spec, fmt)
+            batch = []
+    if batch:
+        yield await render_export_batch(batch, spec, fmt)
+
+async def ensure_export_indexes():
+    for spec in EXPORT_DATASETS.values():
+        await db[spec["collection"]].create_index([("created_at", -1), ("id", -1)])
+
+@api_router.get("/admin/exports/{dataset}")
+async def export_admin_dataset(
+    dataset: str,
+    request: Request,
+    format: str = "ndjson",
+    cursor: Optional[str] = None,
+    from_date: Optional[str] = None,
+    to_date: Optional[str] = None,
+    batch_size: int = EXPORT_BATCH_SIZE,
+    admin_user: dict = Depends(get_admin_user),
+):
+    """Stream a full admin dataset as NDJSON or CSV; extra query params filter on the dataset's `filters`."""
+    spec = EXPORT_DATASETS.get(dataset)
+    if not spec:
+        raise HTTPException(status_code=404, detail=error_detail("EXPORT_NOT_FOUND", f"Unknown export: {dataset}"))
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail=error_detail("INVALID_EXPORT_FORMAT", "format must be ndjson or csv"))
+
+    filters = {name: request.query_params[name] for name in spec["filters"] if request.query_params.get(name)}
+    query: dict = dict(filters)
+    date_query = created_at_range(from_date, to_date)
     if date_query:
-        query['created_at'] = date_query
+        query["created_at"] = date_query
+    keyset = created_at_cursor_query(cursor)
+    if keyset:
+        query = {"$and": [query, keyset]} if query else keyset
 
-    rows = await db.admin_audit_logs.find(query).sort("created_at", -1).limit(max(1, min(limit, 1000))).to_list(1000)
-    return [{k: v for k, v in r.items() if k != "_id"} for r in rows]
+    await audit_admin_action(admin_user, "export", dataset, None, {
+        "format": format, "filters": filters, "from_date": from_date, "to_date": to_date, "cursor": cursor,
+    })
+
+    batch_size = max(1, min(batch_size, EXPORT_MAX_BATCH_SIZE))
+    projection = mongo_projection(*[c for c in spec["columns"] if c not in spec.get("derived", ())])
+    rows = db[spec["collection"]].find(query, projection).sort([("created_at", -1), ("id", -1)]).batch_size(batch_size)
+    filename = f"{dataset}-{datetime.utcnow():%Y%m%d-%H%M%S}.{format}"
+    return StreamingResponse(
+        stream_export(rows, spec, format, batch_size),
+        media_type="application/x-ndjson" if format == "ndjson" else "text/csv",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
 
 @api_router.get("/admin/orders")
 async def get_all_orders_admin(admin_user: dict = Depends(get_admin_user)):
     """Get all orders for admin"""
     orders = await db.orders.find({}).sort("created_at", -1).to_list(1000)
+    user_ids = list({o.get("user_id") for o in orders if o.get("user_id")})
+    users = await db.users.find({"id": {"$in": user_ids}}, {"_id": 0, "id": 1, "name": 1}).to_list(len(user_ids) or 1)
+    umap = {u["id"]: u for u in users}
     result = []
     for order in orders:
-        user = await db.users.find_one({"id": order.get("user_id")})
+        user = umap.get(order.get("user_id"))
         result.append({
             "id": order.get("id"),
             "user_id": order.get("user_id"),
@@ -3966,18 +6846,24 @@ async def create_product_admin(data: dict, admin_user: dict = Depends(get_admin_
         "created_at": datetime.utcnow(),
     }
     await db.products.insert_one(product)
+    await product_cache.invalidate()  # drops cached misses for the new id
+    catalog_responses.drop("products")  # product_cache.invalidate already bumped the shared version
     return product
 
 @api_router.put("/admin/products/{product_id}")
 async def update_product_admin(product_id: str, data: dict, admin_user: dict = Depends(get_admin_user)):
     """Update product (admin)"""
     await db.products.update_one({"id": product_id}, {"$set": data})
+    await product_cache.invalidate()
+    catalog_responses.drop("products")  # product_cache.invalidate already bumped the shared version
     return {"success": True}
 
 @api_router.delete("/admin/products/{product_id}")
 async def delete_product_admin(product_id: str, admin_user: dict = Depends(get_admin_user)):
     """Delete product (admin)"""
     await db.products.delete_one({"id": product_id})
+    await product_cache.invalidate()
+    catalog_responses.drop("products")  # product_cache.invalidate already bumped the shared version
     return {"success": True}
 
 @api_router.get("/admin/appointments")
@@ -4001,30 +6887,38 @@ async def create_vet_admin(data: dict, admin_user: dict = Depends(get_admin_user
         "created_at": datetime.utcnow(),
     }
     await db.vets.insert_one(vet)
+    await catalog_responses.invalidate("vets")
     return vet
 
 @api_router.put("/admin/vets/{vet_id}")
 async def update_vet_admin(vet_id: str, data: dict, admin_user: dict = Depends(get_admin_user)):
     """Update vet (admin)"""
     await db.vets.update_one({"id": vet_id}, {"$set": data})
+    await catalog_responses.invalidate("vets")
     return {"success": True}
 
 @api_router.delete("/admin/vets/{vet_id}")
 async def delete_vet_admin(vet_id: str, admin_user: dict = Depends(get_admin_user)):
     """Delete vet (admin)"""
     await db.vets.delete_one({"id": vet_id})
+    await catalog_responses.invalidate("vets")
     return {"success": True}
 
 @api_router.get("/admin/community")
 async def get_all_posts_admin(admin_user: dict = Depends(get_admin_user)):
     """Get all community posts for admin"""
-    posts = await db.community_posts.find({}).sort("created_at", -1).to_list(1000)
+    posts = await db.community.find({}, {"_id": 0}).sort("created_at", -1).to_list(1000)
     return posts
 
 @api_router.delete("/admin/community/{post_id}")
 async def delete_post_admin(post_id: str, admin_user: dict = Depends(get_admin_user)):
     """Delete community post (admin)"""
-    await db.community_posts.delete_one({"id": post_id})
+    result = await db.community.delete_one({"id": post_id})
+    if not result.deleted_count:
+        raise HTTPException(status_code=404, detail="Post not found")
+    await db.timelines.delete_many({"post_id": post_id})
+    timeline_rescores.pop(post_id, None)
+    read_coalescer.forget("community")
     return {"success": True}
 
 @api_router.get("/admin/payments")
@@ -4067,6 +6961,298 @@ async def delete_location_admin(location_id: str, admin_user: dict = Depends(get
     await db.map_locations.delete_one({"id": location_id})
     return {"success": True}
 
+# ========================= RETENTION & ARCHIVAL =========================
+#
+# Hot collections keep only recent rows so they and their indexes stay in RAM:
+# - read notifications expire through a partial TTL index on `updated_at`
+#   (set when the notification is marked read);
+# - audit logs, tag scans and care request events older than their hot window
+#   move to `<collection>_archive` in batches (idempotent: archive ids are unique).
+
+NOTIFICATION_READ_TTL_DAYS = int(os.environ.get("NOTIFICATION_READ_TTL_DAYS", "30"))
+RETENTION_COMPACTION_SECONDS = float(os.environ.get("RETENTION_COMPACTION_SECONDS", "3600"))
+RETENTION_ARCHIVE_BATCH_SIZE = int(os.environ.get("RETENTION_ARCHIVE_BATCH_SIZE", "1000"))
+RETENTION_RUN_COMPACT = os.environ.get("RETENTION_RUN_COMPACT", "false").lower() == "true"
+
+ARCHIVE_TIERS = {
+    "admin_audit_logs": int(os.environ.get("AUDIT_LOG_HOT_DAYS", "90")),
+    "tag_scans": int(os.environ.get("TAG_SCAN_HOT_DAYS", "90")),
+    "care_request_events": int(os.environ.get("CARE_EVENT_HOT_DAYS", "180")),
+}
+
+async def ensure_ttl_index(collection, field: str, expire_seconds: int, name: str, partial: Optional[dict] = None):
+    """Create the TTL index, or update its expiry in place when the configured TTL changed."""
+    if expire_seconds <= 0:
+        try:
+            await collection.drop_index(name)
+        except OperationFailure:
+            pass
+        return
+    options: dict = {"name": name, "expireAfterSeconds": expire_seconds}
+    if partial:
+        options["partialFilterExpression"] = partial
+    try:
+        await collection.create_index(field, **options)
+    except OperationFailure:
+        await db.command("collMod", collection.name, index={"name": name, "expireAfterSeconds": expire_seconds})
+
+async def ensure_retention_indexes():
+    await ensure_ttl_index(
+        db.notifications, "updated_at", NOTIFICATION_READ_TTL_DAYS * 86400,
+        "read_notifications_ttl", partial={"is_read": True},
+    )
+    await db.notifications.create_index([("user_id", 1), ("created_at", -1), ("id", -1)])
+    for name in ARCHIVE_TIERS:
+        await db[name].create_index("created_at")
+        await db[f"{name}_archive"].create_index("id", unique=True)
+        await db[f"{name}_archive"].create_index("created_at")
+    await db.tag_scans_archive.create_index([("pet_id", 1), ("created_at", -1)])
+    await db.care_request_events_archive.create_index([("request_id", 1), ("created_at", 1)])
+
+async def archive_collection(name: str, hot_days: int) -> int:
+    """Move rows older than `hot_days` from `name` to `<name>_archive`. Returns rows moved."""
+    if hot_days <= 0:
+        return 0
+    source = db[name]
+    archive = db[f"{name}_archive"]
+    cutoff = datetime.utcnow() - timedelta(days=hot_days)
+    moved = 0
+    while True:
+        rows = await source.find({"created_at": {"$lt": cutoff}}).sort("created_at", 1).limit(RETENTION_ARCHIVE_BATCH_SIZE).to_list(RETENTION_ARCHIVE_BATCH_SIZE)
+        if not rows:
+            break
+        archived_at = datetime.utcnow()
+        try:
+            await archive.insert_many([{**r, "archived_at": archived_at} for r in rows], ordered=False)
+        except BulkWriteError as e:
+            # Rows copied by an interrupted earlier run already exist in the archive.
+            if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+                raise
+        await source.delete_many({"_id": {"$in": [r["_id"] for r in rows]}})
+        moved += len(rows)
+        if len(rows) < RETENTION_ARCHIVE_BATCH_SIZE:
+            break
+    return moved
+
+@periodic_job("retention_compaction", RETENTION_COMPACTION_SECONDS)
+async def run_retention_compaction() -> Dict[str, int]:
+    summary: Dict[str, int] = {}
+    for name, hot_days in ARCHIVE_TIERS.items():
+        summary[name] = await archive_collection(name, hot_days)
+        if RETENTION_RUN_COMPACT and summary[name]:
+            try:
+                await db.command("compact", name)
+            except OperationFailure as e:
+                logger.warning(f"compact {name} failed: {e}")
+    if any(summary.values()):
+        logger.info(f"Retention archived rows: {summary}")
+    return summary
+
+@api_router.post("/admin/retention/run")
+async def run_retention_admin(admin_user: dict = Depends(get_admin_user)):
+    """Run the archival/compaction pass now (admin)"""
+    summary = await run_retention_compaction()
+    await audit_admin_action(admin_user, "run_retention", "system", None, summary)
+    return {"success": True, "archived": summary}
+
+# ========================= SAMPLING PROFILER =========================
+# Off by default and free when off. While a window is open, a daemon thread samples
+# the event-loop thread's stack every `interval_ms` and a loop task measures how late
+# its wake-ups are (loop lag). Results land in PROFILER_OUTPUT_DIR as collapsed stacks
+# (flamegraph.pl / speedscope) plus a JSON summary.
+
+PROFILER_OUTPUT_DIR = Path(os.environ.get("PROFILER_OUTPUT_DIR", str(ROOT_DIR / "profiles")))
+PROFILER_MAX_SECONDS = int(os.environ.get("PROFILER_MAX_SECONDS", "300"))
+PROFILER_ON_START_SECONDS = int(os.environ.get("PROFILER_ON_START_SECONDS", "0"))
+PROFILER_LAG_PROBE_MS = 50
+
+class SamplingProfiler:
+    def __init__(self):
+        self.running = False
+        self.stacks: Dict[str, int] = {}
+        self.lags: List[float] = []
+        self.samples = 0
+        self.started_at: Optional[datetime] = None
+        self.last_result: Optional[dict] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._tasks: List[asyncio.Task] = []
+
+    @staticmethod
+    def _collapse(frame) -> str:
+        parts = []
+        while frame is not None:
+            code = frame.f_code
+            parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return ";".join(reversed(parts))
+
+    def _sample_loop(self, thread_id: int, interval: float, all_threads: bool):
+        while not self._stop.wait(interval):
+            frames = sys._current_frames()
+            targets = [f for tid, f in frames.items() if tid != threading.get_ident()] if all_threads else [frames.get(thread_id)]
+            for frame in targets:
+                if frame is None:
+                    continue
+                stack = self._collapse(frame)
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+                self.samples += 1
+
+    async def _probe_lag(self):
+        interval = PROFILER_LAG_PROBE_MS / 1000
+        while True:
+            expected = time.perf_counter() + interval
+            await asyncio.sleep(interval)
+            self.lags.append(max(0.0, time.perf_counter() - expected))
+
+    async def _stop_after(self, seconds: float):
+        await asyncio.sleep(seconds)
+        await self.stop()
+
+    def start(self, duration_seconds: float, interval_ms: float = 5, all_threads: bool = False):
+        """Open a profiling window; must be called on the event-loop thread."""
+        if self.running:
+            raise RuntimeError("Profiler already running")
+        self.running = True
+        self.stacks, self.lags, self.samples = {}, [], 0
+        self.started_at = datetime.utcnow()
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._sample_loop,
+            args=(threading.get_ident(), interval_ms / 1000, all_threads),
+            name="petsy-profiler",
+            daemon=True,
+        )
+        self._thread.start()
+        self._tasks = [asyncio.create_task(self._probe_lag()), asyncio.create_task(self._stop_after(duration_seconds))]
+
+    async def stop(self) -> Optional[dict]:
+        if not self.running:
+            return self.last_result
+        self.running = False
+        self._stop.set()
+        current = asyncio.current_task()
+        for task in self._tasks:
+            if task is not current:
+                task.cancel()
+        self._tasks = []
+        await asyncio.to_thread(self._thread.join)
+        self.last_result = await asyncio.to_thread(self._write)
+        return self.last_result
+
+    def _write(self) -> dict:
+        PROFILER_OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+        stamp = self.started_at.strftime("%Y%m%dT%H%M%S")
+        collapsed_path = PROFILER_OUTPUT_DIR / f"profile-{stamp}.collapsed"
+        collapsed_path.write_text("".join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items())))
+        lags = sorted(self.lags)
+        summary = {
+            "started_at": self.started_at.isoformat(),
+            "stopped_at": datetime.utcnow().isoformat(),
+            "samples": self.samples,
+            "collapsed_stacks": str(collapsed_path),
+            "loop_lag_ms": {
+                "probes": len(lags),
+                "p50": round(lags[len(lags) // 2] * 1000, 2) if lags else 0,
+                "p99": round(lags[min(len(lags) - 1, int(len(lags) * 0.99))] * 1000, 2) if lags else 0,
+                "max": round(lags[-1] * 1000, 2) if lags else 0,
+            },
+        }
+        (PROFILER_OUTPUT_DIR / f"profile-{stamp}.json").write_text(json.dumps(summary, indent=2))
+        return summary
+
+    def status(self) -> dict:
+        return {
+            "running": self.running,
+            "started_at": self.started_at,
+            "samples": self.samples,
+            "last_result": self.last_result,
+        }
+
+profiler = SamplingProfiler()
+
+class ProfilerStartRequest(BaseModel):
+    duration_seconds: int = 30
+    interval_ms: float = 5
+    all_threads: bool = False
+
+@api_router.get("/admin/profiler")
+async def get_profiler_status_admin(admin_user: dict = Depends(get_admin_user)):
+    return profiler.status()
+
+@api_router.post("/admin/profiler/start")
+async def start_profiler_admin(payload: ProfilerStartRequest, admin_user: dict = Depends(get_admin_user)):
+    """Open a sampling window on this worker (admin)"""
+    if not 0 < payload.duration_seconds <= PROFILER_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"duration_seconds must be between 1 and {PROFILER_MAX_SECONDS}")
+    if payload.interval_ms < 1:
+        raise HTTPException(status_code=400, detail="interval_ms must be at least 1")
+    try:
+        profiler.start(payload.duration_seconds, payload.interval_ms, payload.all_threads)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    await audit_admin_action(admin_user, "start_profiler", "system", None, payload.dict())
+    return profiler.status()
+
+@api_router.post("/admin/profiler/stop")
+async def stop_profiler_admin(admin_user: dict = Depends(get_admin_user)):
+    """Close the sampling window early and write the results (admin)"""
+    result = await profiler.stop()
+    await audit_admin_action(admin_user, "stop_profiler", "system", None, {"samples": (result or {}).get("samples")})
+    return {"success": True, "result": result}
+
+# ========================= METRICS =========================
+
+class RequestMetricsMiddleware:
+    """ASGI middleware recording latency, status and Mongo query counts per route template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestQueryStats()
+        token = current_request_queries.set(stats)
+        status_code = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        with metrics.lock:
+            metrics.in_flight += 1
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            with metrics.lock:
+                metrics.in_flight -= 1
+            current_request_queries.reset(token)
+            route = getattr(scope.get("route"), "path", "unmatched")
+            metrics.observe_request(scope["method"], route, status_code, time.perf_counter() - started, stats)
+            if QUERY_DEBUG:
+                for shape, count in stats.repeated_shapes(N_PLUS_ONE_THRESHOLD).items():
+                    logger.warning(f"Possible N+1 in {scope['method']} {route}: {shape} x{count}")
+                    with metrics.lock:
+                        key = (scope["method"], route, shape)
+                        metrics.n_plus_one[key] = metrics.n_plus_one.get(key, 0) + 1
+            for sink in query_capture_sinks:
+                sink.append(stats)
+
+@api_router.get("/admin/metrics")
+async def get_metrics_admin(admin_user: dict = Depends(get_admin_user)):
+    """Prometheus metrics: per-route latency/status/queries and per-collection Mongo command stats."""
+    coalescer_lines = ["# TYPE petsy_read_coalescer_total counter"] + [
+        f'petsy_read_coalescer_total{{outcome="{outcome}"}} {count}'
+        for outcome, count in (("load", read_coalescer.loads), ("coalesced", read_coalescer.coalesced), ("cached", read_coalescer.hits))
+    ]
+    return PlainTextResponse(metrics.render() + "\n".join(coalescer_lines) + "\n", media_type="text/plain; version=0.0.4")
+
 # ========================= MAIN ROUTES =========================
 
 @api_router.get("/")
@@ -4080,14 +7266,83 @@ async def health_check():
 # Include the router
 app.include_router(api_router)
 
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(RequestMetricsMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
+INDEX_FAILURES_FATAL = os.environ.get("INDEX_FAILURES_FATAL", "true").lower() == "true"
+
+async def ensure_core_indexes():
+    await db.user_counters.create_index("user_id", unique=True)
+    await db.notifications.create_index([("user_id", 1), ("is_read", 1)])
+    await db.chat_messages.create_index([("conversation_id", 1), ("is_read", 1)])
+
+async def ensure_cart_indexes():
+    await db.carts.create_index("user_id", unique=True)
+
+async def ensure_pet_tag_indexes():
+    await db.pet_tags.create_index("tag_code")
+    await db.pet_tags.create_index("pet_id")
+    await db.pet_tags.create_index("owner_id")
+
+# (name, ensure, required): required groups carry unique indexes that writes rely on
+# for correctness (idempotency keys, one row per user/pair), so a failure there
+# stops startup unless INDEX_FAILURES_FATAL=false. Each group runs on its own, so
+# one failure never skips the others.
+INDEX_GROUPS = [
+    ("core", ensure_core_indexes, True),
+    ("retention", ensure_retention_indexes, True),
+    ("account_deletion", ensure_account_deletion_indexes, True),
+    ("likes", ensure_like_indexes, True),
+    ("payments", ensure_payment_indexes, True),
+    ("loyalty", ensure_loyalty_indexes, True),
+    ("carts", ensure_cart_indexes, True),
+    ("pet_tags", ensure_pet_tag_indexes, False),
+    ("usernames", ensure_username_indexes, True),
+    ("exports", ensure_export_indexes, False),
+    ("timelines", ensure_timeline_indexes, True),
+    ("trending", ensure_trending_indexes, False),
+    ("lost_found", ensure_lost_found_indexes, True),
+]
+
+async def ensure_indexes():
+    missing = []
+    for name, ensure, required in INDEX_GROUPS:
+        try:
+            await ensure()
+        except Exception as e:
+            logger.error(f"Index creation failed for {name}{' (required)' if required else ''}: {e}")
+            if required:
+                missing.append(name)
+    if missing and INDEX_FAILURES_FATAL:
+        raise RuntimeError(f"Required indexes missing for: {', '.join(missing)}")
+
+@app.on_event("startup")
+async def start_background_jobs():
+    global query_debug_loop
+    query_debug_loop = asyncio.get_running_loop()
+    await ensure_indexes()
+    if PROFILER_ON_START_SECONDS > 0:
+        profiler.start(min(PROFILER_ON_START_SECONDS, PROFILER_MAX_SECONDS))
+    for job in PERIODIC_JOBS:
+        if job["interval"] > 0:
+            background_tasks.append(asyncio.create_task(run_periodic_job(job["name"], job["interval"], job["func"])))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await profiler.stop()
+    await view_counters.flush()
+    await flush_timeline_scores()
     client.close()
@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import {
   View,
   Text,
@@ -21,6 +21,11 @@ import { ordersAPI, paymentAPI, loyaltyAPI } from '../src/services/api';
 import { useTranslation } from '../src/hooks/useTranslation';
 
 // Cross-platform alert function
+// One key per payment attempt: reused when a network failure left the outcome
+// unknown, renewed when the user changes how (or how much) they pay.
+const newAttemptKey = (orderId: string) =>
+  `order:${orderId}:${Date.now().toString(36)}${Math.random().toString(36).slice(2, 10)}`;
+
 const showAlert = (title: string, message: string, onOk?: () => void) => {
   if (Platform.OS === 'web') {
     window.alert(`${title}\n\n${message}`);
@@ -47,6 +52,8 @@ export default function CheckoutScreen() {
     notes: '',
   });
   const [step, setStep] = useState(1);
+  const pendingOrderId = useRef<string | null>(null);
+  const paymentAttempt = useRef<{ key: string; fingerprint: string } | null>(null);
 
   const shippingCost = cartTotal > 50 ? 0 : 5.99;
   const pointsDiscount = pointsToUse / 100; // 100 points = $1
@@ -118,15 +125,25 @@ export default function CheckoutScreen() {
         points_used: pointsToUse,
       };
 
-      const orderResponse = await ordersAPI.create(orderData);
-      const orderId = orderResponse.data?.id;
+      // A retry after a failed payment pays for the order already placed
+      if (!pendingOrderId.current) {
+        const orderResponse = await ordersAPI.create(orderData);
+        pendingOrderId.current = orderResponse.data?.id;
+      }
+      const orderId = pendingOrderId.current as string;
 
       // Process payment
+      const amount = cartTotal + shippingCost;
+      const fingerprint = `${orderId}|${paymentMethod}|${amount}|${pointsToUse}`;
+      if (!paymentAttempt.current || paymentAttempt.current.fingerprint !== fingerprint) {
+        paymentAttempt.current = { key: newAttemptKey(orderId), fingerprint };
+      }
       const paymentData = {
-        amount: cartTotal + shippingCost,
+        amount,
         payment_method: paymentMethod,
         order_id: orderId,
         points_to_use: pointsToUse,
+        idempotency_key: paymentAttempt.current.key,
         ...(paymentMethod === 'stripe' && {
           card_number: cardDetails.number,
           card_expiry: cardDetails.expiry,
@@ -135,7 +152,9 @@ export default function CheckoutScreen() {
       };
 
       const paymentResponse = await paymentAPI.processPayment(paymentData);
-      
+      pendingOrderId.current = null;
+      paymentAttempt.current = null;
+
       clearCart();
 
       // Show success with points earned info
@@ -148,6 +167,10 @@ export default function CheckoutScreen() {
         router.replace('/(tabs)/shop');
       });
     } catch (error: any) {
+      if (error.response) {
+        // The server answered, so this attempt is settled; trying again is a new attempt
+        paymentAttempt.current = null;
+      }
       showAlert(
         'Order Failed',
         error.response?.data?.detail || 'Failed to place order. Please try again.'
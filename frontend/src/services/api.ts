@@ -264,6 +264,15 @@ export const aiAPI = {
     api.post('/ai/assistant', null, { params: { query, context } }),
 };
 
+// Cart API: the server cart is priced from the catalogue on read
+export const cartAPI = {
+  get: () => api.get('/cart'),
+  add: (productId: string, quantity = 1) => api.post('/cart/add', { product_id: productId, quantity }),
+  update: (productId: string, quantity: number) => api.put(`/cart/update/${productId}`, { quantity }),
+  remove: (productId: string) => api.delete(`/cart/remove/${productId}`),
+  clear: () => api.delete('/cart/clear'),
+};
+
 // Orders API (Cart/Checkout)
 export const ordersAPI = {
   create: (data: {
@@ -333,6 +342,7 @@ export const paymentAPI = {
     appointment_id?: string;
     sponsorship_id?: string;
     points_to_use?: number;
+    idempotency_key?: string;
   }) => api.post('/payments/process', data),
   
   confirmPayment: (paymentId: string) => api.post(`/payments/confirm/${paymentId}`),
@@ -1,6 +1,7 @@
 import { create } from 'zustand';
 import AsyncStorage from '@react-native-async-storage/async-storage';
 import { Language } from '../i18n/translations';
+import { cartAPI } from '../services/api';
 
 const BACKEND_URL = process.env.EXPO_PUBLIC_BACKEND_URL || '';
 
@@ -95,8 +96,19 @@ interface AppState {
   removeFromCart: (productId: string) => void;
   updateCartQuantity: (productId: string, quantity: number) => void;
   clearCart: () => void;
+  syncCart: () => Promise<void>;
 }
 
+const cartTotalOf = (cart: CartItem[]) => cart.reduce((sum, i) => sum + i.price * i.quantity, 0);
+
+// Signed-in carts live on the server; local edits are mirrored best-effort and
+// the next syncCart picks up the server's catalogue prices.
+const mirrorCart = (request: () => Promise<unknown>) => {
+  AsyncStorage.getItem('auth_token').then((token) => {
+    if (token) request().catch((error) => console.log('Cart sync failed:', error));
+  });
+};
+
 export const useStore = create<AppState>((set, get) => ({
   // Initial state
   user: null,
@@ -120,6 +132,7 @@ export const useStore = create<AppState>((set, get) => ({
       await AsyncStorage.removeItem('auth_token');
     }
     set({ token });
+    if (token) get().syncCart();
   },
   
   setLanguage: async (language) => {
@@ -168,6 +181,7 @@ export const useStore = create<AppState>((set, get) => ({
           if (contentType.includes('application/json')) {
             const user = await res.json();
             set({ user, isAuthenticated: true, isLoading: false, token, language, cart, cartTotal });
+            get().syncCart();
             return;
           }
         }
@@ -197,17 +211,19 @@ export const useStore = create<AppState>((set, get) => ({
       newCart = [...cart, { ...item, quantity: 1 }];
     }
     
-    const cartTotal = newCart.reduce((sum, i) => sum + i.price * i.quantity, 0);
+    const cartTotal = cartTotalOf(newCart);
     await AsyncStorage.setItem('cart', JSON.stringify(newCart));
     set({ cart: newCart, cartTotal });
+    mirrorCart(() => cartAPI.add(item.product_id, 1));
   },
   
   removeFromCart: async (productId) => {
     const { cart } = get();
     const newCart = cart.filter((i) => i.product_id !== productId);
-    const cartTotal = newCart.reduce((sum, i) => sum + i.price * i.quantity, 0);
+    const cartTotal = cartTotalOf(newCart);
     await AsyncStorage.setItem('cart', JSON.stringify(newCart));
     set({ cart: newCart, cartTotal });
+    mirrorCart(() => cartAPI.remove(productId));
   },
   
   updateCartQuantity: async (productId, quantity) => {
@@ -215,13 +231,35 @@ export const useStore = create<AppState>((set, get) => ({
     const newCart = cart.map((i) =>
       i.product_id === productId ? { ...i, quantity: Math.max(0, quantity) } : i
     ).filter((i) => i.quantity > 0);
-    const cartTotal = newCart.reduce((sum, i) => sum + i.price * i.quantity, 0);
+    const cartTotal = cartTotalOf(newCart);
     await AsyncStorage.setItem('cart', JSON.stringify(newCart));
     set({ cart: newCart, cartTotal });
+    mirrorCart(() => cartAPI.update(productId, Math.max(0, quantity)));
   },
   
   clearCart: async () => {
     await AsyncStorage.removeItem('cart');
     set({ cart: [], cartTotal: 0 });
+    mirrorCart(() => cartAPI.clear());
+  },
+
+  syncCart: async () => {
+    try {
+      let response = await cartAPI.get();
+      if (!response.data.items.length && get().cart.length) {
+        // First sign-in on this device: hand the local cart to the server
+        for (const item of get().cart) {
+          await cartAPI.add(item.product_id, item.quantity);
+        }
+        response = await cartAPI.get();
+      }
+      const cart: CartItem[] = response.data.items
+        .filter((i: any) => i.available)
+        .map((i: any) => ({ product_id: i.product_id, name: i.name, price: i.price, quantity: i.quantity, image: i.image }));
+      await AsyncStorage.setItem('cart', JSON.stringify(cart));
+      set({ cart, cartTotal: cartTotalOf(cart) });
+    } catch (error) {
+      console.log('Error loading cart:', error);
+    }
   },
 }));
@@ -0,0 +1,28 @@
+"""One-off migration: fill derived fields that new writes maintain themselves.
+
+- `trending_score` for community posts and listings inside the trending window;
+- lost & found match keys (`match_species`, `match_seen_on`, ...) on active reports.
+
+Both used to run at startup; run this once after deploying instead, from the
+repository root with the backend's MONGO_URL / DB_NAME set:
+
+    python scripts/backfill_derived_fields.py
+"""
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from backend import server  # noqa: E402
+
+
+async def main():
+    scored = await server.backfill_trending_scores()
+    stamped = await server.backfill_lost_found_match_keys()
+    print(f"Scored {scored} trending items and stamped {stamped} lost & found reports")
+    server.client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
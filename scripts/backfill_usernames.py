@@ -0,0 +1,35 @@
+"""One-off migration: give every user a username and user code.
+
+Signup allocates both up front; this covers accounts created before that. It
+first seeds `username_counters` from the highest numeric suffix per base, so new
+signups don't walk the sequence through names that already exist.
+Run from the repository root with the backend's MONGO_URL / DB_NAME set:
+
+    python scripts/backfill_usernames.py
+"""
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from pymongo.errors import OperationFailure  # noqa: E402
+
+from backend import server  # noqa: E402
+
+
+async def main():
+    try:
+        await server.ensure_username_indexes()
+    except OperationFailure as e:
+        # Usually pre-existing duplicate usernames; the backfill itself can still run.
+        print(f"Could not create the username index: {e}")
+    seeded = await server.seed_username_counters()
+    print(f"Seeded {seeded} username counters")
+    stats = await server.backfill_usernames()
+    print(f"Backfilled {stats['usernames']} usernames and {stats['user_codes']} user codes")
+    server.client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
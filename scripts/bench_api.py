@@ -0,0 +1,165 @@
+"""Throughput/latency benchmark for the auth, feed and chat API paths.
+
+Runs `backend.server.app` in-process through httpx's ASGI transport, seeds a pool
+of verified users, then drives a weighted mix of signup/login/me/feeds/chat
+requests at each concurrency level and records p50/p95/p99 and RPS per route.
+
+    python scripts/bench_api.py --mock --concurrency 1,8,32 --duration 10
+    python scripts/bench_api.py --mongo-url mongodb://localhost:27017 \
+        --compare test_reports/bench/api-abc1234.json
+"""
+import argparse
+import asyncio
+import base64
+import itertools
+import os
+import random
+import time
+import uuid
+
+import httpx
+
+from bench_common import LatencyRecorder, add_backend_args, boot_server, compare_reports, write_report
+
+DEFAULT_MIX = "signup=1,login=2,me=5,feed_community=4,feed_pets=2,feed_marketplace=2,chat_list=3,chat_send=3"
+PASSWORD = "bench-pass-123"
+# Pets and listings carry inline base64 images, so feeds are serialisation-heavy.
+BENCH_IMAGE = "data:image/jpeg;base64," + base64.b64encode(os.urandom(48 * 1024)).decode()
+
+
+class ApiBench:
+    def __init__(self, server, client: httpx.AsyncClient, users: int):
+        self.server = server
+        self.client = client
+        self.user_count = users
+        self.accounts = []  # [{email, token, id}]
+        self.conversations = []  # [(token, conversation_id)]
+        self.signups = itertools.count()
+
+    async def seed(self):
+        for i in range(self.user_count):
+            email = f"bench{i}-{uuid.uuid4().hex[:6]}@bench.local"
+            await self.client.post("/api/auth/signup", json={"email": email, "name": f"Bench User {i}", "password": PASSWORD})
+        await self.server.db.users.update_many({"email": {"$regex": "@bench\\.local$"}}, {"$set": {"is_verified": True}})
+        async for user in self.server.db.users.find({"email": {"$regex": "@bench\\.local$"}}, {"_id": 0, "id": 1, "email": 1}):
+            self.accounts.append({"email": user["email"], "id": user["id"], "token": self.server.create_access_token({"sub": user["id"]})})
+
+        for a, b in zip(self.accounts[::2], self.accounts[1::2]):
+            r = await self.client.post(
+                "/api/conversations", headers=self.auth(a),
+                json={"other_user_id": b["id"], "initial_message": "hello"},
+            )
+            conversation_id = r.json().get("conversation_id")
+            self.conversations.extend([(a, conversation_id), (b, conversation_id)])
+        for account in self.accounts[:20]:
+            await self.client.post(
+                "/api/community", headers=self.auth(account),
+                json={"type": "question", "title": "Bench post", "content": "Seeded by bench_api.py"},
+            )
+            await self.client.post(
+                "/api/pets", headers=self.auth(account),
+                json={"name": "Bench pet", "species": "dog", "gender": "male", "image": BENCH_IMAGE},
+            )
+            await self.client.post(
+                "/api/marketplace/listings", headers=self.auth(account),
+                json={"title": "Bench listing", "description": "Seeded by bench_api.py", "category": "accessories",
+                      "price": 10, "location": "Bench", "image": BENCH_IMAGE},
+            )
+
+    @staticmethod
+    def auth(account):
+        return {"Authorization": f"Bearer {account['token']}"}
+
+    async def op_signup(self):
+        n = next(self.signups)
+        return await self.client.post(
+            "/api/auth/signup",
+            json={"email": f"signup{n}-{uuid.uuid4().hex[:6]}@bench.local", "name": "Bench Signup", "password": PASSWORD},
+        )
+
+    async def op_login(self):
+        account = random.choice(self.accounts)
+        return await self.client.post("/api/auth/login", json={"email": account["email"], "password": PASSWORD})
+
+    async def op_me(self):
+        return await self.client.get("/api/auth/me", headers=self.auth(random.choice(self.accounts)))
+
+    async def op_feed_community(self):
+        return await self.client.get("/api/community?limit=20", headers=self.auth(random.choice(self.accounts)))
+
+    async def op_feed_pets(self):
+        return await self.client.get("/api/pets")
+
+    async def op_feed_marketplace(self):
+        return await self.client.get("/api/marketplace/listings")
+
+    async def op_chat_list(self):
+        return await self.client.get("/api/conversations", headers=self.auth(random.choice(self.accounts)))
+
+    async def op_chat_send(self):
+        account, conversation_id = random.choice(self.conversations)
+        return await self.client.post(
+            f"/api/conversations/{conversation_id}/messages",
+            params={"content": "bench message"}, headers=self.auth(account),
+        )
+
+    async def run_level(self, mix, concurrency: int, duration: float) -> dict:
+        names, weights = zip(*mix.items())
+        recorder = LatencyRecorder()
+        deadline = time.perf_counter() + duration
+
+        async def worker():
+            while time.perf_counter() < deadline:
+                name = random.choices(names, weights)[0]
+                started = time.perf_counter()
+                try:
+                    response = await getattr(self, f"op_{name}")()
+                    ok = response.status_code < 400
+                except Exception:
+                    ok = False
+                recorder.record(name, time.perf_counter() - started, ok)
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return {"concurrency": concurrency, **recorder.summary()}
+
+
+def parse_mix(raw: str) -> dict:
+    mix = {}
+    for part in raw.split(","):
+        name, _, weight = part.partition("=")
+        if not hasattr(ApiBench, f"op_{name.strip()}"):
+            raise SystemExit(f"Unknown operation in --mix: {name}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+async def main(args):
+    server = await boot_server(args)
+    mix = parse_mix(args.mix)
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        bench = ApiBench(server, client, args.users)
+        await bench.seed()
+        levels = []
+        for concurrency in [int(c) for c in args.concurrency.split(",")]:
+            level = await bench.run_level(mix, concurrency, args.duration)
+            levels.append(level)
+            print(f"concurrency={concurrency:<4} total_rps={level['total_rps']}")
+            for route, stats in level["routes"].items():
+                print(f"  {route:16} n={stats['count']:<6} err={stats['errors']:<4} "
+                      f"p50={stats['p50_ms']:.1f}ms p95={stats['p95_ms']:.1f}ms p99={stats['p99_ms']:.1f}ms rps={stats['rps']}")
+    await server.view_counters.flush()
+
+    path = write_report("api", args, levels, {"mix": mix, "users": args.users, "duration_s": args.duration})
+    if args.compare and not compare_reports(path, args.compare, args.max_regression):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_backend_args(parser)
+    parser.add_argument("--concurrency", default="1,8,32", help="comma-separated concurrency levels to sweep")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per concurrency level")
+    parser.add_argument("--users", type=int, default=50, help="verified accounts to seed")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="weighted operation mix, e.g. login=2,me=5")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,141 @@
+"""Shared plumbing for the in-process load/benchmark scripts.
+
+Boots `backend.server` inside the benchmark process against a local mongod, or
+an in-memory mongomock-motor stand-in, and records per-route latency so runs
+can be stored as JSON baselines and compared between commits.
+"""
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+BASELINE_DIR = ROOT_DIR / "test_reports" / "bench"
+
+sys.path.insert(0, str(ROOT_DIR))
+
+
+def add_backend_args(parser):
+    parser.add_argument("--mongo-url", default=os.environ.get("MONGO_URL", "mongodb://localhost:27017"),
+                        help="mongod to benchmark against (ignored with --mock)")
+    parser.add_argument("--mock", action="store_true", help="use an in-memory mongomock-motor database")
+    parser.add_argument("--db-name", default="petsy_bench",
+                        help="database to create and drop; must contain 'bench'")
+    parser.add_argument("--output", help="write the report here (default: test_reports/bench/<name>-<commit>.json)")
+    parser.add_argument("--compare", help="baseline report to compare against")
+    parser.add_argument("--max-regression", type=float, default=20.0,
+                        help="fail when p95 grows or throughput drops by more than this percentage")
+
+
+async def boot_server(args):
+    """Import the app wired to the benchmark database and return the server module."""
+    if "bench" not in args.db_name:
+        raise SystemExit("--db-name must contain 'bench'; the database is dropped before each run")
+    os.environ["MONGO_URL"] = args.mongo_url
+    os.environ["DB_NAME"] = args.db_name
+    from backend import server
+
+    if args.mock:
+        try:
+            from mongomock_motor import AsyncMongoMockClient
+        except ImportError:
+            raise SystemExit("--mock needs mongomock-motor: pip install mongomock-motor")
+        server.client = AsyncMongoMockClient()
+        server.db = server.client[args.db_name]
+    else:
+        await server.client.drop_database(args.db_name)
+    await server.ensure_indexes()
+    return server
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = min(len(sorted_values), max(1, math.ceil(q / 100 * len(sorted_values))))
+    return sorted_values[rank - 1]
+
+
+class LatencyRecorder:
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.started = time.perf_counter()
+
+    def record(self, route: str, seconds: float, ok: bool = True):
+        self.samples.setdefault(route, []).append(seconds)
+        if not ok:
+            self.errors[route] = self.errors.get(route, 0) + 1
+
+    def summary(self) -> dict:
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        routes = {}
+        for route, values in sorted(self.samples.items()):
+            values = sorted(values)
+            routes[route] = {
+                "count": len(values),
+                "errors": self.errors.get(route, 0),
+                "p50_ms": round(percentile(values, 50) * 1000, 3),
+                "p95_ms": round(percentile(values, 95) * 1000, 3),
+                "p99_ms": round(percentile(values, 99) * 1000, 3),
+                "rps": round(len(values) / elapsed, 2),
+            }
+        total = sum(len(v) for v in self.samples.values())
+        return {"elapsed_s": round(elapsed, 3), "total_rps": round(total / elapsed, 2), "routes": routes}
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_report(name: str, args, levels: List[dict], extra: Optional[dict] = None) -> Path:
+    commit = git_commit()
+    report = {
+        "benchmark": name,
+        "commit": commit,
+        "created_at": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "backend": "mongomock" if args.mock else "mongod",
+        **(extra or {}),
+        "levels": levels,
+    }
+    path = Path(args.output) if args.output else BASELINE_DIR / f"{name}-{commit or 'local'}.json"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(report, indent=2))
+    print(f"Report written to {path}")
+    return path
+
+
+def compare_reports(current_path: Path, baseline_path: str, max_regression: float) -> bool:
+    """Print per-route deltas against a baseline. Returns False when something regressed."""
+    current = json.loads(Path(current_path).read_text())
+    baseline = json.loads(Path(baseline_path).read_text())
+    base_levels = {lvl["concurrency"]: lvl for lvl in baseline.get("levels", [])}
+    ok = True
+    for level in current.get("levels", []):
+        base = base_levels.get(level["concurrency"])
+        if not base:
+            continue
+        for route, stats in level["routes"].items():
+            old = base["routes"].get(route)
+            if not old or not old["p95_ms"] or not old["rps"]:
+                continue
+            p95_delta = (stats["p95_ms"] - old["p95_ms"]) / old["p95_ms"] * 100
+            rps_delta = (stats["rps"] - old["rps"]) / old["rps"] * 100
+            regressed = p95_delta > max_regression or -rps_delta > max_regression
+            ok = ok and not regressed
+            print(
+                f"{'REGRESSED' if regressed else 'ok':9} c={level['concurrency']:<4} {route:28} "
+                f"p95 {old['p95_ms']:.1f} -> {stats['p95_ms']:.1f} ms ({p95_delta:+.0f}%)  "
+                f"rps {old['rps']:.1f} -> {stats['rps']:.1f} ({rps_delta:+.0f}%)"
+            )
+    return ok
@@ -0,0 +1,249 @@
+"""Load test for the /ws/chat websocket.
+
+Boots `backend.server.app` under uvicorn inside this process, seeds N verified
+users paired into conversations, and opens one authenticated websocket per user
+(tokens come from `create_access_token`). Each level then:
+
+1. connects all clients and measures connect latency and RSS per connection
+   (both socket ends live in this process, so treat it as an upper bound);
+2. runs mixed traffic for --duration seconds: ping/pong, typing and read frames,
+   and messages posted through /api/conversations/{id}/messages, timing the
+   fan-out until the other participants receive the event;
+3. drops --storm-fraction of the clients at once and reconnects them, timing the
+   storm and counting the presence_update frames it triggers.
+
+    python scripts/bench_ws.py --mock --clients 100,500,2000 --duration 20
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import resource
+import time
+
+import httpx
+import uvicorn
+import websockets
+
+from bench_common import LatencyRecorder, add_backend_args, boot_server, compare_reports, write_report
+
+
+def rss_kb() -> int:
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+class Harness:
+    def __init__(self, server, base_url: str):
+        self.server = server
+        self.base_url = base_url
+        self.ws_url = base_url.replace("http://", "ws://") + "/ws/chat"
+        self.recorder = LatencyRecorder()
+        self.messages_sent = {}  # marker -> perf_counter at send
+        self.typing_sent = {}  # (conversation_id, user_id) -> perf_counter at send
+        self.presence_frames = 0
+        self.markers = itertools.count()
+
+    async def seed(self, count: int, group_size: int) -> list:
+        password_hash = self.server.hash_password("bench-pass-123")
+        users = []
+        for i in range(count):
+            user = self.server.User(email=f"ws{i}@bench.local", name=f"WS Bench {i}", is_verified=True).dict()
+            user["password_hash"] = password_hash
+            users.append(user)
+        await self.server.db.users.insert_many(users)
+
+        clients = []
+        for start in range(0, count, group_size):
+            group = users[start:start + group_size]
+            conversation = self.server.Conversation(participants=[u["id"] for u in group]).dict()
+            await self.server.db.conversations.insert_one(conversation)
+            for user in group:
+                token = self.server.create_access_token({"sub": user["id"]})
+                clients.append(WsClient(self, user["id"], token, conversation["id"]))
+        return clients
+
+
+class WsClient:
+    def __init__(self, harness: Harness, user_id: str, token: str, conversation_id: str):
+        self.harness = harness
+        self.user_id = user_id
+        self.token = token
+        self.conversation_id = conversation_id
+        self.ws = None
+        self.reader_task = None
+        self.pending_pings = []
+        self.connected = None
+
+    async def connect(self):
+        self.connected = asyncio.get_running_loop().create_future()
+        started = time.perf_counter()
+        self.ws = await websockets.connect(f"{self.harness.ws_url}?token={self.token}", max_queue=None)
+        self.reader_task = asyncio.create_task(self.read_loop())
+        await asyncio.wait_for(self.connected, timeout=30)
+        return time.perf_counter() - started
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+            await asyncio.gather(self.reader_task, return_exceptions=True)
+        self.ws = self.reader_task = None
+
+    async def read_loop(self):
+        recorder = self.harness.recorder
+        async for raw in self.ws:
+            now = time.perf_counter()
+            event = json.loads(raw)
+            kind = event.get("type")
+            payload = event.get("payload") or {}
+            if kind == "connected" and not self.connected.done():
+                self.connected.set_result(True)
+            elif kind == "pong" and self.pending_pings:
+                recorder.record("ping_rtt", now - self.pending_pings.pop(0))
+            elif kind == "presence_update":
+                self.harness.presence_frames += 1
+            elif kind == "new_message":
+                message = payload.get("message") or {}
+                sent_at = self.harness.messages_sent.get(message.get("content"))
+                if sent_at is not None and message.get("sender_id") != self.user_id:
+                    recorder.record("message_fanout", now - sent_at)
+            elif kind == "typing" and payload.get("user_id") != self.user_id:
+                sent_at = self.harness.typing_sent.get((event.get("conversation_id"), payload.get("user_id")))
+                if sent_at is not None:
+                    recorder.record("typing_fanout", now - sent_at)
+
+    async def act(self, http: httpx.AsyncClient):
+        roll = random.random()
+        if roll < 0.5:
+            self.pending_pings.append(time.perf_counter())
+            await self.ws.send('{"type": "ping"}')
+        elif roll < 0.75:
+            self.harness.typing_sent[(self.conversation_id, self.user_id)] = time.perf_counter()
+            await self.ws.send(f'{{"type": "typing", "conversation_id": "{self.conversation_id}", "is_typing": true}}')
+        elif roll < 0.85:
+            await self.ws.send(f'{{"type": "read", "conversation_id": "{self.conversation_id}"}}')
+        else:
+            marker = f"bench:{next(self.harness.markers)}"
+            self.harness.messages_sent[marker] = started = time.perf_counter()
+            response = await http.post(
+                f"/api/conversations/{self.conversation_id}/messages",
+                params={"content": marker}, headers={"Authorization": f"Bearer {self.token}"},
+            )
+            self.harness.recorder.record("message_post", time.perf_counter() - started, response.status_code < 400)
+
+
+async def connect_all(clients, batch: int, recorder: LatencyRecorder, route: str):
+    for start in range(0, len(clients), batch):
+        durations = await asyncio.gather(*(c.connect() for c in clients[start:start + batch]), return_exceptions=True)
+        for duration in durations:
+            if isinstance(duration, Exception):
+                recorder.record(route, 0.0, ok=False)
+            else:
+                recorder.record(route, duration)
+
+
+async def run_level(harness: Harness, count: int, args) -> dict:
+    harness.recorder = LatencyRecorder()
+    harness.presence_frames = 0
+    await harness.server.db.users.delete_many({"email": {"$regex": "@bench\\.local$"}})
+    clients = await harness.seed(count, args.group_size)
+
+    rss_before = rss_kb()
+    await connect_all(clients, args.connect_batch, harness.recorder, "connect")
+    rss_per_connection = (rss_kb() - rss_before) / max(count, 1)
+    connect_presence = harness.presence_frames
+
+    deadline = time.perf_counter() + args.duration
+    async with httpx.AsyncClient(base_url=harness.base_url, timeout=30) as http:
+        async def drive(client):
+            await asyncio.sleep(random.random() * args.interval)
+            while time.perf_counter() < deadline:
+                try:
+                    await client.act(http)
+                except Exception:
+                    harness.recorder.record("client_error", 0.0, ok=False)
+                await asyncio.sleep(args.interval)
+
+        await asyncio.gather(*(drive(c) for c in clients))
+    await asyncio.sleep(0.5)  # let in-flight fan-out land
+
+    stormed = random.sample(clients, int(len(clients) * args.storm_fraction))
+    harness.presence_frames = 0
+    storm_started = time.perf_counter()
+    await asyncio.gather(*(c.close() for c in stormed))
+    await connect_all(stormed, len(stormed) or 1, harness.recorder, "reconnect")
+    storm_seconds = time.perf_counter() - storm_started
+    storm_presence = harness.presence_frames
+
+    await asyncio.gather(*(c.close() for c in clients))
+    summary = harness.recorder.summary()
+    return {
+        "concurrency": count,
+        **summary,
+        "rss_per_connection_kb": round(rss_per_connection, 2),
+        "presence_frames_on_connect": connect_presence,
+        "storm": {
+            "clients": len(stormed),
+            "duration_s": round(storm_seconds, 3),
+            "presence_frames": storm_presence,
+        },
+    }
+
+
+async def main(args):
+    raise_fd_limit()
+    server = await boot_server(args)
+    config = uvicorn.Config(server.app, host="127.0.0.1", port=args.port, log_level="warning", lifespan="off")
+    uv = uvicorn.Server(config)
+    serve_task = asyncio.create_task(uv.serve())
+    while not uv.started:
+        await asyncio.sleep(0.05)
+
+    harness = Harness(server, f"http://127.0.0.1:{args.port}")
+    levels = []
+    try:
+        for count in [int(c) for c in args.clients.split(",")]:
+            level = await run_level(harness, count, args)
+            levels.append(level)
+            print(f"clients={count:<6} rss/conn={level['rss_per_connection_kb']}KB "
+                  f"storm={level['storm']['duration_s']}s presence_frames={level['storm']['presence_frames']}")
+            for route, stats in level["routes"].items():
+                print(f"  {route:16} n={stats['count']:<7} err={stats['errors']:<5} "
+                      f"p50={stats['p50_ms']:.1f}ms p95={stats['p95_ms']:.1f}ms p99={stats['p99_ms']:.1f}ms")
+    finally:
+        uv.should_exit = True
+        await serve_task
+
+    extra = {"duration_s": args.duration, "interval_s": args.interval, "group_size": args.group_size,
+             "storm_fraction": args.storm_fraction}
+    path = write_report("ws", args, levels, extra)
+    if args.compare and not compare_reports(path, args.compare, args.max_regression):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_backend_args(parser)
+    parser.add_argument("--clients", default="100,500", help="comma-separated client counts to sweep")
+    parser.add_argument("--duration", type=float, default=15.0, help="seconds of traffic per level")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between actions per client")
+    parser.add_argument("--group-size", type=int, default=2, help="participants per conversation")
+    parser.add_argument("--connect-batch", type=int, default=200, help="clients connecting concurrently")
+    parser.add_argument("--storm-fraction", type=float, default=0.5, help="share of clients dropped in the reconnect storm")
+    parser.add_argument("--port", type=int, default=8765)
+    asyncio.run(main(parser.parse_args()))
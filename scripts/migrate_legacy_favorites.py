@@ -0,0 +1,26 @@
+"""One-off migration: give legacy {user_id, pet_id} favorites the keyed like shape.
+
+Pet likes and favorites share keyed rows ({user_id, item_type, item_id}); rows
+written before that only carry `pet_id`. Run from the repository root with the
+backend's MONGO_URL / DB_NAME set, then let `reconcile_like_counters` realign
+`pets.likes`:
+
+    python scripts/migrate_legacy_favorites.py
+"""
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from backend import server  # noqa: E402
+
+
+async def main():
+    migrated = await server.migrate_legacy_favorites()
+    print(f"Migrated {migrated} legacy favorites")
+    server.client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,983 @@
+import asyncio
+import json
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+from tests.test_api_security_rbac import _query_budget, _signup_and_verify, client_and_db  # noqa: F401
+
+from backend import server  # noqa: E402
+
+
+def test_unread_notification_counter_tracks_writes(client_and_db):
+    client, db = client_and_db
+    token, user = _signup_and_verify(client, "counter@test.com", name="Counter")
+    headers = {"Authorization": f"Bearer {token}"}
+
+    asyncio.run(server.create_notification(user["id"], "Hello", "First"))
+    asyncio.run(server.create_notification(user["id"], "Hello", "Second"))
+
+    r = client.get("/api/notifications/unread-count", headers=headers)
+    assert r.status_code == 200
+    assert r.json()["count"] == 2
+    page = client.get("/api/notifications?limit=1", headers=headers).json()
+    assert (page["total"], page["has_more"]) == (2, True)
+    assert client.get("/api/notifications?include_total=false", headers=headers).json()["total"] is None
+
+    with _query_budget(1):  # every recipient's chat counter in one batched write
+        asyncio.run(server.record_chat_unread("c1", "sender", ["sender", user["id"], "other", user["id"]]))
+    counters = {row["user_id"]: row.get("chat_unread") for row in db.user_counters.rows}
+    assert (counters[user["id"]], counters["other"]) == ({"c1": 1}, {"c1": 1}) and "sender" not in counters
+
+    notif_id = db.notifications.rows[0]["id"]
+    assert client.put(f"/api/notifications/{notif_id}/read", headers=headers).status_code == 200
+    # marking the same notification twice must not decrement again
+    assert client.put(f"/api/notifications/{notif_id}/read", headers=headers).status_code == 200
+    assert client.get("/api/notifications/unread-count", headers=headers).json()["count"] == 1
+
+    assert client.delete("/api/notifications/clear-all", headers=headers).status_code == 200
+    assert client.get("/api/notifications/unread-count", headers=headers).json()["count"] == 0
+
+
+def test_delete_account_tombstones_and_cascades(client_and_db):
+    client, db = client_and_db
+    token, user = _signup_and_verify(client, "gone@test.com", name="Gone")
+    headers = {"Authorization": f"Bearer {token}"}
+    db.pets.rows.append({"id": "p1", "owner_id": user["id"], "name": "Rex", "species": "dog", "gender": "male"})
+    db.friendships.rows.append({"id": "f1", "users": [user["id"], "other"]})
+    db.pet_tags.rows.append({"id": "t1", "tag_code": "GONE1", "pet_id": "p1", "owner_id": user["id"]})
+    db.tag_scans.rows.append({"id": "s1", "tag_code": "GONE1", "pet_id": "p1", "scanner_phone": "555"})
+    db.tag_scans_archive.rows.append({"id": "s0", "tag_code": "GONE1", "pet_id": "p1", "scanner_phone": "555"})
+    db.orders.rows.append({"id": "o1", "user_id": user["id"], "items": [], "total": 5, "shipping_address": "1 Main St",
+                           "shipping_city": "Town", "shipping_phone": "555", "notes": "ring twice"})
+
+    r = client.post("/api/auth/delete-account", json={"password": "secret123"}, headers=headers)
+    assert r.status_code == 200
+    job_id = r.json()["job_id"]
+
+    job = next(j for j in db.account_deletions.rows if j["id"] == job_id)
+    assert job["status"] == "completed"
+    assert all(state == "done" for state in job["steps"].values())
+    assert not any(u["id"] == user["id"] for u in db.users.rows)
+    assert db.pets.rows == [] and db.friendships.rows == []
+    assert db.pet_tags.rows == [] and db.tag_scans.rows == [] and db.tag_scans_archive.rows == []
+    order = db.orders.rows[0]
+    assert (order["total"], order["shipping_address"], order["shipping_phone"], order["notes"]) == (5, "", "", None)
+    assert client.get("/api/auth/me", headers=headers).status_code == 401
+    assert client.post("/api/auth/signup", json={"email": "gone@test.com", "password": "secret123", "name": "Back"}).status_code == 200
+
+    _token, pending_user = _signup_and_verify(client, "pending@test.com", name="Pending")
+    asyncio.run(server.schedule_account_deletion(pending_user["id"], pending_user["id"]))  # cascade not run yet
+    assert client.post("/api/auth/signup", json={"email": "pending@test.com", "password": "secret123", "name": "Again"}).status_code == 200
+
+
+def test_admin_delete_of_unknown_user_is_404_and_schedules_nothing(client_and_db):
+    client, db = client_and_db
+    admin_token, admin = _signup_and_verify(client, "deladmin@test.com", name="Admin")
+    admin.update({"role": "admin", "is_admin": True})
+
+    r = client.delete("/api/admin/users/no-such-user", headers={"Authorization": f"Bearer {admin_token}"})
+    assert r.status_code == 404
+    assert db.account_deletions.rows == []
+
+
+def test_pet_like_toggle_keeps_counter_in_step(client_and_db):
+    client, db = client_and_db
+    token, user = _signup_and_verify(client, "liker@test.com", name="Liker")
+    headers = {"Authorization": f"Bearer {token}"}
+    db.pets.rows.append({"id": "pet-1", "owner_id": "someone", "name": "Rex", "species": "cat", "gender": "male", "likes": 0})
+
+    r = client.post("/api/pets/pet-1/like", headers=headers)
+    assert r.json() == {"liked": True}
+    assert db.pets.rows[0]["likes"] == 1
+    assert db.favorites.rows[0]["item_type"] == "pet" and db.favorites.rows[0]["pet_id"] == "pet-1"
+
+    r = client.post("/api/pets/pet-1/like", headers=headers)
+    assert r.json() == {"liked": False}
+    assert db.pets.rows[0]["likes"] == 0
+    assert db.favorites.rows == []
+
+    assert client.post("/api/pets/missing/like", headers=headers).status_code == 404
+    assert db.favorites.rows == []
+
+
+def test_like_reconcile_counts_legacy_favorites_and_only_rechecks_reacted_items(client_and_db, monkeypatch):
+    client, db = client_and_db
+    token, user = _signup_and_verify(client, "reconcile@test.com", name="R")
+    for pet_id, likes in (("pet-legacy", 0), ("pet-liked", 0), ("pet-quiet", 7)):
+        db.pets.rows.append({"id": pet_id, "owner_id": "o", "name": pet_id, "species": "cat", "gender": "male", "likes": likes})
+    db.favorites.rows.append({"_id": "old", "id": "old", "user_id": "someone", "pet_id": "pet-legacy"})  # not yet migrated
+    asked = []
+
+    async def count_like_rows(item_type, target, item_ids, legacy_pending):  # the fake has no aggregate
+        asked.append((item_type, item_ids))
+        counts = {}
+        for row in db[target["rows"]].rows:
+            keyed = row.get("item_type") == item_type
+            legacy = legacy_pending and target["legacy_key"] and "item_type" not in row
+            item_id = row.get("item_id") if keyed else row.get(target["legacy_key"]) if legacy else None
+            if item_id and (item_ids is None or item_id in item_ids):
+                counts[item_id] = counts.get(item_id, 0) + 1
+        return counts
+
+    monkeypatch.setattr(server, "count_like_rows", count_like_rows)
+    asyncio.run(server.reconcile_like_counters())  # first run: every item
+    assert {p["id"]: p["likes"] for p in db.pets.rows} == {"pet-legacy": 1, "pet-liked": 0, "pet-quiet": 0}
+
+    db.pets.rows[2]["likes"] = 7  # drift on an item nobody reacted to is left to the next full pass
+    client.post("/api/pets/pet-liked/like", headers={"Authorization": f"Bearer {token}"})
+    asked.clear()
+    asyncio.run(server.reconcile_like_counters())
+    assert asked == [("pet", ["pet-liked"])]
+    assert {p["id"]: p["likes"] for p in db.pets.rows} == {"pet-legacy": 1, "pet-liked": 1, "pet-quiet": 7}
+
+    assert asyncio.run(server.migrate_legacy_favorites()) == 1
+    assert asyncio.run(server.legacy_favorites_migrated())
+
+
+def test_view_counter_buffer_aggregates_until_flush(client_and_db):
+    client, db = client_and_db
+    db.pets.rows.append({"id": "pet-v", "owner_id": "o", "name": "Viewed", "species": "cat", "gender": "female", "views": 0})
+    server.view_counters.pending.clear()
+
+    for _ in range(3):
+        assert client.get("/api/pets/pet-v").status_code == 200
+    assert db.pets.rows[0]["views"] == 0
+
+    written = asyncio.run(server.view_counters.flush())
+    assert written == 1
+    assert db.pets.rows[0]["views"] == 3
+
+
+def test_view_counter_flush_drops_rejected_writes_and_caps_retries(client_and_db, monkeypatch):
+    _client, db = client_and_db
+    counters = server.WriteBehindCounters(100, max_retries=2)
+    counters.add("pets", "id", "bad", {"views": 1})
+    counters.add("pets", "id", "flaky", {"views": 1})
+    counters.append("pet_events", {"id": "e1"})
+
+    async def rejecting_bulk_write(ops, ordered=True):
+        codes = {"bad": 14, "flaky": 91}  # type mismatch is permanent, shutdown in progress is not
+        raise BulkWriteError({"writeErrors": [
+            {"index": i, "code": codes[op._filter["id"]], "errmsg": "rejected"} for i, op in enumerate(ops)
+        ]})
+
+    async def offline_insert_many(docs, ordered=True):
+        raise AutoReconnect("primary stepped down")
+
+    monkeypatch.setattr(db.pets, "bulk_write", rejecting_bulk_write)
+    monkeypatch.setattr(db.pet_events, "insert_many", offline_insert_many)
+    for _ in range(2):
+        assert asyncio.run(counters.flush()) == 0
+        assert list(counters.pending) == [("pets", "id", "flaky")]  # the rejected write is gone
+        assert len(counters.inserts["pet_events"]) == 1
+    asyncio.run(counters.flush())
+    assert counters.pending == {} and counters.inserts == {}
+
+
+def test_view_counter_flush_survives_a_cancelled_caller(client_and_db, monkeypatch):
+    _client, db = client_and_db
+    db.pets.rows.append({"id": "pet-c", "views": 0})
+    counters = server.WriteBehindCounters(100)
+    counters.add("pets", "id", "pet-c", {"views": 2})
+    real_bulk_write = db.pets.bulk_write
+
+    async def slow_bulk_write(ops, ordered=True):
+        await asyncio.sleep(0.05)
+        await real_bulk_write(ops, ordered)
+
+    monkeypatch.setattr(db.pets, "bulk_write", slow_bulk_write)
+
+    async def shutdown():
+        job = asyncio.create_task(counters.flush())
+        await asyncio.sleep(0.01)
+        job.cancel()  # what shutdown does to the periodic flush job
+        await asyncio.gather(job, return_exceptions=True)
+        return await counters.flush()
+
+    asyncio.run(shutdown())
+    assert db.pets.rows[0]["views"] == 2 and counters.pending == {}
+
+
+def test_checkout_reserves_stock_and_redeems_points_once(client_and_db):
+    client, db = client_and_db
+    token, user = _signup_and_verify(client, "buyer@test.com", name="Buyer")
+    headers = {"Authorization": f"Bearer {token}"}
+    db.users.rows[-1]["loyalty_points"] = 500
+    db.products.rows.append({"id": "prod-1", "name": "Food", "price": 10.0, "quantity": 3, "in_stock": True})
+    db.carts.rows.append({"user_id": user["id"], "items": [{"product_id": "prod-1", "quantity": 2}]})
+    order = {
+        "items": [{"product_id": "prod-1", "name": "Food", "price": 10.0, "quantity": 2}],
+        "total": 23.99, "shipping_address": "1 Main St", "shipping_city": "Town", "shipping_phone": "555", "points_used": 200,
+    }
+
+    r = client.post("/api/orders", json=order, headers=headers)
+    assert r.status_code == 200
+    assert r.json()["subtotal"] == 20.0
+    assert (r.json()["shipping_cost"], r.json()["total"]) == (5.99, 23.99)  # 20 + shipping - 2 redeemed
+    assert db.products.rows[0]["quantity"] == 1
+    assert db.carts.rows[0]["items"] == []
+    assert db.users.rows[-1]["loyalty_points"] == 300
+
+    assert client.post("/api/orders", json=order, headers=headers).status_code == 409
+    assert db.products.rows[0]["quantity"] == 1
+
+    stale = dict(order, items=[dict(order["items"][0], price=5.0, quantity=1)])
+    assert client.post("/api/orders", json=stale, headers=headers).status_code == 409
+
+    under_total = dict(order, total=20.0)  # shipping left out
+    assert client.post("/api/orders", json=under_total, headers=headers).status_code == 409
+
+    assert asyncio.run(server.product_cache.get_many(["prod-1"]))["prod-1"]["in_stock"] is True  # cached
+    last = dict(order, items=[dict(order["items"][0], quantity=1)], total=15.99, points_used=0)
+    assert client.post("/api/orders", json=last, headers=headers).status_code == 200
+    assert db.products.rows[0]["quantity"] == 0 and db.products.rows[0]["in_stock"] is False
+    assert asyncio.run(server.product_cache.get_many(["prod-1"]))["prod-1"]["in_stock"] is False
+
+
+def test_failed_order_write_returns_stock_and_redeemed_points(client_and_db, monkeypatch):
+    client, db = client_and_db
+    token, user = _signup_and_verify(client, "unlucky@test.com", name="Unlucky")
+    headers = {"Authorization": f"Bearer {token}"}
+    db.users.rows[-1].update({"loyalty_points": 500, "lifetime_points": 500})
+    db.products.rows.append({"id": "prod-f", "name": "Food", "price": 60.0, "quantity": 2, "in_stock": True})
+
+    async def failing_insert(*args, **kwargs):
+        raise RuntimeError("primary went away")
+
+    monkeypatch.setattr(db.orders, "insert_one", failing_insert)
+    order = {
+        "items": [{"product_id": "prod-f", "name": "Food", "price": 60.0, "quantity": 1}],
+        "total": 57.0, "shipping_address": "1 Main St", "shipping_city": "Town", "shipping_phone": "555", "points_used": 300,
+    }
+    with pytest.raises(RuntimeError):
+        client.post("/api/orders", json=order, headers=headers)
+
+    assert db.products.rows[0]["quantity"] == 2
+    user_row = db.users.rows[-1]
+    assert (user_row["loyalty_points"], user_row["lifetime_points"]) == (500, 500)
+    assert client.get("/api/loyalty/points", headers=headers).json()["total_points"] == 500
+
+
+def test_payment_retry_with_same_idempotency_key_is_replayed(client_and_db):
+    client, db = client_and_db
+    token, _user = _signup_and_verify(client, "payer@test.com", name="Payer")
+    headers = {"Authorization": f"Bearer {token}", "Idempotency-Key": "pay-1"}
+    db.users.rows[-1]["loyalty_points"] = 100
+    db.payment_idempotency.unique = ("user_id", "key")
+    body = {"amount": 25.0, "payment_method": "stripe", "points_to_use": 100}
+
+    first = client.post("/api/payments/process", json=body, headers=headers)
+    assert first.status_code == 200
+    retry = client.post("/api/payments/process", json=body, headers=headers)
+    assert retry.json() == first.json()
+    assert len(db.payments.rows) == 1
+    assert db.users.rows[-1]["loyalty_points"] == 24  # 100 - 100 redeemed + 24 earned
+
+    reused = client.post("/api/payments/process", json=dict(body, amount=30.0), headers=headers)
+    assert reused.status_code == 422
+
+    payment_id = first.json()["payment_id"]
+    assert client.post(f"/api/payments/confirm/{payment_id}", headers=headers).status_code == 200
+    assert db.payments.rows[0]["status"] == "succeeded"
+    db.payments.rows[0]["status"] = "failed"
+    assert client.post(f"/api/payments/confirm/{payment_id}", headers=headers).status_code == 409
+
+
+def test_loyalty_ledger_carries_opening_balance_and_repairs_drift(client_and_db):
+    client, db = client_and_db
+    token, user = _signup_and_verify(client, "loyal@test.com", name="Loyal")
+    headers = {"Authorization": f"Bearer {token}"}
+    db.users.rows[-1].update({"loyalty_points": 450, "lifetime_points": 600})
+
+    r = client.get("/api/loyalty/points", headers=headers)
+    assert r.json()["total_points"] == 450 and r.json()["tier"] == "silver"
+    assert db.points_transactions.rows[0]["transaction_type"] == "opening_balance"
+
+    assert client.post("/api/loyalty/bonus?points=1500&description=promo", headers=headers).status_code == 200
+    r = client.get("/api/loyalty/points", headers=headers)
+    assert r.json()["total_points"] == 1950 and r.json()["tier"] == "gold"
+
+    db.users.rows[-1]["loyalty_points"] = 0  # materialised balance drifted
+    asyncio.run(server.reconcile_loyalty_ledgers())
+    assert db.users.rows[-1]["loyalty_points"] == 1950
+    assert db.loyalty_snapshots.rows[0]["balance"] == 1950
+
+    r = client.get("/api/loyalty/transactions?limit=1", headers=headers)
+    assert [t["transaction_type"] for t in r.json()] == ["bonus"]
+    rest = client.get(f"/api/loyalty/transactions?cursor={r.headers['X-Next-Cursor']}", headers=headers)
+    assert [t["transaction_type"] for t in rest.json()] == ["opening_balance"]
+    assert "X-Next-Cursor" not in rest.headers
+
+
+def test_loyalty_reconcile_replays_from_zero_and_yields_to_concurrent_posts(client_and_db, monkeypatch):
+    client, db = client_and_db
+    token, user = _signup_and_verify(client, "replay@test.com", name="Replay")
+    headers = {"Authorization": f"Bearer {token}"}
+    client.post("/api/loyalty/bonus?points=100&description=promo", headers=headers)
+    assert client.get("/api/loyalty/points", headers=headers).json()["total_points"] == 100
+
+    # A row that landed behind the snapshot position, without its balance update.
+    db.points_transactions.rows.append({"id": "0-late", "user_id": user["id"], "points": 50, "transaction_type": "bonus",
+                                        "description": "late", "created_at": datetime.utcnow() - timedelta(minutes=5)})
+    real_snapshot = server.snapshot_loyalty
+
+    async def snapshot_racing_a_post(user_id, full=False):
+        account = await real_snapshot(user_id, full)
+        db.users.rows[-1]["loyalty_points"] += 7  # post_points' $inc, ledger row not written yet
+        return account
+
+    monkeypatch.setattr(server, "snapshot_loyalty", snapshot_racing_a_post)
+    asyncio.run(server.reconcile_loyalty_ledgers())
+    assert db.users.rows[-1]["loyalty_points"] == 107  # the repair stood down
+
+    monkeypatch.setattr(server, "snapshot_loyalty", real_snapshot)
+    db.users.rows[-1]["loyalty_points"] = 100
+    asyncio.run(server.reconcile_loyalty_ledgers())
+    assert db.users.rows[-1]["loyalty_points"] == 150
+    assert db.loyalty_snapshots.rows[0]["balance"] == 150
+
+
+def test_loyalty_ledger_opens_before_the_first_points_write(client_and_db):
+    client, db = client_and_db
+    token, user = _signup_and_verify(client, "early@test.com", name="Early")
+    headers = {"Authorization": f"Bearer {token}"}
+    db.users.rows[-1].update({"loyalty_points": 300, "lifetime_points": 300})
+
+    # Points are posted before any snapshot exists; the carried-over balance must
+    # not also absorb the new entry once the snapshot is finally taken.
+    assert client.post("/api/loyalty/bonus?points=100&description=promo", headers=headers).status_code == 200
+    assert client.get("/api/loyalty/points", headers=headers).json()["total_points"] == 400
+    opening = [t for t in db.points_transactions.rows if t["transaction_type"] == "opening_balance"]
+    assert [t["points"] for t in opening] == [300]
+
+
+def test_cart_is_priced_from_catalogue_and_invalidated_on_product_update(client_and_db):
+    client, db = client_and_db
+    token, user = _signup_and_verify(client, "cart@test.com", name="Cart")
+    admin_token, admin = _signup_and_verify(client, "cartadmin@test.com", name="Admin")
+    admin.update({"role": "admin", "is_admin": True})
+    headers = {"Authorization": f"Bearer {token}"}
+    server.product_cache.entries.clear()
+    db.products.rows.append({"id": "prod-c", "name": "Toy", "price": 4.5, "in_stock": True})
+    db.carts.rows.append({"user_id": user["id"], "items": [
+        {"product_id": "prod-c", "quantity": 2, "price": 0.01},  # legacy client-sent price is ignored
+        {"product_id": "gone", "quantity": 1},
+    ]})
+
+    cart = client.get("/api/cart", headers=headers).json()
+    assert cart["total"] == 9.0
+    assert cart["items"][0]["name"] == "Toy" and cart["items"][1]["available"] is False
+
+    db.products.rows[0]["price"] = 5.0
+    assert client.get("/api/cart", headers=headers).json()["total"] == 9.0  # served from cache
+    r = client.put("/api/admin/products/prod-c", json={"price": 6.0}, headers={"Authorization": f"Bearer {admin_token}"})
+    assert r.status_code == 200
+    assert client.get("/api/cart", headers=headers).json()["total"] == 12.0
+
+
+def test_add_to_cart_upserts_and_merges_lines_in_one_update(client_and_db):
+    client, db = client_and_db
+    token, user = _signup_and_verify(client, "cartadd@test.com", name="Cart")
+    admin_token, admin = _signup_and_verify(client, "cartaddadmin@test.com", name="Admin")
+    admin.update({"role": "admin", "is_admin": True})
+    headers = {"Authorization": f"Bearer {token}"}
+    server.product_cache.entries.clear()
+    db.products.rows.append({"id": "prod-a", "name": "Ball", "price": 2.0, "in_stock": True})
+    assert client.get("/api/cart", headers=headers).status_code == 200  # no cart yet
+
+    client.post("/api/cart/add", json={"product_id": "prod-a", "quantity": 1}, headers=headers)
+    with _query_budget(2):  # auth and a single upserting update; the product comes from the cache
+        client.post("/api/cart/add", json={"product_id": "prod-a", "quantity": 2, "price": 0.01}, headers=headers)
+    cart = [c for c in db.carts.rows if c["user_id"] == user["id"]]
+    assert len(cart) == 1 and cart[0]["items"] == [{"product_id": "prod-a", "quantity": 3}]
+
+    assert client.post("/api/cart/add", json={"product_id": "prod-b"}, headers=headers).status_code == 404
+    client.post("/api/admin/products", json={"id": "prod-b", "name": "Bone", "price": 3.0, "in_stock": True},
+                headers={"Authorization": f"Bearer {admin_token}"})
+    assert client.post("/api/cart/add", json={"product_id": "prod-b"}, headers=headers).status_code == 200
+    assert client.get("/api/cart", headers=headers).json()["total"] == 9.0
+
+
+def test_community_list_reads_stored_comment_counters_and_fills_factory_defaults(client_and_db):
+    client, db = client_and_db
+    db.community.rows.extend([
+        {"id": f"post-{i}", "user_id": "u", "user_name": "U", "type": "tip", "title": f"t{i}", "content": "c",
+         "created_at": datetime.utcnow() - timedelta(minutes=i), "comments": i}
+        for i in range(3)
+    ])
+    db.community.rows.append({"user_id": "u", "user_name": "U", "type": "tip", "title": "legacy", "content": "c",
+                              "created_at": datetime.utcnow() - timedelta(hours=1)})
+
+    with _query_budget(1):  # one find; no per-post comment counts
+        posts = client.get("/api/community").json()
+    assert [p["comments_count"] for p in posts] == [0, 1, 2, 0]
+    assert posts[-1]["id"]  # filled by the model's default_factory, as the validated path would
+
+
+def test_signup_allocates_usernames_from_per_base_counter(client_and_db):
+    client, db = client_and_db
+    for i in range(3):
+        r = client.post("/api/auth/signup", json={"email": f"ahmad{i}@test.com", "name": "Ahmad", "password": "secret123"})
+        assert r.status_code == 200
+    assert [u["username"] for u in db.users.rows] == ["ahmad", "ahmad2", "ahmad3"]
+    assert db.username_counters.rows == [{"base": "ahmad", "seq": 3}]
+
+
+def test_username_counters_are_seeded_and_signup_falls_back_to_a_random_suffix(client_and_db):
+    client, db = client_and_db
+    db.users.unique = ("username",)
+    db.users.rows.extend({"id": f"legacy-{i}", "username": name} for i, name in enumerate(
+        ["sara", *(f"sara{n}" for n in range(2, 12))]))
+
+    r = client.post("/api/auth/signup", json={"email": "sara@test.com", "name": "Sara", "password": "secret123"})
+    assert r.status_code == 200
+    fallback = db.users.rows[-1]["username"]
+    assert fallback.startswith("sara") and len(fallback) >= 9
+
+    db.username_counters.rows.clear()
+    asyncio.run(server.seed_username_counters())
+    assert db.username_counters.rows == [{"base": "sara", "seq": 11}]
+    client.post("/api/auth/signup", json={"email": "sara2@test.com", "name": "Sara", "password": "secret123"})
+    assert db.users.rows[-1]["username"] == "sara12"
+
+
+def test_admin_metrics_expose_route_histograms_and_query_attribution(client_and_db):
+    client, _db = client_and_db
+    user_token, _ = _signup_and_verify(client, "metrics-user@test.com")
+    admin_token, admin = _signup_and_verify(client, "metrics-admin@test.com", name="Admin")
+    admin.update({"role": "admin", "is_admin": True})
+
+    stats = server.RequestQueryStats()
+    token = server.current_request_queries.set(stats)
+    listener = server.mongo_command_metrics
+    listener.started(SimpleNamespace(command_name="find", command={"find": "users"}, request_id=1))
+    listener.succeeded(SimpleNamespace(
+        command_name="find", request_id=1, duration_micros=1500, reply={"cursor": {"firstBatch": [{}, {}]}},
+    ))
+    server.current_request_queries.reset(token)
+    assert (stats.count, stats.docs) == (1, 2)
+
+    client.get("/api/pets/some-id")
+    assert client.get("/api/admin/metrics", headers={"Authorization": f"Bearer {user_token}"}).status_code == 403
+    body = client.get("/api/admin/metrics", headers={"Authorization": f"Bearer {admin_token}"}).text
+    assert 'petsy_http_responses_total{method="GET",route="/api/pets/{pet_id}",status="404"} 1' in body
+    assert 'petsy_mongo_documents_returned_total{collection="users",command="find"}' in body
+
+
+def test_admin_orders_listing_stays_within_query_budget(client_and_db):
+    client, db = client_and_db
+    admin_token, admin = _signup_and_verify(client, "orders-admin@test.com", name="Admin")
+    admin.update({"role": "admin", "is_admin": True})
+    for i in range(25):
+        db.orders.rows.append({"id": f"o{i}", "user_id": admin["id"], "items": [], "total": 1, "created_at": datetime.utcnow()})
+
+    with _query_budget(3):  # auth lookup, orders, one batched users lookup
+        r = client.get("/api/admin/orders", headers={"Authorization": f"Bearer {admin_token}"})
+    assert r.status_code == 200 and r.json()[0]["user_name"] == "Admin"
+
+
+def test_sampling_profiler_writes_collapsed_stacks(monkeypatch, tmp_path):
+    monkeypatch.setattr(server, "PROFILER_OUTPUT_DIR", tmp_path)
+    profiler = server.SamplingProfiler()
+
+    def spin(seconds):
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            pass
+
+    async def run():
+        profiler.start(duration_seconds=30, interval_ms=1)
+        await asyncio.sleep(0.05)
+        spin(0.1)  # stall the loop so the lag probe and the sampler both notice
+        await asyncio.sleep(0.06)
+        return await profiler.stop()
+
+    result = asyncio.run(run())
+    assert result["samples"] > 0 and not profiler.running
+    assert result["loop_lag_ms"]["max"] >= 40
+    collapsed = (tmp_path / Path(result["collapsed_stacks"]).name).read_text()
+    assert "spin (test_api_counters.py" in collapsed
+
+
+def test_trusted_projection_matches_validated_response(client_and_db, monkeypatch):
+    client, db = client_and_db
+    token, user = _signup_and_verify(client, "fastjson@test.com", name="Fast")
+    created = client.post(
+        "/api/pets", headers={"Authorization": f"Bearer {token}"},
+        json={"name": "Rex", "species": "dog", "gender": "male", "image": "data:image/png;base64,AAAA"},
+    )
+    assert created.status_code == 200
+    db.pets.rows.append({"id": "legacy", "owner_id": user["id"], "name": "Old", "species": "cat", "gender": "female",
+                         "created_at": datetime(2025, 1, 2, 3, 4, 5, 678901), "_id": "oid", "stray": True})
+
+    expected = [server.Pet(**row).model_dump(mode="json") for row in db.pets.rows]
+    for fast in (False, True):
+        monkeypatch.setattr(server, "FAST_JSON_RESPONSES", fast)
+        assert client.get("/api/pets").json() == expected
+
+
+def test_sparse_fieldsets_project_list_endpoints(client_and_db):
+    client, db = client_and_db
+    token, admin = _signup_and_verify(client, "fields@test.com", name="Fields")
+    admin.update({"role": "admin", "is_admin": True})
+    headers = {"Authorization": f"Bearer {token}"}
+    client.post("/api/pets", headers=headers, json={"name": "Rex", "species": "dog", "gender": "male", "image": "data:,x"})
+
+    assert client.get("/api/pets?fields=name,species").json() == [{"id": db.pets.rows[0]["id"], "name": "Rex", "species": "dog"}]
+
+    users = client.get("/api/admin/users?fields=email,role", headers=headers).json()
+    assert users == [{"id": admin["id"], "email": "fields@test.com", "role": "admin"}]
+
+    bad = client.get("/api/friends?fields=password_hash", headers=headers)
+    assert bad.status_code == 400 and bad.json()["detail"]["code"] == "INVALID_FIELDS"
+
+
+def test_catalogue_responses_are_compressed_once_and_revalidated_by_etag(client_and_db, monkeypatch):
+    client, db = client_and_db
+    token, admin = _signup_and_verify(client, "catalog@test.com", name="Catalog")
+    admin.update({"role": "admin", "is_admin": True})
+    for i in range(40):
+        db.products.rows.append(server.Product(name=f"Food {i}", category="food", price=9.5, pet_type="dog",
+                                               description="Crunchy kibble " * 5).dict())
+    compressed = []
+    real_compress = server.compress_body
+    monkeypatch.setattr(server, "compress_body", lambda enc, body: compressed.append(enc) or real_compress(enc, body))
+
+    first = client.get("/api/products", headers={"Accept-Encoding": "gzip"})
+    again = client.get("/api/products", headers={"Accept-Encoding": "gzip"})
+    assert first.headers["content-encoding"] == "gzip" and len(first.json()) == 40
+    assert again.headers["etag"] == first.headers["etag"] and compressed == ["gzip"]
+
+    assert client.get("/api/products", headers={"If-None-Match": first.headers["etag"]}).status_code == 304
+
+    product_id = db.products.rows[0]["id"]
+    client.put(f"/api/admin/products/{product_id}", json={"price": 7.0}, headers={"Authorization": f"Bearer {token}"})
+    assert client.get("/api/products").headers["etag"] != first.headers["etag"]
+
+
+def test_compression_middleware_negotiates_and_respects_threshold(client_and_db):
+    client, _db = client_and_db
+    assert server.negotiate_encoding("gzip;q=0.5, br;q=0.2") == "gzip"
+    assert server.negotiate_encoding("identity, gzip;q=0") is None
+
+    big = client.get("/openapi.json", headers={"Accept-Encoding": "gzip"})
+    assert big.headers["content-encoding"] == "gzip" and "Accept-Encoding" in big.headers["vary"]
+    small = client.get("/api/health", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in small.headers
+
+
+def test_compression_middleware_flushes_each_streamed_chunk():
+    rows = [b'{"id": "o1"}\n', b'{"id": "o2"}\n']
+
+    async def ndjson_app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/x-ndjson")]})
+        for row in rows:
+            await send({"type": "http.response.body", "body": row, "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "headers": [(b"accept-encoding", b"gzip")]}
+    asyncio.run(server.CompressionMiddleware(ndjson_app)(scope, None, send))
+    decoder = server.zlib.decompressobj(31)
+    bodies = [m["body"] for m in sent if m["type"] == "http.response.body"]
+    assert [decoder.decompress(body) for body in bodies[:2]] == rows  # each row decodable on arrival
+    assert decoder.decompress(bodies[2]) == b"" and decoder.eof
+
+
+def test_admin_export_streams_all_rows_and_resumes_from_cursor(client_and_db):
+    client, db = client_and_db
+    token, admin = _signup_and_verify(client, "export@test.com", name="Exporter")
+    admin.update({"role": "admin", "is_admin": True})
+    headers = {"Authorization": f"Bearer {token}"}
+    for i in range(7):
+        db.orders.rows.append({"id": f"o{i}", "user_id": admin["id"], "items": [{"product_id": "p", "quantity": 1}],
+                               "total": 10 + i, "status": "paid" if i % 2 else "pending",
+                               "created_at": datetime(2026, 1, 1 + i), "shipping_address": "x"})
+
+    csv_export = client.get("/api/admin/exports/orders?format=csv&batch_size=3", headers=headers)
+    assert csv_export.status_code == 200 and csv_export.headers["content-type"].startswith("text/csv")
+    lines = csv_export.text.strip().splitlines()
+    assert lines[0].startswith("id,user_id,user_name") and len(lines) == 8
+    assert lines[1].startswith(f"o6,{admin['id']},Exporter,")
+
+    first = [json.loads(line) for line in client.get("/api/admin/exports/orders", headers=headers).text.splitlines()]
+    cursor = f"{first[2]['created_at']}|{first[2]['id']}"
+    rest = client.get("/api/admin/exports/orders", params={"cursor": cursor}, headers=headers).text.splitlines()
+    assert [json.loads(line)["id"] for line in rest] == ["o3", "o2", "o1", "o0"]
+
+    paid = client.get("/api/admin/exports/orders?status=paid", headers=headers).text.splitlines()
+    assert len(paid) == 3
+    assert any(r["action"] == "export" for r in db.admin_audit_logs.rows)
+
+
+def test_single_flight_shares_one_load_between_concurrent_reads():
+    flight = server.SingleFlight(ttl_seconds=60, max_entries=10)
+    calls = []
+
+    async def load():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"id": "p1"}
+
+    async def failing():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise server.HTTPException(status_code=404)
+
+    async def scenario():
+        results = await asyncio.gather(*(flight.do(("pet", "p1"), load) for _ in range(20)))
+        assert all(r is results[0] for r in results)
+        assert await flight.do(("pet", "p1"), load) is results[0]
+        flight.forget("pet")
+        await flight.do(("pet", "p1"), load)
+
+        errors = await asyncio.gather(*(flight.do(("pet", "gone"), failing) for _ in range(5)), return_exceptions=True)
+        assert all(isinstance(e, server.HTTPException) for e in errors)
+        assert ("pet", "gone") not in flight.results
+
+    asyncio.run(scenario())
+    assert len(calls) == 3 and flight.coalesced == 23 and flight.hits == 1
+
+
+def test_block_sets_hide_both_directions_and_refresh_on_unblock(client_and_db, monkeypatch):
+    client, db = client_and_db
+    token_a, user_a = _signup_and_verify(client, "blocker@test.com", name="A")
+    token_b, user_b = _signup_and_verify(client, "blocked@test.com", name="B")
+    headers_a, headers_b = {"Authorization": f"Bearer {token_a}"}, {"Authorization": f"Bearer {token_b}"}
+    for headers in (headers_a, headers_b):
+        client.post("/api/community", headers=headers, json={"type": "story", "title": "Hi", "content": "Hello"})
+
+    def authors(headers):
+        return {p["user_id"] for p in client.get("/api/community", headers=headers).json()}
+
+    assert client.post(f"/api/community/users/{user_b['id']}/block", headers=headers_a).status_code == 200
+    assert authors(headers_a) == {user_a["id"]}
+    assert authors(headers_b) == {user_b["id"]}
+
+    monkeypatch.setattr(server, "BLOCK_NIN_MAX", 0)  # force in-process filtering
+    server.block_lists.entries.clear()
+    assert authors(headers_a) == {user_a["id"]}
+
+    client.delete(f"/api/community/users/{user_b['id']}/block", headers=headers_a)
+    assert authors(headers_a) == authors(headers_b) == {user_a["id"], user_b["id"]}
+
+
+def test_cache_bumps_adopt_the_shared_version_and_flush_on_a_concurrent_writer(client_and_db):
+    client, db = client_and_db
+    cache = server.block_lists
+
+    async def scenario():
+        cache.store("kept", "row", cache.generation)
+        cache.store("dropped", "row", cache.generation)
+        await cache.invalidate("dropped")
+        after_own = (cache.version, set(cache.entries))
+        cache.store("kept-2", "row", cache.generation)
+        db.catalog_versions.rows[0]["version"] += 1  # another worker's bump we haven't synced yet
+        await cache.invalidate("nothing-cached")
+        return after_own, cache.version, set(cache.entries)
+
+    (own_version, own_entries), version, entries = asyncio.run(scenario())
+    assert (own_version, own_entries) == (1, {"kept"})
+    assert (version, entries) == (3, set())
+
+
+def test_home_timeline_fans_out_to_friends_and_pulls_followed_types(client_and_db, monkeypatch):
+    client, db = client_and_db
+    monkeypatch.setattr(server, "high_degree_cache", {"loaded_at": float("-inf"), "ids": frozenset()})
+    (token_a, user_a), (token_b, user_b), (token_c, user_c) = [
+        _signup_and_verify(client, f"timeline-{n}@test.com", name=n) for n in ("a", "b", "c")
+    ]
+    db.friendships.rows.append({"id": "f1", "users": [user_a["id"], user_b["id"]], "created_at": datetime.utcnow()})
+    client.put("/api/user-settings", json={"followed_post_types": ["tip"]}, headers={"Authorization": f"Bearer {token_a}"})
+
+    def post(token, kind, title):
+        r = client.post("/api/community", json={"type": kind, "title": title, "content": "..."},
+                        headers={"Authorization": f"Bearer {token}"})
+        return r.json()["id"]
+
+    liked = post(token_b, "story", "friend-old")
+    post(token_b, "story", "friend-new")
+    post(token_c, "tip", "followed-type")
+    post(token_c, "story", "stranger")
+    fanned = {(r["user_id"], r["author_id"]) for r in db.timelines.rows}
+    assert fanned == {(user_a["id"], user_b["id"]), (user_b["id"], user_b["id"]), (user_c["id"], user_c["id"])}
+
+    for hour, row in enumerate(db.community.rows):  # an hour apart, in creation order
+        row["created_at"] = datetime(2026, 3, 1, hour)
+        asyncio.run(server.rescore_post(row["id"]))
+    for liker in (token_a, token_c):
+        client.post(f"/api/community/{liked}/like", headers={"Authorization": f"Bearer {liker}"})
+    with _query_budget(1):  # every post's timeline rows re-ranked in one batched write
+        asyncio.run(server.flush_timeline_scores())
+
+    page = client.get("/api/community/timeline?limit=2", headers={"Authorization": f"Bearer {token_a}"}).json()
+    assert [p["title"] for p in page["items"]] == ["friend-old", "followed-type"]
+    rest = client.get(f"/api/community/timeline?limit=2&cursor={page['next_cursor']}",
+                      headers={"Authorization": f"Bearer {token_a}"}).json()
+    assert [p["title"] for p in rest["items"]] == ["friend-new"] and rest["next_cursor"] is None
+
+    admin_token, admin = _signup_and_verify(client, "timeline-admin@test.com", name="Admin")
+    admin.update({"role": "admin", "is_admin": True})
+    assert client.delete(f"/api/admin/community/{liked}", headers={"Authorization": f"Bearer {admin_token}"}).status_code == 200
+    assert not any(r["post_id"] == liked for r in db.timelines.rows)
+
+
+def test_timeline_pages_through_score_ties_and_backfills_new_friends(client_and_db, monkeypatch):
+    client, db = client_and_db
+    monkeypatch.setattr(server, "high_degree_cache", {"loaded_at": float("-inf"), "ids": frozenset()})
+    monkeypatch.setattr(server, "timeline_trim_owners", set())
+    (token_a, user_a), (token_b, user_b) = [_signup_and_verify(client, f"ties-{n}@test.com", name=n) for n in ("a", "b")]
+    auth_a, auth_b = {"Authorization": f"Bearer {token_a}"}, {"Authorization": f"Bearer {token_b}"}
+    for title in ("one", "two", "three"):
+        client.post("/api/community", json={"type": "story", "title": title, "content": "..."}, headers=auth_a)
+    for row in db.timelines.rows:
+        row["score"] = 1.0
+    assert server.timeline_trim_owners == {user_a["id"]}
+
+    seen, cursor = [], None
+    for _ in range(3):
+        page = client.get("/api/community/timeline", params={"limit": 1, **({"cursor": cursor} if cursor else {})},
+                          headers=auth_a).json()
+        seen += [p["title"] for p in page["items"]]
+        cursor = page["next_cursor"]
+    assert sorted(seen) == ["one", "three", "two"]
+    assert client.get("/api/community/timeline", params={"cursor": "nope"}, headers=auth_a).status_code == 400
+
+    request_id = client.post("/api/friends/requests", json={"target_user_id": user_a["id"]}, headers=auth_b).json()["request_id"]
+    client.put(f"/api/friends/requests/{request_id}", json={"action": "accept"}, headers=auth_a)
+    assert {r["post_id"] for r in db.timelines.rows if r["user_id"] == user_b["id"]} == {p["id"] for p in db.community.rows}
+    assert server.timeline_trim_owners == {user_a["id"], user_b["id"]}
+
+
+def test_empty_timeline_is_warmed_only_once(client_and_db, monkeypatch):
+    client, db = client_and_db
+    monkeypatch.setattr(server, "high_degree_cache", {"loaded_at": float("-inf"), "ids": frozenset()})
+    token, user = _signup_and_verify(client, "lonely@test.com", name="Lonely")
+    auth = {"Authorization": f"Bearer {token}"}
+    warmed = []
+    real_warm = server.warm_timeline
+
+    async def counting_warm(user_id):
+        warmed.append(user_id)
+        return await real_warm(user_id)
+
+    monkeypatch.setattr(server, "warm_timeline", counting_warm)
+    for _ in range(3):
+        assert client.get("/api/community/timeline", headers=auth).json()["items"] == []
+    assert warmed == [user["id"]]
+
+
+def test_trending_sort_reads_scores_refreshed_from_counters(client_and_db, monkeypatch):
+    client, db = client_and_db
+    monkeypatch.setattr(server, "trending_dirty", {c: set() for c in server.TRENDING_TARGETS})
+    token, _user = _signup_and_verify(client, "trending@test.com", name="T")
+    auth = {"Authorization": f"Bearer {token}"}
+    now = datetime.utcnow()
+
+    posts = [client.post("/api/community", json={"type": "story", "title": t, "content": "..."}, headers=auth).json()["id"]
+             for t in ("liked", "plain", "reported", "stale")]
+    for row, hours in zip(db.community.rows, (3, 2, 1, 100)):
+        row["created_at"] = now - timedelta(hours=hours)
+        server.mark_trending("community", row["id"])
+    other, _ = _signup_and_verify(client, "trending-2@test.com", name="T2")
+    for liker in (auth, {"Authorization": f"Bearer {other}"}):
+        client.post(f"/api/community/{posts[0]}/like", headers=liker)
+    client.post(f"/api/community/{posts[2]}/report", json={"reason": "spam"}, headers=auth)
+
+    listings = [client.post("/api/marketplace/listings", headers=auth, json={
+        "title": t, "description": "...", "category": "toys", "price": 5, "location": "Here"}).json()["id"] for t in ("viewed", "fresh")]
+    for row, hours in zip(db.marketplace_listings.rows, (2, 1)):
+        row["created_at"] = now - timedelta(hours=hours)
+    for _ in range(20):
+        client.get(f"/api/marketplace/listings/{listings[0]}")
+
+    asyncio.run(server.refresh_trending_scores())
+    assert "trending_score" not in db.community.rows[3]  # slid out of the window
+
+    trending = client.get("/api/community?sort=trending").json()
+    assert [p["title"] for p in trending] == ["liked", "plain", "reported"]
+    recent = client.get("/api/community").json()
+    assert [p["title"] for p in recent][:3] == ["reported", "plain", "liked"]
+    assert [r["title"] for r in client.get("/api/marketplace/listings?sort=trending").json()] == ["viewed", "fresh"]
+    assert client.get("/api/community?sort=random").status_code == 400
+
+
+def test_lost_and_found_reports_are_matched_and_both_parties_notified(client_and_db):
+    client, db = client_and_db
+    db.lost_found_matches.unique = ("pair",)
+    (token_a, user_a), (token_b, user_b) = [_signup_and_verify(client, f"lf-{n}@test.com", name=n) for n in ("a", "b")]
+
+    def report(token, kind, species, lat, lng, date, color="brown and white"):
+        r = client.post("/api/lost-found", headers={"Authorization": f"Bearer {token}"}, json={
+            "type": kind, "pet_species": species, "breed": "Labrador", "color": color, "description": "...",
+            "last_seen_location": "Mezzeh, Damascus", "last_seen_date": date, "contact_phone": "1",
+            "latitude": lat, "longitude": lng})
+        return r.json()["id"]
+
+    lost = report(token_a, "lost", "Dog", 33.5138, 36.2765, "2026-03-01")
+    found = report(token_b, "found", "dog", 33.5200, 36.2900, "2026-03-02", color="White, brown")
+    report(token_b, "found", "cat", 33.5200, 36.2900, "2026-03-02")
+    report(token_b, "found", "dog", 36.2021, 37.1343, "2026-03-02")  # Aleppo: outside the geo prefilter
+    report(token_b, "lost", "dog", 33.5200, 36.2900, "2026-03-02")  # same type never matches
+
+    assert [(m["lost_id"], m["found_id"]) for m in db.lost_found_matches.rows] == [(lost, found)]
+    notified = {n["user_id"] for n in db.notifications.rows if n["type"] == "lost_found_match"}
+    assert notified == {user_a["id"], user_b["id"]}
+
+    db.pets.rows.append({"id": "pet-1", "owner_id": user_a["id"], "name": "Rex", "species": "dog", "breed": "labrador"})
+    db.pet_tags.rows.append({"id": "tag-1", "tag_code": "REX123", "pet_id": "pet-1", "owner_id": user_a["id"], "is_active": True})
+    client.post("/api/pet-tags/scan/REX123/report", json={"location": "Malki", "latitude": 33.52, "longitude": 36.29})
+
+    matches = client.get(f"/api/lost-found/{lost}/matches", headers={"Authorization": f"Bearer {token_a}"}).json()
+    assert {("post" if m["post"] else "scan") for m in matches} == {"post", "scan"}
+    assert next(m for m in matches if m["scan"])["reasons"][0] == "tag"
+
+    # Retention moved the scan to the cold tier; the match still resolves it.
+    db.tag_scans_archive.rows.extend({**scan, "archived_at": datetime.utcnow()} for scan in db.tag_scans.rows)
+    db.tag_scans.rows.clear()
+    matches = client.get(f"/api/lost-found/{lost}/matches", headers={"Authorization": f"Bearer {token_a}"}).json()
+    assert next(m for m in matches if m.get("scan_id"))["scan"]["location"] == "Malki"
+    assert client.get(f"/api/lost-found/{lost}/matches", headers={"Authorization": f"Bearer {token_b}"}).status_code == 404
+    found_side = client.get(f"/api/lost-found/{found}/matches", headers={"Authorization": f"Bearer {token_b}"}).json()
+    assert [set(m) for m in found_side] == [{"id", "score"}]
+
+
+def test_tag_scans_are_served_from_the_card_cache_and_logged_write_behind(client_and_db):
+    client, db = client_and_db
+    token, user = _signup_and_verify(client, "tags@test.com", name="Owner")
+    auth = {"Authorization": f"Bearer {token}"}
+    pet_id = client.post("/api/pets", json={"name": "Rex", "species": "cat", "gender": "male"}, headers=auth).json()["id"]
+    client.post("/api/pet-tags", json={"pet_id": pet_id, "tag_code": "rex-1"}, headers=auth)
+
+    assert client.get("/api/pet-tags/scan/REX-1").json()["pet"]["name"] == "Rex"
+    with _query_budget(1):  # the shared version check at most; no tag/pet/user reads
+        for _ in range(20):
+            assert client.get("/api/pet-tags/scan/rex-1").status_code == 200
+    assert client.get("/api/pet-tags/scan/NOPE").status_code == 404
+
+    client.put(f"/api/pets/{pet_id}", json={"name": "Rexy"}, headers=auth)
+    client.put("/api/auth/update", json={"city": "Homs"}, headers=auth)
+    card = client.get("/api/pet-tags/scan/REX-1").json()
+    assert (card["pet"]["name"], card["owner"]["city"]) == ("Rexy", "Homs")
+
+    r = client.post("/api/pet-tags/scan/rex-1/report", json={"location": "Old Town", "message": "Found him"})
+    assert r.status_code == 200 and [s["id"] for s in db.tag_scans.rows] == [r.json()["scan_id"]]
+    asyncio.run(server.view_counters.flush())
+    tag = db.pet_tags.rows[0]
+    assert [s["id"] for s in db.tag_scans.rows] == [r.json()["scan_id"]]
+    assert (tag["scan_count"], tag["last_location"]) == (22, "Old Town")
+
+    client.put(f"/api/pet-tags/{pet_id}/status", json={"is_active": False}, headers=auth)
+    assert client.get("/api/pet-tags/scan/REX-1").status_code == 404
+
+
+def test_tag_cards_follow_admin_edits_and_ignore_loads_that_raced_an_invalidation(client_and_db, monkeypatch):
+    client, db = client_and_db
+    token, user = _signup_and_verify(client, "tagrace@test.com", name="Owner")
+    admin_token, admin = _signup_and_verify(client, "tagadmin@test.com", name="Admin")
+    admin.update({"role": "admin", "is_admin": True})
+    auth = {"Authorization": f"Bearer {token}"}
+    pet_id = client.post("/api/pets", json={"name": "Rex", "species": "cat", "gender": "male"}, headers=auth).json()["id"]
+    client.post("/api/pet-tags", json={"pet_id": pet_id, "tag_code": "race-1"}, headers=auth)
+    assert client.get("/api/pet-tags/scan/RACE-1").json()["owner"]["phone"] is None
+
+    r = client.put(f"/api/admin/users/{user['id']}", json={"phone": "555-0100"}, headers={"Authorization": f"Bearer {admin_token}"})
+    assert r.status_code == 200
+    assert client.get("/api/pet-tags/scan/RACE-1").json()["owner"]["phone"] == "555-0100"
+
+    real_find_one = db.pets.find_one
+
+    async def slow_find_one(*args, **kwargs):
+        pet = await real_find_one(*args, **kwargs)
+        await asyncio.sleep(0.05)
+        return pet
+
+    async def rename_during_load():
+        server.tag_cards.clear()
+        server.read_coalescer.forget("pet_tag_scan")
+        with monkeypatch.context() as m:
+            m.setattr(db.pets, "find_one", slow_find_one)
+            load = asyncio.create_task(server.tag_cards.get("RACE-1"))
+            await asyncio.sleep(0.01)  # the load has read the old pet
+            db.pets.rows[0]["name"] = "Rexy"
+            await server.tag_cards.invalidate_where({"pet_id": pet_id})
+            assert (await load)["card"]["pet"]["name"] == "Rex"
+        return (await server.tag_cards.get("RACE-1"))["card"]["pet"]["name"]
+
+    assert asyncio.run(rename_during_load()) == "Rexy"
+
+
+def test_pet_favorites_and_likes_share_one_counter(client_and_db):
+    client, db = client_and_db
+    token, _user = _signup_and_verify(client, "fav@test.com", name="Fav")
+    headers = {"Authorization": f"Bearer {token}"}
+    db.pets.rows.append({"id": "pet-f", "owner_id": "someone", "name": "Rex", "species": "cat", "gender": "male", "likes": 0})
+
+    client.post("/api/favorites/pet/pet-f", headers=headers)
+    client.post("/api/favorites/pet/pet-f", headers=headers)
+    assert db.pets.rows[0]["likes"] == 1
+    assert client.post("/api/pets/pet-f/like", headers=headers).json() == {"liked": False}
+    client.delete("/api/favorites/pet/pet-f", headers=headers)
+    assert db.pets.rows[0]["likes"] == 0 and db.favorites.rows == []
+    assert client.post("/api/favorites/pet/missing", headers=headers).status_code == 404
+
+
+def test_index_groups_run_independently_and_required_failures_stop_startup(monkeypatch):
+    ran = []
+
+    async def broken():
+        raise RuntimeError("boom")
+
+    async def ok():
+        ran.append("ok")
+
+    monkeypatch.setattr(server, "INDEX_GROUPS", [("optional", broken, False), ("after", ok, True)])
+    asyncio.run(server.ensure_indexes())
+    assert ran == ["ok"]
+
+    monkeypatch.setattr(server, "INDEX_GROUPS", [("required", broken, True), ("after", ok, False)])
+    with pytest.raises(RuntimeError, match="required"):
+        asyncio.run(server.ensure_indexes())
+    assert ran == ["ok", "ok"]
+
+
+def test_payment_failing_part_way_keeps_its_key_and_expired_leases_are_taken_over(client_and_db, monkeypatch):
+    client, db = client_and_db
+    token, _user = _signup_and_verify(client, "partial@test.com", name="Partial")
+    db.users.rows[-1]["loyalty_points"] = 100
+    db.payment_idempotency.unique = ("user_id", "key")
+    body = {"amount": 25.0, "payment_method": "stripe", "points_to_use": 100}
+    post_points = server.post_points
+
+    async def failing_earn(user_id, points, transaction_type, *args, **kwargs):
+        if transaction_type == "earned":
+            raise RuntimeError("connection reset")
+        return await post_points(user_id, points, transaction_type, *args, **kwargs)
+
+    monkeypatch.setattr(server, "post_points", failing_earn)
+    headers = {"Authorization": f"Bearer {token}", "Idempotency-Key": "pay-partial"}
+    assert client.post("/api/payments/process", json=body, headers=headers).status_code == 500
+    monkeypatch.setattr(server, "post_points", post_points)
+
+    retry = client.post("/api/payments/process", json=body, headers=headers)
+    assert retry.status_code == 409 and retry.json()["detail"]["code"] == "PAYMENT_NEEDS_RECONCILIATION"
+    assert db.payment_idempotency.rows[0]["partial"] == ["points_redeemed"]
+    assert db.users.rows[-1]["loyalty_points"] == 0  # debited once, not twice
+
+    stale = {"Authorization": f"Bearer {token}", "Idempotency-Key": "pay-stale"}
+    db.payment_idempotency.rows.append({
+        "user_id": db.users.rows[-1]["id"], "key": "pay-stale", "request_hash": server.payment_request_hash(
+            server.PaymentRequest(**dict(body, points_to_use=0))),
+        "status": "in_progress", "lease_until": datetime.utcnow() - timedelta(seconds=1), "created_at": datetime.utcnow(),
+    })
+    taken = client.post("/api/payments/process", json=dict(body, points_to_use=0), headers=stale)
+    assert taken.status_code == 200 and db.payment_idempotency.rows[-1]["status"] == "completed"
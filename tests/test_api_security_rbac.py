@@ -1,9 +1,12 @@
 import os
 import uuid
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
 import pytest
 from fastapi.testclient import TestClient
+from pymongo import ReturnDocument, UpdateMany
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
 os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
 os.environ.setdefault("DB_NAME", "petsy_test")
@@ -28,12 +31,14 @@ class DeleteResult:
 
 
 class FakeCursor:
-    def __init__(self, rows):
+    def __init__(self, rows, keep=None):
         self.rows = list(rows)
+        self.keep = keep  # projected fields, applied after sorting like the server does
 
-    def sort(self, key, direction):
-        reverse = direction == -1
-        self.rows.sort(key=lambda r: r.get(key), reverse=reverse)
+    def sort(self, key, direction=1):
+        keys = key if isinstance(key, list) else [(key, direction)]
+        for field, order in reversed(keys):
+            self.rows.sort(key=lambda r: r.get(field), reverse=order == -1)
         return self
 
     def skip(self, _n):
@@ -42,70 +47,290 @@ class FakeCursor:
     def limit(self, _n):
         return self
 
+    def batch_size(self, _n):
+        return self
+
+    def _project(self, row):
+        return {k: row[k] for k in row if k in self.keep} if self.keep else row
+
     async def to_list(self, n):
-        return list(self.rows)[:n]
+        return [self._project(r) for r in self.rows][:n]
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for row in self.rows:
+            yield self._project(row)
 
 
 class FakeCollection:
-    def __init__(self):
+    def __init__(self, name="-"):
+        self.name = name
         self.rows = []
+        self.unique = None  # tuple of fields emulating a unique index
 
-    async def insert_one(self, doc):
+    def _record(self, command, query=None, docs=0):
+        # Stand-in for Motor command monitoring so query budgets work against the fake.
+        server.record_query(self.name, command, 0.0, docs, server.query_shape(self.name, command, query))
+
+    async def insert_one(self, doc, session=None):
+        self._record("insert")
+        if self.unique and any(all(r.get(f) == doc.get(f) for f in self.unique) for r in self.rows):
+            raise DuplicateKeyError("duplicate key", 11000, {"keyPattern": {f: 1 for f in self.unique}})
         self.rows.append(dict(doc))
         return InsertResult(doc.get("id"))
 
+    async def insert_many(self, docs, ordered=True):
+        self._record("insert")
+        duplicates = 0
+        for doc in docs:
+            try:
+                await self.insert_one(doc)
+            except DuplicateKeyError:
+                duplicates += 1
+        if duplicates:
+            raise BulkWriteError({"writeErrors": [{"code": 11000}] * duplicates})
+
     def _match(self, row, query):
         for k, v in (query or {}).items():
-            if isinstance(v, dict) and "$ne" in v:
+            if k == "$and":
+                if not all(self._match(row, sub) for sub in v):
+                    return False
+            elif k == "$or":
+                if not any(self._match(row, sub) for sub in v):
+                    return False
+            elif isinstance(v, dict) and "$type" in v:
+                if v["$type"] == "string" and not isinstance(row.get(k), str):
+                    return False
+            elif isinstance(v, dict) and "$exists" in v:
+                if (k in row) != bool(v["$exists"]):
+                    return False
+            elif isinstance(v, dict) and "$ne" in v:
                 if row.get(k) == v["$ne"]:
                     return False
+            elif isinstance(v, dict) and "$nin" in v:
+                if row.get(k) in v["$nin"]:
+                    return False
+            elif isinstance(v, dict) and "$in" in v:
+                if row.get(k) not in v["$in"]:
+                    return False
+            elif isinstance(v, dict) and "$lt" in v:
+                if row.get(k) is None or not row.get(k) < v["$lt"]:
+                    return False
+            elif isinstance(v, dict) and "$gt" in v:
+                if row.get(k) is None or not row.get(k) > v["$gt"]:
+                    return False
+            elif isinstance(v, dict) and "$gte" in v:
+                if row.get(k) is None or not row.get(k) >= v["$gte"]:
+                    return False
+            elif isinstance(row.get(k), list) and not isinstance(v, list):
+                if v not in row.get(k):
+                    return False
             elif row.get(k) != v:
                 return False
         return True
 
-    async def find_one(self, query):
+    @staticmethod
+    def _apply(row, update):
+        if isinstance(update, list):  # aggregation pipeline update
+            for stage in update:
+                values = {k: _eval_expr(v, row, {}) for k, v in stage.get("$set", {}).items()}
+                for k, v in values.items():
+                    _set_path(row, k, v)
+            return
+        for k, v in update.get("$set", {}).items():
+            _set_path(row, k, v)
+        for k, v in update.get("$inc", {}).items():
+            _set_path(row, k, (_get_path(row, k) or 0) + v)
+        for k in update.get("$unset", {}).keys():
+            _pop_path(row, k)
+        for k, v in update.get("$pull", {}).items():
+            drop = (v or {}).get("product_id", {}).get("$in", [])
+            _set_path(row, k, [i for i in (_get_path(row, k) or []) if i.get("product_id") not in drop])
+        for k, v in update.get("$max", {}).items():
+            current = _get_path(row, k)
+            if current is None or v > current:
+                _set_path(row, k, v)
+
+    async def find_one(self, query, projection=None, session=None):
+        self._record("find", query)
         for row in self.rows:
             if self._match(row, query):
                 return dict(row)
         return None
 
-    def find(self, query):
-        return FakeCursor([dict(r) for r in self.rows if self._match(r, query)])
+    def find(self, query, projection=None):
+        self._record("find", query)
+        keep = [k for k, v in (projection or {}).items() if v]
+        rows = [r for r in self.rows if self._match(r, query)]
+        return FakeCursor([dict(r) for r in rows], keep)
+
+    async def distinct(self, field, query=None):
+        self._record("distinct", query)
+        return list(dict.fromkeys(r.get(field) for r in self.rows if self._match(r, query)))
 
-    async def update_one(self, query, update, upsert=False):
+    async def count_documents(self, query):
+        self._record("aggregate", query)
+        return len([r for r in self.rows if self._match(r, query)])
+
+    async def update_one(self, query, update, upsert=False, session=None):
+        self._record("update", query)
         for i, row in enumerate(self.rows):
             if self._match(row, query):
-                if "$set" in update:
-                    row.update(update["$set"])
-                if "$unset" in update:
-                    for k in update["$unset"].keys():
-                        row.pop(k, None)
+                self._apply(row, update)
                 self.rows[i] = row
                 return UpdateResult(matched_count=1, modified_count=1)
         if upsert:
-            new_row = dict(query)
-            if "$set" in update:
-                new_row.update(update["$set"])
+            new_row = {k: v for k, v in query.items() if not isinstance(v, dict)}
+            self._apply(new_row, update)
             self.rows.append(new_row)
             return UpdateResult(matched_count=0, modified_count=1)
         return UpdateResult()
 
+    async def find_one_and_update(self, query, update, upsert=False, return_document=None, projection=None, session=None):
+        self._record("findAndModify", query)
+        for i, row in enumerate(self.rows):
+            if self._match(row, query):
+                before = dict(row)
+                self._apply(row, update)
+                return before if return_document is ReturnDocument.BEFORE else dict(row)
+        if upsert:
+            new_row = {k: v for k, v in query.items() if not isinstance(v, dict)}
+            self._apply(new_row, update)
+            self.rows.append(new_row)
+            return dict(new_row)
+        return None
+
+    async def bulk_write(self, ops, ordered=True):
+        self._record("update", ops[0]._filter if ops else None)
+        for op in ops:
+            if isinstance(op, UpdateMany):
+                await self.update_many(op._filter, op._doc)
+            else:
+                await self.update_one(op._filter, op._doc, upsert=bool(op._upsert))
+
+    async def update_many(self, query, update, session=None):
+        self._record("update", query)
+        matched = [r for r in self.rows if self._match(r, query)]
+        for row in matched:
+            self._apply(row, update)
+        return UpdateResult(matched_count=len(matched), modified_count=len(matched))
+
+    async def delete_one(self, query, session=None):
+        self._record("delete", query)
+        for i, row in enumerate(self.rows):
+            if self._match(row, query):
+                del self.rows[i]
+                return DeleteResult(1)
+        return DeleteResult(0)
+
+    async def delete_many(self, query):
+        self._record("delete", query)
+        before = len(self.rows)
+        self.rows = [r for r in self.rows if not self._match(r, query)]
+        return DeleteResult(before - len(self.rows))
+
+
+def _get_path(row, path):
+    for part in path.split("."):
+        if not isinstance(row, dict):
+            return None
+        row = row.get(part)
+    return row
+
+
+def _eval_expr(expr, row, variables):
+    """Evaluate the aggregation expressions the server uses in pipeline updates."""
+    if isinstance(expr, str) and expr.startswith("$$"):
+        name, _, path = expr[2:].partition(".")
+        return _get_path(variables[name], path) if path else variables[name]
+    if isinstance(expr, str) and expr.startswith("$"):
+        return _get_path(row, expr[1:])
+    if isinstance(expr, list):
+        return [_eval_expr(e, row, variables) for e in expr]
+    if not isinstance(expr, dict):
+        return expr
+    if "$map" in expr:
+        spec = expr["$map"]
+        return [_eval_expr(spec["in"], row, {**variables, spec["as"]: item})
+                for item in _eval_expr(spec["input"], row, variables) or []]
+    if "$cond" in expr:
+        test, then, otherwise = expr["$cond"]
+        return _eval_expr(then if _eval_expr(test, row, variables) else otherwise, row, variables)
+    ops = {
+        "$ifNull": lambda a: a[0] if a[0] is not None else a[1],
+        "$in": lambda a: a[0] in a[1],
+        "$eq": lambda a: a[0] == a[1],
+        "$add": lambda a: sum(a),
+        "$concatArrays": lambda a: [x for part in a for x in part],
+    }
+    for op, fn in ops.items():
+        if op in expr:
+            return fn(_eval_expr(expr[op], row, variables))
+    return {k: _eval_expr(v, row, variables) for k, v in expr.items()}
+
+
+def _set_path(row, path, value):
+    *parents, leaf = path.split(".")
+    for part in parents:
+        row = row.setdefault(part, {})
+    row[leaf] = value
+
+
+def _pop_path(row, path):
+    *parents, leaf = path.split(".")
+    for part in parents:
+        row = row.get(part) or {}
+    row.pop(leaf, None)
+
 
 class FakeDB:
     def __init__(self):
-        self.users = FakeCollection()
-        self.pets = FakeCollection()
-        self.health_records = FakeCollection()
-        self.marketplace_listings = FakeCollection()
+        self.users = FakeCollection("users")
+        self.pets = FakeCollection("pets")
+        self.health_records = FakeCollection("health_records")
+        self.marketplace_listings = FakeCollection("marketplace_listings")
+
+    def __getattr__(self, name):
+        collection = FakeCollection(name)
+        setattr(self, name, collection)
+        return collection
+
+    def __getitem__(self, name):
+        return getattr(self, name)
 
 
 @pytest.fixture()
 def client_and_db(monkeypatch):
     fake_db = FakeDB()
     monkeypatch.setattr(server, "db", fake_db)
+    # Process-local read caches must not carry results across fake databases.
+    monkeypatch.setattr(server, "read_coalescer", server.SingleFlight(server.COALESCE_TTL_SECONDS, server.COALESCE_MAX_ENTRIES))
+    monkeypatch.setattr(server, "catalog_responses", server.CatalogResponseCache(30, 5, 256))
+    monkeypatch.setattr(server, "block_lists", server.BlockListCache(300, 5, 1000))
+    monkeypatch.setattr(server, "tag_cards", server.TagCardCache(300, 5, 1000))
+    monkeypatch.setattr(server, "view_counters", server.WriteBehindCounters(server.VIEW_COUNTER_MAX_PENDING))
     return TestClient(server.app), fake_db
 
 
+@contextmanager
+def _query_budget(max_queries):
+    """Fail when the requests made inside the block issue more than `max_queries` queries."""
+    sink = []
+    server.query_capture_sinks.append(sink)
+    try:
+        yield sink
+    finally:
+        server.query_capture_sinks.remove(sink)
+    shapes = {}
+    for stats in sink:
+        for shape, n in stats.shapes.items():
+            shapes[shape] = shapes.get(shape, 0) + n
+    total = sum(stats.count for stats in sink)
+    assert total <= max_queries, f"{total} queries over a budget of {max_queries}: {shapes}"
+
+
 def _signup_and_verify(client, email, name="User", password="secret123"):
     r = client.post("/api/auth/signup", json={"email": email, "name": name, "password": password})
     assert r.status_code == 200